@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""
+Follow the progress events written by builds generated with
+``generate_build_config --progress-log``, reporting them as they happen.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import time
+
+
+CHUNK_SIZE = 64 * 1024
+MAX_LINE_LENGTH = 64 * 1024
+POLL_INTERVAL = 1.0
+
+
+def _follow(path, offset=0, inode=None, follow=True,
+            poll_interval=POLL_INTERVAL, max_line_length=MAX_LINE_LENGTH):
+    """
+    Yield (line, offset, inode) tuples for each complete line appended to a
+    file, where offset is that just after the line; this can be passed back
+    in (with the inode) to resume after it without re-reading the file.
+
+    Only a partial line is ever buffered, and lines longer than
+    max_line_length are skipped, so memory use is bounded however long the
+    file grows.  If the file is truncated, or replaced (e.g. by log
+    rotation), it is followed again from its start.
+
+    :param path:
+        The path of the file to follow; it need not exist yet.
+    :param offset:
+        The offset to start reading from, if the file's inode matches inode
+        (or inode is None).
+    :param follow:
+        If False, stop at the end of the file instead of waiting for more.
+    """
+    f = None
+    buf = b''
+    discarding = False
+    while True:
+        if f is None:
+            try:
+                f = open(path, 'rb')
+            except (IOError, OSError):
+                if not follow:
+                    return
+                time.sleep(poll_interval)
+                continue
+            stat = os.fstat(f.fileno())
+            if (inode is not None and stat.st_ino != inode
+                    or stat.st_size < offset):
+                offset = 0
+            inode = stat.st_ino
+            f.seek(offset)
+        chunk = f.read(CHUNK_SIZE)
+        if chunk:
+            lines = (buf + chunk).split(b'\n')
+            buf = lines.pop()
+            for line in lines:
+                offset += len(line) + 1
+                if discarding:
+                    discarding = False
+                    continue
+                if len(line) > max_line_length:
+                    continue
+                yield line.decode('utf-8', 'replace'), offset, inode
+            if len(buf) > max_line_length:
+                discarding = True
+                offset += len(buf)
+                buf = b''
+            continue
+        if not follow:
+            f.close()
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+        if (stat is not None and stat.st_ino != inode
+                or stat is not None and stat.st_size < offset + len(buf)):
+            # Rotated or truncated; we have read all there was before
+            f.close()
+            f = None
+            offset = 0
+            buf = b''
+            discarding = False
+            continue
+        time.sleep(poll_interval)
+
+
+def _parse_event(line):
+    """
+    Parse a progress event, returning None for anything that isn't one.
+    """
+    try:
+        event = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(event, dict) or 'event' not in event:
+        return None
+    return event
+
+
+def _update_status(status, event):
+    """
+    Update a summary of the builds' progress with an event.
+
+    The summary holds only the latest state of each build, so stays small
+    however many events there are.
+    """
+    build_id = event.get('build_id')
+    if build_id is None:
+        target = status.setdefault('shared', {})
+    else:
+        target = status.setdefault('builds', {}).setdefault(build_id, {})
+    name = event['event']
+    if name == 'phase-start':
+        target['phase'] = event.get('phase')
+        target.pop('stage', None)
+    elif name == 'stage':
+        target['stage'] = event.get('stage')
+    elif name == 'build-end':
+        target['status'] = event.get('status')
+        target['images'] = event.get('images')
+    elif name == 'started':
+        status['builds_expected'] = event.get('builds')
+    elif name == 'finished':
+        status['finished'] = event
+    return status
+
+
+def _succeeded(finished):
+    return finished.get('succeeded') == finished.get('builds')
+
+
+def _format_event(event):
+    fields = ' '.join('{}={}'.format(key, event[key]) for key in sorted(event)
+                      if key not in ('time', 'event', 'build_id'))
+    timestamp = time.strftime('%H:%M:%S', time.localtime(event['time'])) \
+        if isinstance(event.get('time'), (int, float)) else '-'
+    return '{} {} {} {}'.format(timestamp, event.get('build_id', '-'),
+                                event['event'], fields).rstrip()
+
+
+def _read_offset_file(path):
+    try:
+        with open(path) as f:
+            state = json.load(f)
+        return state['offset'], state['inode']
+    except (IOError, OSError, ValueError, KeyError):
+        return 0, None
+
+
+def _write_offset_file(path, offset, inode):
+    partial_path = '{}.part'.format(path)
+    with open(partial_path, 'w') as f:
+        json.dump({'offset': offset, 'inode': inode}, f)
+    os.rename(partial_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('path', metavar='PROGRESS_LOG',
+                        help='The progress log to follow.')
+    parser.add_argument('--json', dest='json', action='store_true',
+                        help='Output each event as a line of JSON, instead '
+                        'of in a human-readable form.')
+    parser.add_argument('--no-follow', dest='follow', action='store_false',
+                        help='Exit at the end of the log, instead of waiting '
+                        'for more events.')
+    parser.add_argument('--offset-file', dest='offset_file', metavar='FILE',
+                        help='A file in which to record how far through the '
+                        'log has been reported, so that a later run resumes '
+                        'from there.')
+    parser.add_argument('--poll-interval', dest='poll_interval',
+                        type=float, default=POLL_INTERVAL, metavar='SECONDS',
+                        help='How often to check for new events.  Defaults '
+                        'to %(default)s.')
+    parser.add_argument('--until-finished', dest='until_finished',
+                        action='store_true',
+                        help='Exit once the builds have finished; the exit '
+                        'status is non-zero unless they all succeeded.')
+    args = parser.parse_args()
+
+    offset, inode = 0, None
+    if args.offset_file is not None:
+        offset, inode = _read_offset_file(args.offset_file)
+    status = {}
+    for line, offset, inode in _follow(
+            args.path, offset, inode, follow=args.follow,
+            poll_interval=args.poll_interval):
+        event = _parse_event(line)
+        if event is not None:
+            _update_status(status, event)
+            if args.json:
+                print(json.dumps(event, sort_keys=True))
+            else:
+                print(_format_event(event))
+            sys.stdout.flush()
+        if args.offset_file is not None:
+            _write_offset_file(args.offset_file, offset, inode)
+        if args.until_finished and 'finished' in status:
+            sys.exit(0 if _succeeded(status['finished']) else 1)
+    if args.until_finished:
+        # The log ended (with --no-follow) before the builds finished
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+"""
+Schedule the builds described by build matrix files on to build instances,
+running several builds on each instance where they fit.
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import hashlib
+import itertools
+import os
+import sys
+import threading
+import time
+
+from generate_build_config import (
+    BuildConfig,
+    DEFAULT_CHROOT_STORAGE_SIZE,
+    _expand_matrix,
+    _get_builds,
+    _load_matrix,
+)
+import local_build
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+JOB_STATES = (QUEUED, RUNNING, SUCCEEDED, FAILED)
+
+# The resources an instance has, or a job needs: CPUs, memory (in MiB) and
+# disk (in GiB)
+Resources = collections.namedtuple('Resources', ['cpus', 'memory', 'disk'])
+
+# Each build needs a 20G root disk (see the README); the CPUs and memory are
+# what builds usually use while they run
+BUILD_RESOURCES = Resources(cpus=2, memory=4096, disk=20)
+# Enough for four builds
+DEFAULT_INSTANCE_BUDGET = Resources(cpus=8, memory=16384, disk=80)
+POLL_INTERVAL = 30.0
+
+
+def _get_job_resources(config):
+    """
+    Estimate the resources that building a BuildConfig will need.
+
+    Every build needs its own disk, but only the builds which run at once
+    (at most parallel_builds of them) need CPUs and memory at the same time;
+    builds on tmpfs or zram also need memory for their chroot storage.
+    """
+    builds = len(_get_builds(config.architectures, config.projects))
+    concurrent_builds = min(builds, config.parallel_builds or builds)
+    memory = BUILD_RESOURCES.memory
+    if config.chroot_storage in ('tmpfs', 'zram'):
+        memory += config.chroot_storage_size or DEFAULT_CHROOT_STORAGE_SIZE
+    return Resources(cpus=BUILD_RESOURCES.cpus * concurrent_builds,
+                     memory=memory * concurrent_builds,
+                     disk=BUILD_RESOURCES.disk * builds)
+
+
+def _fits(resources, budget):
+    return all(needed <= available
+               for needed, available in zip(resources, budget))
+
+
+def _add_resources(first, second):
+    return Resources(*[a + b for a, b in zip(first, second)])
+
+
+def _pack_jobs(jobs, budget, max_jobs=None):
+    """
+    Pack jobs in to as few groups as possible, each needing no more than
+    budget between them (first-fit, largest jobs first), and each of no more
+    than max_jobs jobs (if that is given).
+
+    Returns a list of (resources needed, jobs) tuples.
+    """
+    groups = []
+    for job in sorted(jobs, key=lambda job: tuple(reversed(job.resources)),
+                      reverse=True):
+        for index, (resources, group) in enumerate(groups):
+            if max_jobs is not None and len(group) >= max_jobs:
+                continue
+            combined = _add_resources(resources, job.resources)
+            if _fits(combined, budget):
+                groups[index] = (combined, group + [job])
+                break
+        else:
+            groups.append((job.resources, [job]))
+    return groups
+
+
+class Job(object):
+    """
+    A build to be scheduled: a rendered cloud-config and its state.
+
+    Jobs are identified by the SHA256 of their rendered cloud-config, so two
+    configs which render identically are the same job.
+    """
+
+    __slots__ = ('id', 'name', 'config', 'cloud_config', 'resources',
+                 'state', 'instance', 'error', 'submissions')
+
+    def __init__(self, config, cloud_config, name=None):
+        self.id = hashlib.sha256(cloud_config.encode('utf-8')).hexdigest()
+        self.name = name or self.id[:12]
+        self.config = config
+        self.cloud_config = cloud_config
+        self.resources = _get_job_resources(config)
+        self.state = QUEUED
+        self.instance = None
+        self.error = None
+        self.submissions = 1
+
+    def __repr__(self):
+        return 'Job({}, {})'.format(self.name, self.state)
+
+
+class InstanceBackend(object):
+    """
+    The interface between a Scheduler and whatever launches build instances;
+    subclasses implement it for a particular cloud (or other host).
+
+    Each Job's cloud-config is a complete one, which expects an instance to
+    itself: builds use fixed paths (the home directory, the "root" build ID,
+    /tmp/root-*.squashfs and the images directory).  So by default, each
+    instance is launched for a single job, as a cloud instance takes a
+    single user-data.  Backends which isolate the jobs on an instance from
+    each other (e.g. in containers, as LocalBuildBackend does) can set
+    max_jobs_per_instance to None, to have as many jobs packed on to each
+    instance as fit.
+    """
+
+    max_jobs_per_instance = 1
+
+    def launch(self, name, resources, jobs):
+        """
+        Launch an instance with at least the given resources, which runs the
+        cloud-config of each of the given Jobs (at most
+        max_jobs_per_instance of them), each in isolation from the others.
+
+        Returns an identifier for the instance, which the scheduler passes
+        back to poll() and terminate().
+        """
+        raise NotImplementedError
+
+    def poll(self, instance):
+        """
+        Return a dict mapping the ID of each job on an instance that has
+        finished to a (SUCCEEDED or FAILED, error or None) tuple.
+        """
+        raise NotImplementedError
+
+    def terminate(self, instance):
+        """
+        Tear down an instance once all of its jobs have finished.
+        """
+
+
+class LocalBuildBackend(InstanceBackend):
+    """
+    Run each "instance" as containers on this host, using local_build; with
+    a budget matching this host, this runs as many builds at once as fit.
+    Each job gets its own container, so any number can share an "instance".
+    """
+
+    max_jobs_per_instance = None
+
+    def __init__(self, output_dir, backend='lxd', **backend_kwargs):
+        self.output_dir = output_dir
+        self.backend = backend
+        self.backend_kwargs = backend_kwargs
+        self._results = {}
+
+    def _run_job(self, name, job):
+        job_dir = os.path.join(self.output_dir, job.name)
+        if not os.path.isdir(job_dir):
+            os.makedirs(job_dir)
+        config_path = os.path.join(job_dir, 'build-config.yaml')
+        with open(config_path, 'w') as f:
+            f.write(job.cloud_config)
+        try:
+            with open(os.path.join(job_dir, 'build.log'), 'w') as log:
+                succeeded = local_build._run_build(
+                    config_path, name, self.backend,
+                    output_dir=os.path.join(job_dir, 'images'), log=log,
+                    **self.backend_kwargs)
+            self._results[job.id] = (SUCCEEDED, None) if succeeded else (
+                FAILED, 'see {}'.format(os.path.join(job_dir, 'build.log')))
+        except Exception as e:
+            self._results[job.id] = (FAILED, str(e))
+
+    def launch(self, name, resources, jobs):
+        for index, job in enumerate(jobs):
+            thread = threading.Thread(
+                target=self._run_job,
+                args=('{}-{}'.format(name, index), job))
+            thread.daemon = True
+            thread.start()
+        return (name, tuple(job.id for job in jobs))
+
+    def poll(self, instance):
+        _, job_ids = instance
+        return dict((job_id, self._results[job_id])
+                    for job_id in job_ids if job_id in self._results)
+
+
+class Scheduler(object):
+    """
+    Accepts build jobs, and runs them on instances launched by a backend.
+
+    For example::
+
+        scheduler = Scheduler(backend, max_instances=4)
+        for kwargs in configs:
+            scheduler.submit(BuildConfig(**kwargs))
+        scheduler.run()
+
+    :param backend:
+        The InstanceBackend to launch instances with.
+    :param budget:
+        The Resources of each instance; as many jobs are run on an instance
+        as fit in to this (and the backend's max_jobs_per_instance allows).
+    :param max_instances:
+        The (optional) maximum number of instances to run at once.
+    :param name_prefix:
+        The prefix of the names given to instances.
+    """
+
+    def __init__(self, backend, budget=DEFAULT_INSTANCE_BUDGET,
+                 max_instances=None, name_prefix='usb'):
+        self.backend = backend
+        self.budget = budget
+        self.max_instances = max_instances
+        self.name_prefix = name_prefix
+        self.jobs = collections.OrderedDict()
+        self.instances = {}
+        self._cache = {}
+        self._counter = itertools.count()
+
+    def submit(self, config, name=None):
+        """
+        Submit a BuildConfig to be built, returning its Job.
+
+        If an identical config has already been submitted, its Job is
+        returned instead (and, if it failed, queued again).
+        """
+        cloud_config = config.render(cache=self._cache)
+        job = Job(config, cloud_config, name=name)
+        existing = self.jobs.get(job.id)
+        if existing is not None:
+            existing.submissions += 1
+            if existing.state == FAILED:
+                existing.state, existing.error = QUEUED, None
+            return existing
+        if not _fits(job.resources, self.budget):
+            raise ValueError(
+                'Job {} needs {}, more than an instance has ({}).'.format(
+                    job.name, job.resources, self.budget))
+        self.jobs[job.id] = job
+        return job
+
+    def get_jobs(self, state):
+        return [job for job in self.jobs.values() if job.state == state]
+
+    def schedule(self):
+        """
+        Launch instances for queued jobs, as many as max_instances allows.
+
+        Returns the identifiers of the instances launched.
+        """
+        launched = []
+        for resources, jobs in _pack_jobs(
+                self.get_jobs(QUEUED), self.budget,
+                self.backend.max_jobs_per_instance):
+            if (self.max_instances is not None
+                    and len(self.instances) >= self.max_instances):
+                break
+            name = '{}-{}'.format(self.name_prefix, next(self._counter))
+            try:
+                instance = self.backend.launch(name, resources, jobs)
+            except Exception as e:
+                for job in jobs:
+                    job.state, job.error = FAILED, str(e)
+                continue
+            self.instances[instance] = jobs
+            for job in jobs:
+                job.state, job.instance = RUNNING, instance
+            launched.append(instance)
+        return launched
+
+    def poll(self):
+        """
+        Update the states of running jobs, and terminate the instances
+        whose jobs have all finished.
+        """
+        for instance, jobs in list(self.instances.items()):
+            results = self.backend.poll(instance)
+            for job in jobs:
+                if job.id in results:
+                    job.state, job.error = results[job.id]
+            if all(job.state != RUNNING for job in jobs):
+                self.backend.terminate(instance)
+                del self.instances[instance]
+
+    def run(self, poll_interval=POLL_INTERVAL):
+        """
+        Schedule and poll until no jobs are queued or running, returning
+        True if they all succeeded.
+        """
+        while True:
+            self.schedule()
+            if not self.instances:
+                break
+            time.sleep(poll_interval)
+            self.poll()
+        return all(job.state == SUCCEEDED for job in self.jobs.values())
+
+    def get_summary(self):
+        """
+        Return a dict mapping each job state to the number of jobs in it.
+        """
+        summary = dict((state, 0) for state in JOB_STATES)
+        for job in self.jobs.values():
+            summary[job.state] += 1
+        return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('matrices', metavar='MATRIX_FILE', nargs='+',
+                        help='A build matrix file (see generate_build_config '
+                        '--matrix); each combination in it is a job.')
+    parser.add_argument('--backend', dest='backend',
+                        choices=local_build.BACKENDS, default='lxd',
+                        help='How run_local_build should run the builds.  '
+                        'Defaults to %(default)s.')
+    parser.add_argument('--cpus', dest='cpus', type=int,
+                        default=DEFAULT_INSTANCE_BUDGET.cpus,
+                        help='The CPUs to allow for the builds run at once.  '
+                        'Defaults to %(default)s.')
+    parser.add_argument('--directory', dest='directory', metavar='DIR',
+                        help='With the nspawn backend, the Ubuntu root '
+                        'filesystem to run each build in (ephemerally).')
+    parser.add_argument('--disk', dest='disk', type=int, metavar='GIB',
+                        default=DEFAULT_INSTANCE_BUDGET.disk,
+                        help='The disk to allow for the builds run at once.  '
+                        'Defaults to %(default)s GiB.')
+    parser.add_argument('--image', dest='image',
+                        default=local_build.DEFAULT_LXD_IMAGE,
+                        help='With the lxd backend, the image to launch each '
+                        'build from.  Defaults to %(default)s.')
+    parser.add_argument('--memory', dest='memory', type=int, metavar='MIB',
+                        default=DEFAULT_INSTANCE_BUDGET.memory,
+                        help='The memory to allow for the builds run at '
+                        'once.  Defaults to %(default)s MiB.')
+    parser.add_argument('--output-dir', dest='output_dir', metavar='DIR',
+                        default='.',
+                        help='The directory in which to put the config, log '
+                        'and images of each job, in a subdirectory named '
+                        'after its matrix file and its output path in the '
+                        'matrix.  Defaults to the current directory.')
+    parser.add_argument('--poll-interval', dest='poll_interval',
+                        type=float, default=POLL_INTERVAL, metavar='SECONDS',
+                        help='How often to check on the builds.  Defaults to '
+                        '%(default)s.')
+    args = parser.parse_args()
+    if args.backend == 'nspawn' and args.directory is None:
+        parser.error('--directory must be given with --backend nspawn')
+
+    if args.backend == 'lxd':
+        backend_kwargs = {'image': args.image}
+    else:
+        backend_kwargs = {'directory': args.directory}
+    backend = LocalBuildBackend(args.output_dir, backend=args.backend,
+                                **backend_kwargs)
+    # The jobs all run on this host, so one "instance" at a time
+    scheduler = Scheduler(
+        backend, budget=Resources(args.cpus, args.memory, args.disk),
+        max_instances=1)
+    # Job names are used for their output directories, so must be unique
+    names = set()
+    for matrix_file in args.matrices:
+        _, matrix = _load_matrix(matrix_file)
+        matrix_name = os.path.splitext(os.path.basename(matrix_file))[0]
+        for path, kwargs in _expand_matrix(matrix):
+            name = base_name = '{}-{}'.format(
+                matrix_name, os.path.splitext(os.path.basename(path))[0])
+            for index in itertools.count(1):
+                if name not in names:
+                    break
+                name = '{}-{}'.format(base_name, index)
+            names.add(name)
+            try:
+                job = scheduler.submit(BuildConfig(**kwargs), name=name)
+            except ValueError as e:
+                sys.exit(str(e))
+            if job.submissions > 1:
+                print('{}: same as {}, skipping'.format(name, job.name))
+    succeeded = scheduler.run(poll_interval=args.poll_interval)
+    for job in scheduler.jobs.values():
+        error = ' ({})'.format(job.error) if job.error else ''
+        print('{}: {}{}'.format(job.name, job.state, error))
+    if not succeeded:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
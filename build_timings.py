@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Aggregate the timings.json files written by builds generated with
+``generate_build_config --instrument`` in to per-phase percentiles.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+
+
+DEFAULT_PERCENTILES = (50, 90, 99)
+
+
+def _find_timings_files(paths):
+    """
+    Yield the timings files at, or (recursively) within, the given paths.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, _, filenames in os.walk(path):
+            if 'timings.json' in filenames:
+                yield os.path.join(dirpath, 'timings.json')
+
+
+def _load_durations(timings_files):
+    """
+    Return a dict mapping phase names to the list of their durations across
+    the given timings files.  Phases that didn't complete are skipped.
+    """
+    durations = {}
+    for timings_file in timings_files:
+        with open(timings_file) as f:
+            timings = json.load(f)
+        for phase in timings['phases']:
+            if phase['duration'] is not None:
+                durations.setdefault(phase['name'], []).append(
+                    phase['duration'])
+    return durations
+
+
+def _percentile(values, percentile):
+    """
+    Return a percentile of a list of values, linearly interpolating between
+    the closest ranks.
+    """
+    values = sorted(values)
+    rank = (len(values) - 1) * percentile / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def _aggregate(durations, percentiles=DEFAULT_PERCENTILES):
+    """
+    Return a dict mapping each phase to the number of times it was recorded
+    and its duration at each of the given percentiles.
+    """
+    return dict(
+        (phase, {
+            'count': len(values),
+            'percentiles': dict(
+                (str(percentile), _percentile(values, percentile))
+                for percentile in percentiles)})
+        for phase, values in durations.items())
+
+
+def _format_table(aggregated, percentiles=DEFAULT_PERCENTILES):
+    header = ['phase', 'count'] + ['p{}'.format(percentile)
+                                   for percentile in percentiles]
+    rows = [header]
+    for phase in sorted(aggregated):
+        rows.append([phase, str(aggregated[phase]['count'])] + [
+            '{:.2f}'.format(aggregated[phase]['percentiles'][str(percentile)])
+            for percentile in percentiles])
+    widths = [max(len(row[column]) for row in rows)
+              for column in range(len(header))]
+    return '\n'.join(
+        '  '.join(cell.ljust(width) for cell, width in zip(row, widths))
+        .rstrip() for row in rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('paths', nargs='+', metavar='PATH',
+                        help='A timings.json file, or a directory to search '
+                        'for them.')
+    parser.add_argument('--percentiles', dest='percentiles',
+                        default=','.join(str(percentile) for percentile
+                                         in DEFAULT_PERCENTILES),
+                        help='A comma-separated list of the percentiles to '
+                        'report.  Defaults to "%(default)s".')
+    parser.add_argument('--json', dest='json', action='store_true',
+                        help='Output JSON instead of a table.')
+    args = parser.parse_args()
+
+    try:
+        percentiles = [float(percentile)
+                       for percentile in args.percentiles.split(',')]
+    except ValueError:
+        parser.error('--percentiles must be a comma-separated list of '
+                     'numbers.')
+    percentiles = [int(percentile) if percentile.is_integer() else percentile
+                   for percentile in percentiles]
+    if any(not 0 <= percentile <= 100 for percentile in percentiles):
+        parser.error('--percentiles must be between 0 and 100.')
+    durations = _load_durations(_find_timings_files(args.paths))
+    if not durations:
+        parser.error('No timings found.')
+    aggregated = _aggregate(durations, percentiles)
+    if args.json:
+        json.dump(aggregated, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        print(_format_table(aggregated, percentiles))
+
+
+if __name__ == '__main__':
+    main()
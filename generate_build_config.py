@@ -3,66 +3,459 @@ from __future__ import print_function
 
 import argparse
 import base64
+import collections
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import os
+import re
+import string
+import subprocess
 import sys
+import tarfile
+
+import yaml
+
+try:
+    from inspect import getfullargspec as getargspec
+except ImportError:  # Python 2
+    from inspect import getargspec
+
+try:
+    from urllib.request import urlopen
+except ImportError:  # Python 2
+    from urllib2 import urlopen
 
 
 TEMPLATE = """\
 #cloud-config
 packages:
-- bzr
-- squashfs-tools
-- python-setuptools
-- python-twisted
-- dpkg-dev
+{packages}
 runcmd:
 # Setup environment
 - export HOME={homedir}
-- export BUILD_ID=root
+{apt_proxy_setup}
+{copy_payloads}
+
+# Fetch base images
+{base_image_fetch}
+
+# Pull in build scripts and install the python parts
+{buildd_install}
+
+# Perform the build
+{builds}
+"""  # noqa: E501
+
+BUILD_TEMPLATE = """\
+- export BUILD_ID={build_id}
 - export CHROOT_ROOT={homedir}/build-$BUILD_ID/chroot-autobuild
 
 # Setup build chroot
-- wget http://cloud-images.ubuntu.com/xenial/current/xenial-server-cloudimg-amd64.squashfs -O /tmp/root.squashfs
+{storage_conf}
 - mkdir -p $CHROOT_ROOT
-- unsquashfs -force -no-progress -dest $CHROOT_ROOT /tmp/root.squashfs
-- mkdir $CHROOT_ROOT/build
+{unpack_chroot}
+- mkdir -p $CHROOT_ROOT/build
 - rm $CHROOT_ROOT/etc/resolv.conf  # We need to write over this symlink
 - cp /etc/resolv.conf $CHROOT_ROOT/etc/resolv.conf
+{apt_proxy_conf}
+{qemu_conf}
+# Update the build chroot
+- {homedir}/launchpad-buildd/bin/mount-chroot $BUILD_ID
+{update_chroot}
+{squashfs_conf}
+
+# Build the images
+- "{homedir}/launchpad-buildd/bin/buildlivefs --arch {arch} --project {project} --series {series} --build-id $BUILD_ID --datestamp ubuntu-standalone-builder-$(date +%s) {image_ppa}"
+- {homedir}/launchpad-buildd/bin/umount-chroot $BUILD_ID
+
+# Collect the images
+- mkdir -p {images}
+- mv $CHROOT_ROOT/build/livecd.{project}.* {images}
+{storage_release}"""  # noqa: E501
+
+# In worker mode, an instance is set up once (with WORKER_TEMPLATE) to run
+# many build jobs, which are each rendered as a script (from
+# WORKER_JOB_TEMPLATE) to put in its job queue; see WORKER_CONTENT.
+WORKER_TEMPLATE = """\
+#cloud-config
+packages:
+{packages}
+runcmd:
+# Setup environment
+- export HOME={homedir}
+{apt_proxy_setup}
+{copy_payloads}
 
 # Pull in build scripts and install the python parts
-- bzr branch lp:launchpad-buildd {homedir}/launchpad-buildd
-- "cd /home/ubuntu/launchpad-buildd; python setup.py install; cd"
+{buildd_install}
+
+# Start the worker
+- mkdir -p {homedir}/jobs/queue
+- systemctl enable --now --no-block {worker_unit}
+"""
+
+WORKER_JOB_TEMPLATE = """\
+#cloud-config
+runcmd:
+# Setup environment
+- export HOME={homedir}
+- "dpkg -s {packages} > /dev/null 2>&1 || {{ apt-get update -q && apt-get install -qy {packages}; }}"
+{copy_payloads}
+
+# Fetch base images
+{base_image_fetch}
+
+# Pull in build scripts and install the python parts
+{buildd_install}
 
 # Perform the build
-- {homedir}/launchpad-buildd/bin/mount-chroot $BUILD_ID
-{ppa_conf}
-- {homedir}/launchpad-buildd/bin/update-debian-chroot $BUILD_ID
-- "{homedir}/launchpad-buildd/bin/buildlivefs --arch amd64 --project ubuntu-cpc --series xenial --build-id $BUILD_ID --datestamp ubuntu-standalone-builder-$(date +%s) {image_ppa}"
-- {homedir}/launchpad-buildd/bin/umount-chroot $BUILD_ID
-- mkdir {homedir}/images
-- mv $CHROOT_ROOT/build/livecd.ubuntu-cpc.* {homedir}/images
+{builds}
+
+# Clean up the build trees
+- "for tree in {homedir}/build-*/; do rm -rf --one-file-system $tree; done"
 """  # noqa: E501
 
+# The job's exit status is that of its last command
+WORKER_JOB_CHECK_TEMPLATE = """
+- "find {homedir}/images -name 'livecd.*' | grep -q ."
+"""
+
+# Jobs keep the base images they fetch on the worker, and only download them
+# again once they have changed upstream
+WORKER_BASE_IMAGE_TEMPLATE = """\
+- mkdir -p {directory}
+- wget -N -nv -P {directory} {url}{filename}
+- ln -sf {directory}/{filename} {destination}"""
+
+WORKER_JOB_BUILDD_TEMPLATE = """\
+- ln -sfn {worker_homedir}/launchpad-buildd {homedir}/launchpad-buildd"""
+
+WORKER_JOB_SCRIPT_TEMPLATE = """\
+#!/bin/sh
+# A build job for an ubuntu-standalone-builder worker
+export DEBIAN_FRONTEND=noninteractive
+{write_files}
+{runcmd}
+"""
+
+WORKER_JOB_FILE_TEMPLATE = """\
+mkdir -p {directory}
+base64 -d <<"PAYLOAD" {decompress}> {path}
+{content}
+PAYLOAD
+chmod {permissions} {path}"""
+
+WORKER_JOB_NAME_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]*$')
+WORKER_UNIT = 'ubuntu-standalone-builder-worker.service'
+
+# The section comments in TEMPLATE and BUILD_TEMPLATE (and the worker
+# templates), mapped to the name of the phase of the build that they start
+# (or None for untimed sections).
+PHASES = {
+    '# Setup environment': None,
+    '# Fetch base images': 'fetch-base-images',
+    '# Pull in build scripts and install the python parts':
+        'install-launchpad-buildd',
+    '# Perform the build': None,
+    '# Setup build chroot': 'unpack-chroot',
+    '# Update the build chroot': 'update-chroot',
+    '# Build the images': 'buildlivefs',
+    '# Collect the images': 'collect-images',
+    '# Post-process the images': 'post-process-images',
+    '# Publish the images': 'publish-images',
+    '# Prefetch network inputs': 'prefetch',
+    '# Start the worker': None,
+    '# Clean up the build trees': None,
+    '# Unpack the offline bundle': 'unpack-offline-bundle',
+}
+
+PHASE_TIMER_TEMPLATE = '- {{homedir}}/phase-timer.sh {log} {event} {phase}'
+SHARED_TIMINGS_LOG = '{homedir}/timings.log'
+BUILD_TIMINGS_LOG = '{homedir}/timings-$BUILD_ID.log'
+TIMINGS_JSON_TEMPLATE = """
+- {homedir}/phase-timer.sh json {images}/timings.json {homedir}/timings.log {homedir}/timings-$BUILD_ID.log"""  # noqa: E501
+
+# Added to BUILD_TEMPLATE (before it is instrumented) to checksum, and
+# optionally compress, the images; the manifest is written once the build's
+# timings are.
+POST_PROCESS_TEMPLATE = """
+
+# Post-process the images
+- {{homedir}}/post-process.sh artifacts {{images}} {compressor} {level}"""
+POST_PROCESS_MANIFEST_TEMPLATE = """
+- {homedir}/post-process.sh manifest {images}"""
+
+# Added to TEMPLATE (before it is instrumented) to upload the images once
+# every build has finished.
+PUBLISH_TEMPLATE = """
+# Publish the images
+- {{homedir}}/publish.sh {url} {{homedir}}/images {chunk_size} {jobs}
+"""
+# The URLs that images can be published to; they are templated in to
+# runcmd, and the images' paths appended to them.
+PUBLISH_URL_PATTERN = re.compile(r'^https?://[^\s\'"?#;&|<>`$\\{}()]+$')
+DEFAULT_PUBLISH_JOBS = 4
+
+# Inserted in to TEMPLATE (and the worker templates) after the environment
+# is set up, to fetch every network input listed in the prefetch manifest
+# at once; the steps which would otherwise fetch them use these copies.
+PREFETCH_TEMPLATE = """
+# Prefetch network inputs
+- {homedir}/prefetch.sh {homedir}/prefetch.manifest || exit 1
+"""
+PREFETCH_KINDS = ('url', 'newer', 'bzr')
+
+# Offline bundles (made by make_offline_bundle) are tarballs of the inputs a
+# build would otherwise download, indexed by a SHA256SUMS file.  With one,
+# the bundle is unpacked and checked (in place of prefetching those inputs)
+# after the environment is set up, and the build uses only its contents.
+OFFLINE_BUNDLE_TEMPLATE = """
+# Unpack the offline bundle
+{offline_bundle}
+"""
+OFFLINE_BUNDLE_FETCH_TEMPLATE = """\
+- wget -nv {url} -O {archive}"""
+OFFLINE_BUNDLE_UNPACK_TEMPLATE = """\
+- mkdir -p {directory}
+- tar -xf {archive} -C {directory}
+- "cd {directory}; sha256sum -c --quiet {index} && ls {required} > /dev/null || exit 1; cd\""""  # noqa: E501
+OFFLINE_BUNDLE_INDEX = 'SHA256SUMS'
+OFFLINE_BUNDLE_BASE_IMAGE_PATH = 'base-images/{series}/{filename}'
+OFFLINE_BUNDLE_BUILDD_PATH = 'launchpad-buildd.tar.gz'
+OFFLINE_BUNDLE_PPA_KEY_PATH = 'ppa-keys/{key_id}.asc'
+OFFLINE_BUNDLE_PATTERN = re.compile(
+    r'^(https?://|/)[^\s\'"?#;&|<>`$\\{}()*]+$')
+
+# Progress events are appended, as lines of JSON, to the progress log by
+# progress.sh (see PROGRESS_CONTENT).
+PROGRESS_PHASE_TEMPLATE = '- {{homedir}}/progress.sh phase-{event} phase {phase}'  # noqa: E501
+PROGRESS_SETUP_TEMPLATE = """\
+- export PROGRESS_LOG={progress_log}
+- {{homedir}}/progress.sh started builds {builds}"""
+PROGRESS_DOWNLOADED_TEMPLATE = """\
+- "{homedir}/progress.sh downloaded path {path} bytes $(stat -L -c %s {path})\""""  # noqa: E501
+PROGRESS_BUILDLIVEFS_TEMPLATE = """\
+- "{{{{ {command} 2>&1; echo $? > {{homedir}}/buildlivefs-$BUILD_ID.status; }}}} | {{homedir}}/progress.sh stages\""""  # noqa: E501
+PROGRESS_BUILD_END_TEMPLATE = """
+- "{homedir}/progress.sh build-end status $(cat {homedir}/buildlivefs-$BUILD_ID.status) images $(ls {images} | wc -l)\""""  # noqa: E501
+PROGRESS_FINISHED_TEMPLATE = """
+- "{homedir}/progress.sh finished builds {builds} succeeded $(grep -lx 0 {homedir}/buildlivefs-*.status 2>/dev/null | wc -l)\""""  # noqa: E501
+
+BUILDD_BZR_BRANCH = 'lp:launchpad-buildd'
+BUILDD_BZR_INSTALL_TEMPLATE = """\
+- "cd {homedir}/launchpad-buildd; python setup.py install; cd\""""
+BUILDD_BZR_TEMPLATE = """\
+- bzr branch lp:launchpad-buildd {homedir}/launchpad-buildd
+""" + BUILDD_BZR_INSTALL_TEMPLATE
+
+BUILDD_FETCH_TEMPLATE = """\
+- wget {url} -O {tarball}"""
+
+# The python parts of a pre-packaged launchpad-buildd are used in place, so
+# don't need to be built or installed.
+BUILDD_UNPACK_TEMPLATE = """\
+- mkdir -p {homedir}/launchpad-buildd
+- tar -xf {tarball} -C {homedir}/launchpad-buildd --strip-components=1
+- export PYTHONPATH={homedir}/launchpad-buildd"""
+BUILDD_TARBALL_TEMPLATE = """\
+- echo '{sha256}  {tarball}' | sha256sum -c -
+""" + BUILDD_UNPACK_TEMPLATE
+
+UNPACK_CHROOT_TEMPLATE = """\
+- unsquashfs -force -no-progress{processors} -dest $CHROOT_ROOT {base_image}"""
+# With "auto" unsquashfs processors, the instance's CPUs are shared between
+# the builds running at once.
+UNSQUASHFS_PROCESSORS_AUTO = '$(( ($(nproc) + {builds} - 1) / {builds} ))'
+
+# mksquashfs in the build chroot is diverted, and replaced by a wrapper
+# which sets the compressor and block size of the squashfses it builds.
+SQUASHFS_CONF_TEMPLATE = """\
+- chroot $CHROOT_ROOT dpkg-divert --local --rename --divert /usr/bin/mksquashfs.distrib --add /usr/bin/mksquashfs
+- cp {homedir}/mksquashfs $CHROOT_ROOT/usr/bin/mksquashfs"""  # noqa: E501
+# Compressors for built squashfses, mapped to the series whose
+# squashfs-tools support them (or None, if all do).
+SQUASHFS_COMPRESSORS = {
+    'gzip': None,
+    'lz4': None,
+    'lzo': None,
+    'xz': None,
+    'zstd': ('focal', 'jammy'),
+}
+
+UPDATE_CHROOT_TEMPLATE = """\
+{ppa_conf}
+- {homedir}/launchpad-buildd/bin/update-debian-chroot $BUILD_ID"""
+
+# When snapshotting, whether the chroot was restored from a snapshot is
+# decided once, so that a snapshot created by a concurrent build part way
+# through can't cause the chroot update to be skipped.  The hooks written for
+# this config aren't overwritten by any in (older) snapshots.
+RESTORE_CHROOT_SNAPSHOT_TEMPLATE = """\
+- export CHROOT_SNAPSHOT={snapshot_dir}/{key}-$(date +%Y%m%d).tar
+- "if [ -f $CHROOT_SNAPSHOT ]; then export CHROOT_RESTORED=1; tar -xf $CHROOT_SNAPSHOT {hook_excludes} -C $CHROOT_ROOT; else export CHROOT_RESTORED=0; {unpack}; fi\""""  # noqa: E501
+
+# Hooks and proxy configuration are excluded from snapshots, as they are
+# written per-config.  Any older snapshots for the same key are removed once
+# a new one is in place.
+CREATE_CHROOT_SNAPSHOT_TEMPLATE = """\
+- mkdir -p {snapshot_dir}
+- "[ $CHROOT_RESTORED = 1 ] || {{ tar -cf $CHROOT_SNAPSHOT.$BUILD_ID.part --one-file-system {hook_excludes} --exclude=.{apt_proxy_conf_path} -C $CHROOT_ROOT . && find {snapshot_dir} -name '{key}-*.tar' -delete && mv $CHROOT_SNAPSHOT.$BUILD_ID.part $CHROOT_SNAPSHOT; }}\""""  # noqa: E501
+
+PARALLEL_BUILDS_TEMPLATE = """\
+- "echo {build_ids} | xargs -n 1 -P {parallelism} sh -c 'sh -x {homedir}/build-$0.sh > {homedir}/build-$0.log 2>&1'\""""  # noqa: E501
+
+QEMU_TEMPLATE = """\
+- cp /usr/bin/qemu-{qemu_arch}-static $CHROOT_ROOT/usr/bin/
+"""
+
+CHROOT_STORAGE_MOUNT_TEMPLATE = """\
+- {homedir}/chroot-storage.sh mount {mode} {size} {required} {homedir}/build-$BUILD_ID"""  # noqa: E501
+
+CHROOT_STORAGE_RELEASE_TEMPLATE = """\
+- {homedir}/chroot-storage.sh release {homedir}/build-$BUILD_ID"""
+
+APT_PROXY_CONF_PATH = '/etc/apt/apt.conf.d/90ubuntu-standalone-builder-proxy'
+APT_PROXY_CONF_TEMPLATE = 'Acquire::http::Proxy "{url}";\n'
+APT_PROXY_CHROOT_TEMPLATE = """\
+- cp {conf_path} $CHROOT_ROOT/etc/apt/apt.conf.d/"""
+
+# apt-cacher-ng is used when caching on the build instance itself; its
+# configuration is written before it is installed, so is in place when it
+# first starts.
+LOCAL_APT_CACHE_URL = 'http://127.0.0.1:3142'
+LOCAL_APT_CACHE_STAGED_CONF_PATH = '/etc/apt/ubuntu-standalone-builder-proxy'
+LOCAL_APT_CACHE_CONF_PATH = '/etc/apt-cacher-ng/zz-ubuntu-standalone-builder.conf'  # noqa: E501
+LOCAL_APT_CACHE_CONF_TEMPLATE = 'Proxy: {url}\n'
+LOCAL_APT_CACHE_SETUP_TEMPLATE = """\
+- service apt-cacher-ng restart
+- cp {staged_conf_path} {conf_path}"""
+
+CHROOT_STORAGE_MODES = ('disk', 'tmpfs', 'zram', 'auto')
+
+# Multi-threaded compressors for built images, mapped to the package that
+# provides them, the compression levels they accept and their default level.
+ARTIFACT_COMPRESSORS = {
+    'gzip': ('pigz', range(1, 10), 6),
+    'xz': ('xz-utils', range(0, 10), 6),
+    'zstd': ('zstd', range(1, 20), 3),
+}
+# The default size (in MiB) of RAM-backed build trees; enough for a
+# ubuntu-cpc build.
+DEFAULT_CHROOT_STORAGE_SIZE = 10240
+
+PACKAGES = ['bzr', 'squashfs-tools', 'python-setuptools', 'python-twisted',
+            'dpkg-dev']
+# Packages only needed to fetch and install launchpad-buildd from bzr
+BUILDD_BZR_PACKAGES = ['bzr', 'python-setuptools']
+FOREIGN_ARCH_PACKAGES = ['binfmt-support', 'qemu-user-static']
+
+# Architectures that a build instance can't execute natively (assuming it is
+# amd64), mapped to the qemu-user-static emulator for them.
+QEMU_ARCHES = {
+    'arm64': 'aarch64',
+    'armhf': 'arm',
+    'ppc64el': 'ppc64le',
+    's390x': 's390x',
+}
+
+DEFAULT_ARCH = 'amd64'
+DEFAULT_PROJECT = 'ubuntu-cpc'
+
+DEFAULT_SERIES = 'xenial'
+
+# The directory that the base images for each series are published in; their
+# checksums are looked up in the SHA256SUMS file alongside them.
+BASE_IMAGE_URLS = {
+    'xenial': 'http://cloud-images.ubuntu.com/xenial/current/',
+    'bionic': 'http://cloud-images.ubuntu.com/bionic/current/',
+    'focal': 'http://cloud-images.ubuntu.com/focal/current/',
+    'jammy': 'http://cloud-images.ubuntu.com/jammy/current/',
+}
+BASE_IMAGE_FILENAME = '{series}-server-cloudimg-{arch}.squashfs'
+BASE_IMAGE_PATH = '/tmp/root-{arch}.squashfs'
+
+BASE_IMAGE_FETCH_TEMPLATE = """\
+- wget {url} -O {destination}"""
+
+BASE_IMAGE_CACHE_DIR_TEMPLATE = """\
+- mkdir -p {cache_subdir}
+- "[ -f {cache_path} ] && echo '{checksum}  {cache_path}' | sha256sum -c - || {{ wget {url} -O {cache_path}.part && echo '{checksum}  {cache_path}.part' | sha256sum -c - && mv {cache_path}.part {cache_path}; }}"
+- ln -sf {cache_path} {destination}"""  # noqa: E501
+
+BASE_IMAGE_CACHE_MIRROR_TEMPLATE = """\
+- "wget {cache_path} -O {destination} && echo '{checksum}  {destination}' | sha256sum -c - || wget {url} -O {destination}"
+- echo '{checksum}  {destination}' | sha256sum -c -"""  # noqa: E501
+
 WRITE_FILES_STANZA_TEMPLATE = """\
-- encoding: b64
+- encoding: {encoding}
   content: {content}
   path:
-    {homedir}/build-root/chroot-autobuild/usr/share/livecd-rootfs/live-build/ubuntu-cpc/hooks/{sequence}-local-modifications.{hook_type}
+    {path}
   owner: root:root
-  permissions: '0755'
+  permissions: '{permissions}'
+"""
+
+COPY_PAYLOAD_TEMPLATE = '- install -D -m {permissions} {source} {path}'
+
+# The maximum size of user-data, in bytes, accepted by each cloud
+USER_DATA_LIMITS = {
+    'aws': 16384,
+    'azure': 65536,
+    'gce': 262144,
+}
+
+HOOK_PATH_TEMPLATE = '{homedir}/build-{build_id}/chroot-autobuild/usr/share/livecd-rootfs/live-build/{project}/hooks/{sequence}-{name}.{hook_type}'  # noqa: E501
+HOOK_NAME = 'local-modifications'
+# The artifact filter has its own name, so that the binary hook filter can
+# leave it in place, and a zero-padded sequence, so that it sorts (and so
+# runs) before the hooks it filters.
+ARTIFACT_FILTER_HOOK_NAME = 'artifact-filter'
+ARTIFACT_FILTER_HOOK_SEQUENCE = '010'
+
+# The hooks from a customisation directory are run by a hook which carries
+# them (and any assets) as a tar.gz appended to its shell script; the chroot
+# hook carries the archive, and the binary hook reads it from there.  Both
+# sort before the single customisation script hooks.
+CUSTOMISATION_DIR_HOOK_NAME = 'local-customisation'
+# The tar options which leave the hooks written per-config out of chroot
+# snapshots (and out of restores from them)
+SNAPSHOT_HOOK_EXCLUDES = ' '.join(
+    "--exclude='*-{}.*'".format(name) for name in (
+        HOOK_NAME, ARTIFACT_FILTER_HOOK_NAME, CUSTOMISATION_DIR_HOOK_NAME))
+CUSTOMISATION_DIR_HOOK_TEMPLATE = """\
+#!/bin/sh -eux
+CUSTOMISATION_DIR=$(mktemp -d)
+export CUSTOMISATION_DIR
+tail -n +{archive_line} {archive} | tar -xzf - -C $CUSTOMISATION_DIR
+for hook in $(ls $CUSTOMISATION_DIR | grep '\\.{hook_type}$' | LC_ALL=C sort); do
+    $CUSTOMISATION_DIR/$hook
+done
+rm -rf $CUSTOMISATION_DIR
+exit 0
 """  # noqa: E501
+CUSTOMISATION_DIR_HOOK_TYPES = ('chroot', 'binary')
 
 PRIVATE_PPA_TEMPLATE = """
 - chroot $CHROOT_ROOT apt-get install -y apt-transport-https
-- "echo 'deb {ppa_url} xenial main' | tee $CHROOT_ROOT/etc/apt/sources.list.d/builder-extra-ppa.list"
-- "chroot $CHROOT_ROOT apt-key adv --keyserver hkp://keyserver.ubuntu.com:80 --recv-keys {key_id}"
+- "echo 'deb {ppa_url} {series} main' | tee $CHROOT_ROOT/etc/apt/sources.list.d/builder-extra-ppa.list"
+{add_key}
 - chroot $CHROOT_ROOT apt-get -y update
 """  # noqa: E501
+PRIVATE_PPA_RECV_KEY_TEMPLATE = """\
+- "chroot $CHROOT_ROOT apt-key adv --keyserver hkp://keyserver.ubuntu.com:80 --recv-keys {key_id}\""""  # noqa: E501
+PRIVATE_PPA_KEY_FILE_TEMPLATE = """\
+- "chroot $CHROOT_ROOT apt-key add - < {key_path}\""""
+# Where PPA signing keys are fetched from, when prefetched
+PPA_KEY_URL_TEMPLATE = 'https://keyserver.ubuntu.com/pks/lookup?op=get&search=0x{key_id}'  # noqa: E501
 
 BINARY_HOOK_FILTER_CONTENT = """\
 #!/bin/sh -eux
 for hook in /build/config/hooks/*.binary; do
     case $(basename $hook) in
-        {}|9997*|9998*|9999*)
+        {}|9997*|9998*|9999*|*-artifact-filter.binary)
             ;;
         *)
             cat << EOF > $hook
@@ -75,6 +468,49 @@ EOF
 done
 """
 
+# The binary hooks (in the ubuntu-cpc livecd-rootfs project) that produce
+# each artifact; hooks needed by several artifacts (e.g. the disk image that
+# the VM images are converted from) are listed against each of them.
+ARTIFACT_HOOKS = {
+    'lxd': ('*-lxd-tarball.binary',),
+    'qcow2': ('*-disk-image.binary', '*-qcow2-image.binary'),
+    'squashfs': ('*-root-squashfs.binary',),
+    'tar.gz': ('*-root-tarball.binary',),
+    'tar.xz': ('*-root-xz.binary',),
+    'vagrant': ('*-disk-image.binary', '*-vagrant.binary'),
+    'vmdk': ('*-disk-image.binary', '*-vmdk-image.binary',
+             '*-vmdk-ova-image.binary'),
+}
+
+# The binary hooks of livecd-rootfs' ubuntu-cpc project, which
+# --binary-hook-filter globs are checked against
+UBUNTU_CPC_BINARY_HOOKS = (
+    '030-root-tarball.binary',
+    '031-root-xz.binary',
+    '032-root-squashfs.binary',
+    '033-disk-image.binary',
+    '040-qcow2-image.binary',
+    '041-vmdk-image.binary',
+    '042-vmdk-ova-image.binary',
+    '043-lxd-tarball.binary',
+    '044-vagrant.binary',
+)
+
+ARTIFACT_FILTER_CONTENT = """\
+#!/bin/sh -eux
+for hook in /build/config/hooks/*.binary; do
+    case $(basename $hook) in
+        {skipped})
+            cat << EOF > $hook
+#!/bin/sh
+echo "Skipped \\$0 (artifact not requested)"
+exit 0
+EOF
+            ;;
+    esac
+done
+"""
+
 SETUP_CONTENT = """\
 #!/bin/sh -eux
 mv /usr/sbin/grub-probe /usr/sbin/grub-probe.dist
@@ -119,13 +555,477 @@ PSEUDO_GRUB_PROBE
 chmod +x /usr/sbin/grub-probe
 """  # noqa: E501
 
+# As SETUP_CONTENT, but with a stand-in grub-probe that parses its options
+# (exactly as getopt would) without forking; package installs run it often.
+FAST_SETUP_CONTENT = """\
+#!/bin/sh -eux
+mv /usr/sbin/grub-probe /usr/sbin/grub-probe.dist
+cat <<"PSEUDO_GRUB_PROBE" > /usr/sbin/grub-probe
+#!/bin/sh
+bad_Usage() { echo "$@"; exit 1; }
+
+target=""
+device=0
+arg=""
+have_arg=0
+
+while [ $# -ne 0 ]; do
+   case "$1" in
+      --device) device=1;;
+      --device-=*|--device-m=*|--device-ma=*|--device-map=*) ;;
+      --device-|--device-m|--device-ma|--device-map)
+         [ $# -ge 2 ] || bad_Usage; shift;;
+      --t=*|--ta=*|--tar=*|--targ=*|--targe=*|--target=*) target=${1#*=};;
+      --t|--ta|--tar|--targ|--targe|--target)
+         [ $# -ge 2 ] || bad_Usage; target=${2}; shift;;
+      --) shift; break;;
+      -?*) bad_Usage;;
+      *) [ $have_arg = 1 ] || { arg=${1}; have_arg=1; };;
+   esac
+   shift;
+done
+[ $have_arg = 1 ] || arg=${1}
+
+case "${target}:${device}:${arg}" in
+   device:*:/*) echo "/dev/sda1"; exit 0;;
+   fs:*:*) echo "ext2"; exit 0;;
+   partmap:*:*) echo "msdos"; exit 0;;
+   abstraction:*:*) echo ""; exit 0;;
+   drive:*:/dev/sda) echo "(hd0)";;
+   drive:*:/dev/sda*) echo "(hd0,1)";;
+   fs_uuid:*:*) exit 1;;
+esac
+PSEUDO_GRUB_PROBE
+chmod +x /usr/sbin/grub-probe
+"""
+
+PHASE_TIMER_CONTENT = """\
+#!/bin/sh -eu
+# Usage: phase-timer.sh LOG start|end PHASE
+#        phase-timer.sh json OUTPUT LOG...
+# Phases are timed using the (monotonic) system uptime.
+if [ "$1" = json ]; then
+    output=$2
+    shift 2
+    cat "$@" | awk -v build_id="${BUILD_ID:-}" '
+        $2 == "start" { start[$1] = $3; phases[n++] = $1 }
+        $2 == "end" { end[$1] = $3 }
+        END {
+            printf "{\\"build_id\\": \\"%s\\", \\"phases\\": [", build_id
+            for (i = 0; i < n; i++) {
+                phase = phases[i]
+                printf "%s{\\"name\\": \\"%s\\", \\"start\\": %s, ", (i ? ", " : ""), phase, start[phase]
+                if (phase in end) {
+                    printf "\\"end\\": %s, \\"duration\\": %.2f}", end[phase], end[phase] - start[phase]
+                } else {
+                    printf "\\"end\\": null, \\"duration\\": null}"
+                }
+            }
+            print "]}"
+        }' > "$output"
+    exit 0
+fi
+echo "$3 $2 $(cut -d ' ' -f 1 /proc/uptime)" >> "$1"
+"""  # noqa: E501
+
+CHROOT_STORAGE_CONTENT = """\
+#!/bin/sh -eu
+# Usage: chroot-storage.sh mount MODE SIZE_MB REQUIRED_MB DIR
+#        chroot-storage.sh release DIR
+# In "auto" mode, REQUIRED_MB is the memory that must be available (e.g. for
+# all concurrent builds) to use tmpfs, or twice what must be available to use
+# zram (assuming 2:1 compression); otherwise DIR is left on disk.
+RESERVE_MB=1024
+MEMINFO=${MEMINFO:-/proc/meminfo}
+
+mount_zram() {
+    modprobe zram || return 1
+    dev=$(zramctl --find --size "${1}M") || return 1
+    mkfs.ext4 -q "$dev"
+    mount "$dev" "$2"
+}
+
+if [ "$1" = release ]; then
+    if mountpoint -q "$2"; then
+        dev=$(findmnt -n -o SOURCE "$2")
+        umount "$2"
+        case "$dev" in
+            /dev/zram*) zramctl --reset "$dev";;
+        esac
+    fi
+    exit 0
+fi
+
+requested=$2; mode=$2; size=$3; required=$4; dir=$5
+if [ "$mode" = auto ]; then
+    available=$(awk '/^MemAvailable:/ { print int($2 / 1024) }' "$MEMINFO")
+    if [ $((available - RESERVE_MB)) -ge "$required" ]; then
+        mode=tmpfs
+    elif [ $((available - RESERVE_MB)) -ge $((required / 2)) ]; then
+        mode=zram
+    else
+        mode=disk
+    fi
+    echo "Using $mode for $dir ($available MiB of memory available)"
+fi
+[ "$mode" = disk ] && exit 0
+
+# Preserve anything (e.g. hooks) already written in to the build tree
+if [ -d "$dir" ]; then
+    mv "$dir" "$dir.disk"
+fi
+mkdir -p "$dir"
+case "$mode" in
+    tmpfs) mount -t tmpfs -o "size=${size}M" tmpfs "$dir";;
+    zram) mount_zram "$size" "$dir" || {
+        [ "$requested" = auto ] || exit 1
+        echo "zram unavailable; using disk for $dir"
+    };;
+esac
+if [ -d "$dir.disk" ]; then
+    cp -a "$dir.disk/." "$dir/"
+    rm -rf "$dir.disk"
+fi
+"""
+
+PROGRESS_CONTENT = """\
+#!/bin/sh -eu
+# Usage: progress.sh EVENT [KEY VALUE]...
+#        COMMAND 2>&1 | progress.sh stages
+# Appends an event, as a line of JSON, to $PROGRESS_LOG.  In "stages" mode,
+# passes its input through, recording the live-build stages it reports.
+event() {
+    line="{\\"time\\": $(date +%s.%N), \\"event\\": \\"$1\\""
+    shift
+    if [ -n "${BUILD_ID:-}" ]; then
+        line="$line, \\"build_id\\": \\"$BUILD_ID\\""
+    fi
+    while [ $# -ge 2 ]; do
+        case $2 in
+            ''|*[!0-9]*)
+                value="\\"$(printf '%s' "$2" | tr -d '"\\\\[:cntrl:]')\\"" ;;
+            *)
+                value=$2 ;;
+        esac
+        line="$line, \\"$1\\": $value"
+        shift 2
+    done
+    echo "$line}" >> "$PROGRESS_LOG"
+}
+if [ "$1" = stages ]; then
+    while IFS= read -r line; do
+        printf '%s\\n' "$line"
+        case $line in
+            "P: "*)
+                event stage stage "${line#P: }" || true ;;
+        esac
+    done
+    exit 0
+fi
+event "$@"
+"""
+
+POST_PROCESS_CONTENT = """\
+#!/bin/sh -eu
+# Usage: post-process.sh artifacts IMAGES COMPRESSOR|none LEVEL
+#        post-process.sh manifest IMAGES
+# "artifacts" checksums each image in IMAGES, first compressing it (in
+# place of the original) unless COMPRESSOR is none or it is compressed
+# already; each image is only read once.  "manifest" then writes out
+# IMAGES/manifest.json, with the build's timings if there are any.
+images=$2
+entries=$images/.manifest-entries
+
+entry() {
+    printf '{"name": "%s", "size": %s, "sha256": "%s"' \\
+        "${1##*/}" "$(stat -c %s "$1")" "$2"
+}
+
+compress() {
+    case $1 in
+        gzip) pigz -p "$(nproc)" "-$2" -c ;;
+        xz) xz -T0 "-$2" -c ;;
+        zstd) zstd -T0 "-$2" -c -q ;;
+    esac
+}
+
+if [ "$1" = manifest ]; then
+    timings=null
+    if [ -f "$images/timings.json" ]; then
+        timings=$(cat "$images/timings.json")
+    fi
+    {
+        printf '{"build_id": "%s", "artifacts": [' "${BUILD_ID:-}"
+        if [ -f "$entries" ]; then
+            sed '1!s/^/, /' "$entries" | tr -d '\\n'
+        fi
+        printf '], "timings": %s}\\n' "$timings"
+    } > "$images/manifest.json"
+    rm -f "$entries"
+    exit 0
+fi
+
+compressor=$3
+level=$4
+case $compressor in
+    gzip) extension=.gz ;;
+    xz) extension=.xz ;;
+    zstd) extension=.zst ;;
+esac
+work=$(mktemp -d)
+mkfifo "$work/in" "$work/out"
+: > "$entries"
+for artifact in "$images"/livecd.*; do
+    [ -f "$artifact" ] || continue
+    start=$(cut -d ' ' -f 1 /proc/uptime)
+    case $compressor:$artifact in
+        none:*|*.gz|*.xz|*.zst|*.bz2|*.squashfs|*.qcow2|*.vmdk|*.box)
+            line=$(entry "$artifact" "$(sha256sum < "$artifact" | cut -d ' ' -f 1)")
+            ;;
+        *)
+            # Checksum the image and its compressed form as it is compressed
+            sha256sum < "$work/in" | cut -d ' ' -f 1 > "$work/in.sum" &
+            sha256sum < "$work/out" | cut -d ' ' -f 1 > "$work/out.sum" &
+            { tee "$work/in" < "$artifact" | compress "$compressor" "$level"; echo $? > "$work/status"; } \\
+                | tee "$work/out" > "$artifact$extension"
+            wait
+            if [ "$(cat "$work/status")" != 0 ]; then
+                echo "Compressing $artifact failed" >&2
+                rm -f "$artifact$extension"
+                exit 1
+            fi
+            line="$(entry "$artifact$extension" "$(cat "$work/out.sum")"), \\"uncompressed\\": $(entry "$artifact" "$(cat "$work/in.sum")")}"
+            rm "$artifact"
+            ;;
+    esac
+    end=$(cut -d ' ' -f 1 /proc/uptime)
+    echo "$line, \\"duration\\": $(awk "BEGIN { printf \\"%.2f\\", $end - $start }")}" >> "$entries"
+done
+rm -rf "$work"
+"""  # noqa: E501
+
+PUBLISH_CONTENT = """\
+#!/bin/sh -eu
+# Usage: publish.sh URL DIR CHUNK_MB JOBS
+# Uploads each file under DIR to URL/PATH with HTTP PUTs, JOBS at a time,
+# retrying each upload up to $PUBLISH_RETRIES times.  Files larger than
+# CHUNK_MB (unless it is 0) are uploaded in chunks, to PATH.part-00000 and
+# so on.  Once every upload has succeeded, URL/published.json (listing the
+# files, their sizes and how many chunks each was split in to) is uploaded
+# to signal that publishing is complete.
+RETRIES=${PUBLISH_RETRIES:-5}
+RETRY_DELAY=${PUBLISH_RETRY_DELAY:-2}
+
+put() {
+    attempt=1
+    until curl -fsS -H Expect: -o /dev/null -T "$1" "$2"; do
+        if [ "$attempt" -ge "$RETRIES" ]; then
+            echo "Uploading to $2 failed after $attempt attempts" >&2
+            return 1
+        fi
+        sleep $((attempt * RETRY_DELAY))
+        attempt=$((attempt + 1))
+    done
+}
+
+if [ "$1" = put ]; then
+    # Internal: put URL DIR CHUNK_MB PATH INDEX|-
+    url=$2 dir=$3 chunk_mb=$4 path=$5 index=$6
+    if [ "$index" = - ]; then
+        put "$dir/$path" "$url/$path"
+        exit
+    fi
+    part=$(mktemp)
+    trap 'rm -f "$part"' EXIT
+    dd if="$dir/$path" of="$part" bs=1M count="$chunk_mb" \\
+        skip=$((index * chunk_mb)) 2>/dev/null
+    put "$part" "$url/$path.part-$(printf %05d "$index")"
+    exit
+fi
+
+url=${1%/}
+dir=$2
+chunk_bytes=$(($3 * 1048576))
+work=$(mktemp -d)
+trap 'rm -rf "$work"' EXIT
+: > "$work/tasks"
+: > "$work/files"
+(cd "$dir" && find . -type f | sed 's|^\\./||' | sort) | while IFS= read -r path; do
+    size=$(stat -c %s "$dir/$path")
+    chunks=0
+    if [ "$chunk_bytes" -gt 0 ] && [ "$size" -gt "$chunk_bytes" ]; then
+        chunks=$(((size + chunk_bytes - 1) / chunk_bytes))
+        seq 0 $((chunks - 1)) | sed "s|^|$path |" >> "$work/tasks"
+    else
+        echo "$path -" >> "$work/tasks"
+    fi
+    printf '{"name": "%s", "size": %s, "chunks": %s}\\n' \\
+        "$path" "$size" "$chunks" >> "$work/files"
+done
+xargs -P "$4" -L 1 sh "$0" put "$url" "$dir" "$3" < "$work/tasks"
+{
+    printf '{"files": ['
+    sed '1!s/^/, /' "$work/files" | tr -d '\\n'
+    printf ']}\\n'
+} > "$work/published.json"
+put "$work/published.json" "$url/published.json"
+"""  # noqa: E501
+
+PREFETCH_CONTENT = """\
+#!/bin/sh
+# Fetches every network input listed in a prefetch manifest, at once.
+#
+# Each line of the manifest is "DESTINATION KIND SHA256 SOURCE...", with a
+# SHA256 of "-" if the checksum isn't known.  KIND is "url" (downloaded
+# from the first SOURCE that works), "newer" (downloaded in to
+# DESTINATION's directory, unless the copy there is up to date) or "bzr"
+# (branched).  A download whose checksum doesn't match counts as failed,
+# and a matching DESTINATION isn't downloaded again.  Each input is tried
+# PREFETCH_ATTEMPTS times; the exit status is non-zero if any could not be
+# fetched.
+set -u
+
+if [ "$1" != fetch ]; then
+    exec xargs -r -L 1 -P 0 sh "$0" fetch < "$1"
+fi
+destination=$2 kind=$3 sha256=$4
+shift 4
+
+verify() {
+    [ "$sha256" = - ] || echo "$sha256  $1" | sha256sum -c --quiet -
+}
+
+if [ "$sha256" != - ] && [ -f "$destination" ] && verify "$destination" 2>/dev/null; then
+    exit 0
+fi
+mkdir -p "$(dirname "$destination")"
+attempt=1
+while true; do
+    for source in "$@"; do
+        rm -rf "$destination.part"
+        case $kind in
+            newer)
+                wget -N -nv -P "$(dirname "$destination")" "$source" && exit 0
+                continue;;
+            bzr)
+                bzr branch -q "$source" "$destination.part";;
+            *)
+                wget -nv "$source" -O "$destination.part";;
+        esac && verify "$destination.part" && {
+            rm -rf "$destination"
+            mv "$destination.part" "$destination"
+            exit 0
+        }
+    done
+    if [ "$attempt" -ge "${PREFETCH_ATTEMPTS:-3}" ]; then
+        rm -rf "$destination.part"
+        echo "Could not fetch $destination" >&2
+        exit 1
+    fi
+    attempt=$((attempt + 1))
+    sleep "${PREFETCH_RETRY_DELAY:-5}"
+done
+"""  # noqa: E501
+
+MKSQUASHFS_CONTENT = """\
+#!/bin/sh -eu
+# mksquashfs, with the compressor and block size it is called with (and any
+# options for its compressor) replaced by those configured, if they are.
+MKSQUASHFS=${{MKSQUASHFS:-/usr/bin/mksquashfs.distrib}}
+COMPRESSOR={compressor}
+BLOCK_SIZE={block_size}
+n=$#
+while [ "$n" -gt 0 ]; do
+    arg=$1
+    shift
+    n=$((n - 1))
+    replaced=
+    case $arg in
+        -comp) [ -z "$COMPRESSOR" ] || replaced=value ;;
+        -b) [ -z "$BLOCK_SIZE" ] || replaced=value ;;
+        -X*) [ -z "$COMPRESSOR" ] || replaced=option ;;
+    esac
+    if [ -z "$replaced" ]; then
+        set -- "$@" "$arg"
+        continue
+    fi
+    # Drop the option's value too (some compressor options don't have one)
+    if [ "$n" -gt 0 ] && {{ [ "$replaced" = value ] || [ "${{1#-}}" = "$1" ]; }}; then
+        shift
+        n=$((n - 1))
+    fi
+done
+if [ -n "$COMPRESSOR" ]; then
+    set -- "$@" -comp "$COMPRESSOR"
+fi
+if [ -n "$BLOCK_SIZE" ]; then
+    set -- "$@" -b "$BLOCK_SIZE"
+fi
+exec "$MKSQUASHFS" "$@"
+"""  # noqa: E501
+
 TEARDOWN_CONTENT = """\
 #!/bin/sh -eux
 mv /usr/sbin/grub-probe.dist /usr/sbin/grub-probe
 """
 
+WORKER_CONTENT = """\
+#!/bin/sh -u
+# Runs the build jobs put in $HOMEDIR/jobs/queue (as NAME.sh, by
+# "generate_build_config --worker-job NAME"), one at a time, oldest first.
+# Each job is moved to $HOMEDIR/jobs/NAME/job.sh and run there, logging to
+# job.log, and its exit status is then written to exit-status.  With
+# WORKER_ONCE set, this exits once the queue is empty.
+HOMEDIR=$1
+QUEUE=$HOMEDIR/jobs/queue
+mkdir -p "$QUEUE"
+while true; do
+    job=$(ls -tr "$QUEUE" | grep '\\.sh$' | head -n 1)
+    if [ -z "$job" ]; then
+        [ -n "${WORKER_ONCE:-}" ] && exit 0
+        sleep "${WORKER_POLL_INTERVAL:-5}"
+        continue
+    fi
+    name=${job%.sh}
+    dir=$HOMEDIR/jobs/$name
+    if [ -e "$dir" ]; then
+        echo "A job named $name has already been run; skipping it" >&2
+        mv "$QUEUE/$job" "$QUEUE/$name.duplicate"
+        continue
+    fi
+    mkdir -p "$dir"
+    mv "$QUEUE/$job" "$dir/job.sh"
+    status=0
+    (cd "$dir" && sh "$dir/job.sh") > "$dir/job.log" 2>&1 || status=$?
+    echo "$status" > "$dir/exit-status"
+done
+"""
+
+WORKER_UNIT_CONTENT = """\
+[Unit]
+Description=ubuntu-standalone-builder worker
+Wants=network-online.target
+After=network-online.target
+
+[Service]
+ExecStart=/bin/sh {homedir}/worker.sh {homedir}
+Restart=on-failure
+
+[Install]
+WantedBy=multi-user.target
+"""
+
+# How grub-probe is stood in for while chroot hooks run: with SETUP_CONTENT,
+# with FAST_SETUP_CONTENT, not at all, or (with "auto") not at all unless the
+# hooks look like they might run it (i.e. match GRUB_PROBE_PATTERN), in which
+# case with FAST_SETUP_CONTENT.
+GRUB_PROBE_SHIMS = ('full', 'fast', 'none', 'auto')
+GRUB_PROBE_PATTERN = re.compile(
+    br'apt|dpkg|grub|initramfs|initrd|kernel|linux-|vmlinuz')
+
 
-def _get_ppa_snippet(ppa, ppa_key=None):
+def _get_ppa_snippet(ppa, ppa_key=None, series=DEFAULT_SERIES,
+                     key_path=None):
     """
     Depending on what string is passed as PPA, return an appropriate yaml
     snippet, ready to inject in TEMPLATE.
@@ -136,6 +1036,12 @@ def _get_ppa_snippet(ppa, ppa_key=None):
     :param ppa_key:
         The hexacecimal key ID used to sign the PPA's package. This is only
         used for private PPAs.
+    :param series:
+        The series being built, which private PPAs are added for.
+    :param key_path:
+        The (optional) path on the build instance of a (prefetched) copy of
+        the signing key of a private PPA, to use instead of fetching it from
+        the keyserver.
     """
     conf = ""
     if ppa.startswith("https://") and 'private-ppa' in ppa:
@@ -147,7 +1053,12 @@ def _get_ppa_snippet(ppa, ppa_key=None):
         if ppa_key is None:
             raise ValueError("You must provide a --ppa-key parameter if using "
                              "a private PPA URL.")
-        conf = PRIVATE_PPA_TEMPLATE.format(ppa_url=ppa, key_id=ppa_key)
+        if key_path is None:
+            add_key = PRIVATE_PPA_RECV_KEY_TEMPLATE.format(key_id=ppa_key)
+        else:
+            add_key = PRIVATE_PPA_KEY_FILE_TEMPLATE.format(key_path=key_path)
+        conf = PRIVATE_PPA_TEMPLATE.format(add_key=add_key, ppa_url=ppa,
+                                           series=series)
     elif ppa.startswith("ppa"):
         # The simple case, we simply need to inject an "add-apt-repository"
         # command.
@@ -158,22 +1069,850 @@ def _get_ppa_snippet(ppa, ppa_key=None):
     return conf
 
 
-def _produce_write_files_stanza(content, hook_type, sequence, homedir):
-    b64_content = base64.b64encode(content.encode('utf-8')).decode('utf-8')
+def _get_ppa_key_id(ppa_key):
+    """
+    Return a PPA signing key's ID (or fingerprint) as the keyserver and
+    offline bundles name it: in upper case, without a leading "0x".
+    """
+    return re.sub('^0[xX]', '', ppa_key).upper()
+
+
+def _parse_sha256sums(content):
+    """
+    Parse the contents of a SHA256SUMS file in to a dict mapping filenames to
+    their checksums.
+
+    :param content:
+        The text of a SHA256SUMS file, as produced by sha256sum(1).
+    """
+    checksums = {}
+    for line in content.splitlines():
+        parts = line.split(None, 1)
+        if len(parts) != 2:
+            continue
+        checksum, filename = parts
+        # sha256sum marks files read in binary mode with a leading '*'
+        checksums[filename.lstrip('*')] = checksum.lower()
+    return checksums
+
+
+def _get_base_image_checksum(filename,
+                             base_url=BASE_IMAGE_URLS[DEFAULT_SERIES]):
+    """
+    Look up the published SHA256 checksum of a base image.
+
+    :param filename:
+        The filename of the base image within base_url.
+    :param base_url:
+        The URL of the directory containing the base image and its
+        SHA256SUMS file.
+    """
+    response = urlopen(base_url + 'SHA256SUMS')
+    try:
+        content = response.read().decode('utf-8')
+    finally:
+        response.close()
+    checksums = _parse_sha256sums(content)
+    if filename not in checksums:
+        raise ValueError('{} is not listed in {}SHA256SUMS.'.format(
+            filename, base_url))
+    return checksums[filename]
+
+
+def _get_base_image_cache_path(cache, series, checksum):
+    """
+    Return the location of a base image within a base image cache.
+
+    Cached images are grouped by series, addressed by their checksum, and
+    sharded by its first two characters, so that stale images never shadow
+    newer ones.
+
+    :param cache:
+        The path to a cache directory on the build instance, or the URL of an
+        HTTP mirror laid out in the same way.
+    :param series:
+        The series of the base image.
+    :param checksum:
+        The SHA256 checksum of the base image.
+    """
+    return '{}/{}/{}/{}.squashfs'.format(cache.rstrip('/'), series,
+                                         checksum[:2], checksum)
+
+
+def _get_base_image_snippet(arch, base_image_cache=None,
+                            series=DEFAULT_SERIES):
+    """
+    Return a yaml snippet that fetches the base image for an architecture to
+    BASE_IMAGE_PATH, ready to inject in TEMPLATE.
+
+    :param arch:
+        The architecture of the base image.
+    :param base_image_cache:
+        An (optional) path to a persistent cache directory on the build
+        instance, or the URL of a (read-only) HTTP mirror of one.  If given,
+        the expected checksum of the base image is looked up when the
+        config is generated, and a verified cached copy is used in preference
+        to downloading the image.
+    :param series:
+        The series of the base image; one of the keys of BASE_IMAGE_URLS.
+    """
+    filename = BASE_IMAGE_FILENAME.format(arch=arch, series=series)
+    base_url = BASE_IMAGE_URLS[series]
+    url = base_url + filename
+    destination = BASE_IMAGE_PATH.format(arch=arch)
+    if base_image_cache is None:
+        return BASE_IMAGE_FETCH_TEMPLATE.format(url=url,
+                                                destination=destination)
+    checksum = _get_base_image_checksum(filename, base_url)
+    cache_path = _get_base_image_cache_path(base_image_cache, series,
+                                            checksum)
+    if base_image_cache.startswith(('http://', 'https://')):
+        template = BASE_IMAGE_CACHE_MIRROR_TEMPLATE
+    else:
+        template = BASE_IMAGE_CACHE_DIR_TEMPLATE
+    return template.format(url=url, checksum=checksum, cache_path=cache_path,
+                           cache_subdir=cache_path.rsplit('/', 1)[0],
+                           destination=destination)
+
+
+def _get_base_image_prefetch(arch, base_image_cache=None,
+                             series=DEFAULT_SERIES):
+    """
+    Return the prefetch manifest entry which fetches the base image for an
+    architecture, and a yaml snippet which then puts it at BASE_IMAGE_PATH
+    (as _get_base_image_snippet would).
+
+    Manifest entries are (destination, kind, SHA256 or None, sources)
+    tuples; see PREFETCH_CONTENT.
+    """
+    filename = BASE_IMAGE_FILENAME.format(arch=arch, series=series)
+    base_url = BASE_IMAGE_URLS[series]
+    url = base_url + filename
+    destination = BASE_IMAGE_PATH.format(arch=arch)
+    if base_image_cache is None:
+        return (destination, 'url', None, [url]), ''
+    checksum = _get_base_image_checksum(filename, base_url)
+    cache_path = _get_base_image_cache_path(base_image_cache, series,
+                                            checksum)
+    if base_image_cache.startswith(('http://', 'https://')):
+        return (destination, 'url', checksum, [cache_path, url]), ''
+    return ((cache_path, 'url', checksum, [url]),
+            '- ln -sf {} {}'.format(cache_path, destination))
+
+
+def _format_prefetch_manifest(entries):
+    """
+    Format prefetch manifest entries as the lines PREFETCH_CONTENT reads.
+    """
+    return ''.join(
+        '{} {} {} {}\n'.format(destination, kind, sha256 or '-',
+                               ' '.join(sources))
+        for destination, kind, sha256, sources in entries)
+
+
+def _get_builds(architectures=None, projects=None):
+    """
+    Return a list of (build ID, architecture, project) tuples, one for each
+    combination of architecture and project to be built.
+
+    A single build keeps the "root" build ID that launchpad-buildd uses by
+    default.
+
+    :param architectures:
+        An (optional) list of architectures to build; defaults to
+        DEFAULT_ARCH.
+    :param projects:
+        An (optional) list of livecd-rootfs projects to build; defaults to
+        DEFAULT_PROJECT.
+    """
+    if not architectures:
+        architectures = [DEFAULT_ARCH]
+    elif not isinstance(architectures, (list, tuple)):
+        architectures = [architectures]
+    if not projects:
+        projects = [DEFAULT_PROJECT]
+    elif not isinstance(projects, (list, tuple)):
+        projects = [projects]
+    unknown = [arch for arch in architectures
+               if arch not in QEMU_ARCHES and arch not in ('amd64', 'i386')]
+    if unknown:
+        raise ValueError('Unsupported architecture(s): {}'.format(
+            ', '.join(unknown)))
+    combinations = [(arch, project)
+                    for project in projects for arch in architectures]
+    if len(combinations) == 1:
+        return [('root',) + combinations[0]]
+    return [('{}-{}'.format(project, arch), arch, project)
+            for arch, project in combinations]
+
+
+def _get_launchpad_buildd_tarball(path):
+    """
+    Read a pre-packaged launchpad-buildd tarball, checking that it looks like
+    a launchpad-buildd tree.
+
+    Returns a (content, SHA256 checksum) tuple.
+
+    :param path:
+        The path to a tarball of a launchpad-buildd tree, with a single
+        top-level directory (as produced by "bzr export").
+    """
+    try:
+        with tarfile.open(path) as tarball:
+            names = tarball.getnames()
+    except tarfile.TarError as e:
+        raise ValueError('{} is not a launchpad-buildd tarball: {}'.format(
+            path, e))
+    if not any(name.split('/', 1)[-1] == 'bin/buildlivefs'
+               for name in names):
+        raise ValueError('{} does not contain bin/buildlivefs in its '
+                         'top-level directory.'.format(path))
+    with open(path, 'rb') as f:
+        content = f.read()
+    return content, hashlib.sha256(content).hexdigest()
+
+
+def _instrument_template(template, log, marker=PHASE_TIMER_TEMPLATE):
+    """
+    Return template with each of the PHASES it contains wrapped in calls to
+    phase-timer.sh.
+
+    :param template:
+        An (unformatted) template, e.g. TEMPLATE or BUILD_TEMPLATE.
+    :param log:
+        The path of the timings log to record phases in, on the build
+        instance; this may contain template fields.
+    :param marker:
+        The template for the runcmd entries marking the start and end of
+        each phase, formatted with the event ("start" or "end"), log and
+        phase; e.g. PROGRESS_PHASE_TEMPLATE to report phases as progress
+        events instead.
+    """
+    def timer(event, phase):
+        return marker.format(event=event, log=log, phase=phase)
+
+    def end_phase(lines, phase):
+        # Keep any blank lines separating this phase from the next
+        index = len(lines)
+        while index and not lines[index - 1].strip():
+            index -= 1
+        lines.insert(index, timer('end', phase))
+
+    lines = []
+    phase = None
+    for line in template.splitlines():
+        if line in PHASES:
+            if phase is not None:
+                end_phase(lines, phase)
+            lines.append(line)
+            phase = PHASES[line]
+            if phase is not None:
+                lines.append(timer('start', phase))
+        else:
+            lines.append(line)
+    if phase is not None:
+        end_phase(lines, phase)
+    return '\n'.join(lines) + ('\n' if template.endswith('\n') else '')
+
+
+def _add_build_progress(build_template):
+    """
+    Return build_template with buildlivefs' output passed through
+    progress.sh (to report the live-build stages it goes through), and the
+    result of the build reported at its end.
+    """
+    lines = []
+    for line in build_template.splitlines():
+        if '/launchpad-buildd/bin/buildlivefs ' in line:
+            command = line[len('- "'):-len('"')]
+            line = PROGRESS_BUILDLIVEFS_TEMPLATE.format(command=command)
+        lines.append(line)
+    return '\n'.join(lines) + PROGRESS_BUILD_END_TEMPLATE
+
+
+def _get_chroot_snapshot_key(series, arch, update_chroot):
+    """
+    Return the key that identifies snapshots of updated build chroots which
+    can be shared between builds.
+
+    :param series:
+        The series of the build chroot.
+    :param arch:
+        The architecture of the build chroot.
+    :param update_chroot:
+        The (rendered) yaml snippet that updates the build chroot; builds
+        only share snapshots if they update their chroots identically.
+    """
+    digest = hashlib.sha256(update_chroot.encode('utf-8')).hexdigest()
+    return '{}-{}-{}'.format(series, arch, digest[:12])
+
+
+def _guard_snippet(snippet, condition):
+    """
+    Return a yaml snippet of runcmd entries with each command only run if a
+    shell condition is false.
+    """
+    return '\n'.join(
+        '- ' + json.dumps('{} || {{ {}; }}'.format(condition, command))
+        for command in yaml.safe_load(snippet) or [])
+
+
+def _get_artifact_filter(artifacts):
+    """
+    Produce a binary hook which skips hooks producing unrequested artifacts.
+
+    :param artifacts:
+        An iterable of artifact names (keys of ARTIFACT_HOOKS) to produce.
+    :return:
+        The content of the hook, or None if all artifacts are requested (so
+        that no hooks need skipping).
+    """
+    wanted = set(itertools.chain.from_iterable(
+        ARTIFACT_HOOKS[artifact] for artifact in artifacts))
+    skipped = set(itertools.chain.from_iterable(
+        ARTIFACT_HOOKS.values())) - wanted
+    if not skipped:
+        return None
+    return ARTIFACT_FILTER_CONTENT.format(skipped='|'.join(sorted(skipped)))
+
+
+def _parse_artifacts(value):
+    """
+    Parse a comma-separated list of artifact names for argparse.
+    """
+    artifacts = [artifact.strip() for artifact in value.split(',')
+                 if artifact.strip()]
+    unknown = sorted(set(artifacts) - set(ARTIFACT_HOOKS))
+    if unknown or not artifacts:
+        raise argparse.ArgumentTypeError(
+            'unknown artifact(s) {!r}; choose from {}'.format(
+                ', '.join(unknown), ', '.join(sorted(ARTIFACT_HOOKS))))
+    return artifacts
+
+
+# Compiled templates, least recently used first.  Templates can have
+# per-config values (e.g. a publish URL) formatted in to them, so only the
+# most recently used are kept.
+_COMPILED_TEMPLATES = collections.OrderedDict()
+COMPILED_TEMPLATES_LIMIT = 64
+
+
+def _compile_template(template):
+    """
+    Split a str.format template in to (literal text, field name) pairs, once
+    per template (while it stays among the COMPILED_TEMPLATES_LIMIT most
+    recently used).
+    """
+    try:
+        parts = _COMPILED_TEMPLATES.pop(template)
+    except KeyError:
+        parts = []
+        for literal, field, spec, conversion in string.Formatter().parse(
+                template):
+            if spec or conversion or field == '':
+                raise ValueError('Only named fields can be compiled.')
+            parts.append((literal, field))
+    _COMPILED_TEMPLATES[template] = parts
+    while len(_COMPILED_TEMPLATES) > COMPILED_TEMPLATES_LIMIT:
+        _COMPILED_TEMPLATES.popitem(last=False)
+    return parts
+
+
+def _render_template(template, **kwargs):
+    """
+    Render a template, as template.format(**kwargs) would, from its
+    pre-split parts.
+    """
+    return ''.join(
+        literal if field is None else literal + format(kwargs[field])
+        for literal, field in _compile_template(template))
+
+
+def _write_pieces(output_file, pieces):
+    # Files opened in binary mode (and bytes buffers) are given UTF-8
+    binary = (isinstance(output_file, (io.BufferedIOBase, io.RawIOBase))
+              or 'b' in getattr(output_file, 'mode', ''))
+    for piece in pieces:
+        output_file.write(piece.encode('utf-8') if binary else piece)
+
+
+def _cached(cache, key, func, *args, **kwargs):
+    """
+    Return func(*args, **kwargs), memoised in cache under key.
+
+    :param cache:
+        A dict shared between renders, or None to disable caching.
+    """
+    if cache is None:
+        return func(*args, **kwargs)
+    try:
+        return cache[key]
+    except KeyError:
+        value = cache[key] = func(*args, **kwargs)
+        return value
+
+
+def _get_customisation_dir_archive(path):
+    """
+    Pack a customisation directory in to a reproducible tar.gz.
+
+    Files are streamed in to the archive (so the tree is never held in
+    memory), in sorted order and with normalised ownership, permissions and
+    timestamps, so that an unchanged directory always produces an identical
+    archive.
+
+    :param path:
+        The path to a directory containing hooks (files at its top level
+        ending in .chroot or .binary, run in sorted order) and any assets
+        they need.
+    """
+    if not os.path.isdir(path):
+        raise ValueError('{} is not a directory.'.format(path))
+    hooks = [name for name in os.listdir(path)
+             if os.path.isfile(os.path.join(path, name))
+             and name.rsplit('.', 1)[-1] in CUSTOMISATION_DIR_HOOK_TYPES]
+    if not hooks:
+        raise ValueError('{} does not contain any .chroot or .binary '
+                         'hooks.'.format(path))
+    buf = io.BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', fileobj=buf,
+                       mtime=0) as gzip_file:
+        with tarfile.open(fileobj=gzip_file, mode='w',
+                          format=tarfile.GNU_FORMAT) as tar:
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for name in sorted(dirnames + filenames):
+                    full_path = os.path.join(dirpath, name)
+                    arcname = os.path.relpath(full_path, path)
+                    info = tar.gettarinfo(full_path, arcname)
+                    info.mtime = info.uid = info.gid = 0
+                    info.uname = info.gname = 'root'
+                    if info.isfile():
+                        executable = (name in hooks and dirpath == path
+                                      or info.mode & 0o100)
+                        info.mode = 0o755 if executable else 0o644
+                        with open(full_path, 'rb') as f:
+                            tar.addfile(info, f)
+                    else:
+                        if info.isdir():
+                            info.mode = 0o755
+                        tar.addfile(info)
+    return buf.getvalue()
+
+
+def _get_customisation_dir_hooks(archive, hooks_dir):
+    """
+    Return a list of (content, hook type) tuples for the hooks which unpack
+    a customisation directory archive and run its hooks.
+
+    :param archive:
+        The tar.gz of the customisation directory, as produced by
+        _get_customisation_dir_archive.
+    :param hooks_dir:
+        The location of the hooks directory at build time.
+    """
+    def render(hook_type, archive_path):
+        return CUSTOMISATION_DIR_HOOK_TEMPLATE.format(
+            archive='"{}"'.format(archive_path), hook_type=hook_type,
+            archive_line=CUSTOMISATION_DIR_HOOK_TEMPLATE.count('\n') + 1)
+    carrier = '{}/9998-{}.chroot'.format(hooks_dir,
+                                         CUSTOMISATION_DIR_HOOK_NAME)
+    return [(render('chroot', '$0').encode('utf-8') + archive, 'chroot'),
+            (render('binary', carrier), 'binary')]
+
+
+def _may_run_grub_probe(contents):
+    """
+    Return True if any of some hook contents look like they may install or
+    configure kernels or bootloaders, and so run grub-probe.
+    """
+    return any(GRUB_PROBE_PATTERN.search(
+        content if isinstance(content, bytes) else content.encode('utf-8'))
+        for content in contents)
+
+
+def _customisation_dir_may_run_grub_probe(archive):
+    """
+    Return True if any of the chroot hooks in a customisation directory
+    archive look like they may run grub-probe (see _may_run_grub_probe).
+
+    The archive is streamed, and only its top-level .chroot hooks are read
+    (a chunk at a time), so assets are never unpacked in to memory.
+    """
+    with tarfile.open(fileobj=io.BytesIO(archive), mode='r|gz') as tarball:
+        for member in tarball:
+            if not (member.isfile() and '/' not in member.name
+                    and member.name.endswith('.chroot')):
+                continue
+            hook = tarball.extractfile(member)
+            # Keep the end of each chunk, to match words split between them
+            tail = b''
+            for chunk in iter(lambda: hook.read(65536), b''):
+                if GRUB_PROBE_PATTERN.search(tail + chunk):
+                    return True
+                tail = chunk[-16:]
+    return False
+
+
+def _read_script(script):
+    with open(script, 'rb') as f:
+        return f.read().decode('utf-8')
+
+
+def _produce_write_files_stanza(content, path, permissions='0755',
+                                compress=False):
+    if not isinstance(content, bytes):
+        content = content.encode('utf-8')
+    encoding = 'b64'
+    if compress:
+        buf = io.BytesIO()
+        # A fixed mtime keeps the output identical between runs
+        with gzip.GzipFile(filename='', mode='wb', fileobj=buf,
+                           mtime=0) as gzip_file:
+            gzip_file.write(content)
+        content = buf.getvalue()
+        encoding = 'gz+b64'
+    b64_content = base64.b64encode(content).decode('utf-8')
     return WRITE_FILES_STANZA_TEMPLATE.format(
-        content=b64_content, hook_type=hook_type, sequence=sequence,
-        homedir=homedir)
+        content=b64_content, encoding=encoding, path=path,
+        permissions=permissions)
 
 
-def _write_cloud_config(output_file, binary_customisation_script=None,
-                        binary_hook_filter=None, customisation_script=None,
-                        build_ppa=None, build_ppa_key=None, homedir=None,
-                        image_ppa=None):
+def _format_size_report(output_string, limit):
+    """
+    Produce a human-readable report of the size of a rendered cloud-config,
+    broken down by write_files payload.
+
+    :param output_string:
+        The rendered cloud-config.
+    :param limit:
+        The user-data limit, in bytes, that the cloud-config must fit in.
+    """
+    size = len(output_string.encode('utf-8'))
+    lines = []
+    payloads_size = 0
+    for entry in yaml.safe_load(output_string).get('write_files') or []:
+        payload_size = len(entry['content'])
+        payloads_size += payload_size
+        lines.append('{:>10}  {}'.format(payload_size, entry['path']))
+    lines.insert(0, '{:>10}  (runcmd and other configuration)'.format(
+        size - payloads_size))
+    lines.append('{:>10}  total ({:.0%} of the {} byte limit)'.format(
+        size, float(size) / limit, limit))
+    return '\n'.join(lines)
+
+
+def _parse_user_data_limit(value):
+    """
+    Parse a user-data limit (a cloud name or a number of bytes) for argparse.
+    """
+    if value in USER_DATA_LIMITS:
+        return USER_DATA_LIMITS[value]
+    try:
+        limit = int(value)
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        raise argparse.ArgumentTypeError(
+            'must be a number of bytes or one of: {}'.format(
+                ', '.join(sorted(USER_DATA_LIMITS))))
+    return limit
+
+
+def _parse_unsquashfs_processors(value):
+    """
+    Parse a number of unsquashfs processors (or "auto") for argparse.
+    """
+    if value == 'auto':
+        return value
+    try:
+        processors = int(value)
+    except ValueError:
+        processors = 0
+    if processors < 1:
+        raise argparse.ArgumentTypeError(
+            'must be "auto" or a number of processors')
+    return processors
+
+
+def _build_script_from_snippet(snippet):
+    """
+    Turn a yaml snippet of runcmd entries in to the equivalent shell script.
+    """
+    commands = yaml.safe_load(snippet) or []
+    return '#!/bin/sh\n' + ''.join(
+        '{}\n'.format(command) for command in commands)
+
+
+def _get_hooks(customisation_script=None, binary_customisation_script=None,
+               customisation_dir=None, grub_probe_shim='full',
+               binary_hook_filter=None, artifacts=None, cache=None):
+    """
+    Return the live-build hooks to add to each build, as (content, hook
+    type, sequence, name) tuples; see _write_cloud_config for the
+    arguments.
+    """
+    hooks = []
+    # The contents of the chroot hooks, as written (rather than packed)
+    chroot_contents = []
+    archive = None
+    for hook_type, script in (('chroot', customisation_script),
+                              ('binary', binary_customisation_script)):
+        if script is None:
+            continue
+        content = _cached(cache, ('script', script), _read_script, script)
+        if not content:
+            continue
+        hooks.append((content, hook_type, 9998, HOOK_NAME))
+        if hook_type == 'chroot':
+            chroot_contents.append(content)
+    if customisation_dir is not None:
+        archive = _cached(cache, ('customisation_dir', customisation_dir),
+                          _get_customisation_dir_archive, customisation_dir)
+        for content, hook_type in _get_customisation_dir_hooks(
+                archive, '/build/config/hooks'):
+            hooks.append((content, hook_type, 9998,
+                          CUSTOMISATION_DIR_HOOK_NAME))
+    if any(hook_type == 'chroot' for _, hook_type, _, _ in hooks):
+        if grub_probe_shim == 'auto':
+            grub_probe_shim = 'none'
+            if _may_run_grub_probe(chroot_contents) or (
+                    archive is not None and _cached(
+                        cache, ('may_run_grub_probe', archive),
+                        _customisation_dir_may_run_grub_probe, archive)):
+                grub_probe_shim = 'fast'
+        if grub_probe_shim != 'none':
+            hooks.append((FAST_SETUP_CONTENT if grub_probe_shim == 'fast'
+                          else SETUP_CONTENT, 'chroot', 9997, HOOK_NAME))
+            hooks.append((TEARDOWN_CONTENT, 'chroot', 9999, HOOK_NAME))
+    if binary_hook_filter is not None:
+        hooks.append((BINARY_HOOK_FILTER_CONTENT.format(binary_hook_filter),
+                      'binary', 0, HOOK_NAME))
+    if artifacts is not None:
+        artifact_filter = _get_artifact_filter(artifacts)
+        if artifact_filter is not None:
+            hooks.append((artifact_filter, 'binary',
+                          ARTIFACT_FILTER_HOOK_SEQUENCE,
+                          ARTIFACT_FILTER_HOOK_NAME))
+    return hooks
+
+
+def _get_hook_files(hooks, builds, homedir):
+    """
+    Return the files (as (content, path, permissions) tuples) which add
+    hooks to each build's live-build config.
+    """
+    return [
+        (content, HOOK_PATH_TEMPLATE.format(
+            build_id=build_id, homedir=homedir, hook_type=hook_type,
+            name=name, project=project, sequence=sequence), '0755')
+        for build_id, _, project in builds
+        for content, hook_type, sequence, name in hooks]
+
+
+def _get_chroot_snapshot_snippets(series, arch, unpack_chroot,
+                                  update_chroot, snapshot_dir):
+    """
+    Wrap the yaml snippets which unpack and update a build chroot so that
+    the chroot is restored from a snapshot if there is one, and otherwise
+    snapshotted once it has been updated.
+
+    Returns the wrapped (unpack_chroot, update_chroot) snippets.
+    """
+    key = _get_chroot_snapshot_key(series, arch, update_chroot)
+    unpack_chroot = RESTORE_CHROOT_SNAPSHOT_TEMPLATE.format(
+        hook_excludes=SNAPSHOT_HOOK_EXCLUDES, key=key,
+        snapshot_dir=snapshot_dir, unpack=yaml.safe_load(unpack_chroot)[0])
+    update_chroot = '\n'.join([
+        _guard_snippet(update_chroot, '[ $CHROOT_RESTORED = 1 ]'),
+        CREATE_CHROOT_SNAPSHOT_TEMPLATE.format(
+            apt_proxy_conf_path=APT_PROXY_CONF_PATH,
+            hook_excludes=SNAPSHOT_HOOK_EXCLUDES, key=key,
+            snapshot_dir=snapshot_dir)])
+    return unpack_chroot, update_chroot
+
+
+def _get_worker_files(homedir):
+    """
+    Return the files (as (content, path, permissions) tuples) which install
+    the worker, and its service, in a worker's home directory.
+    """
+    return [
+        (WORKER_CONTENT, '{}/worker.sh'.format(homedir), '0755'),
+        (WORKER_UNIT_CONTENT.format(homedir=homedir),
+         '/etc/systemd/system/{}'.format(WORKER_UNIT), '0644'),
+    ]
+
+
+def _add_setup_steps(template, prefetch=False, offline_bundle=False):
+    """
+    Add the steps which run once the build environment is set up (and its
+    payloads copied in to place) to a template: fetching everything in the
+    prefetch manifest, then unpacking the offline bundle.
+    """
+    steps = ''
+    if prefetch:
+        steps += PREFETCH_TEMPLATE
+    if offline_bundle:
+        steps += OFFLINE_BUNDLE_TEMPLATE
+    return template.replace('{copy_payloads}\n', '{copy_payloads}\n' + steps,
+                            1)
+
+
+def _get_prefetch_files(prefetches, homedir):
+    """
+    Return the files (as (content, path, permissions) tuples) which fetch
+    everything in a list of prefetch manifest entries.
+    """
+    return [
+        (_format_prefetch_manifest(prefetches),
+         '{}/prefetch.manifest'.format(homedir), '0644'),
+        (PREFETCH_CONTENT, '{}/prefetch.sh'.format(homedir), '0755'),
+    ]
+
+
+def _get_base_image_snippets(arches, series, base_image_cache=None,
+                             bundle_directory=None, images_directory=None,
+                             prefetch=False, cache=None):
+    """
+    Return a yaml snippet which puts the base image of each architecture at
+    BASE_IMAGE_PATH, and the prefetch manifest entries (if any) it relies
+    on.
+
+    :param arches:
+        The architectures to put base images in place for.
+    :param series:
+        The series of the base images.
+    :param base_image_cache:
+        An (optional) base image cache; see _write_cloud_config.
+    :param bundle_directory:
+        The (optional) directory an offline bundle is unpacked in to, from
+        which the base images are linked.
+    :param images_directory:
+        The (optional) directory in which a worker keeps base images for its
+        jobs, unless base_image_cache is given.
+    :param prefetch:
+        If True, the base images are fetched with the other prefetches.
+    """
+    snippets = []
+    prefetches = []
+    for arch in arches:
+        filename = BASE_IMAGE_FILENAME.format(arch=arch, series=series)
+        if bundle_directory is not None:
+            snippet = '- ln -sf {}/{} {}'.format(
+                bundle_directory, OFFLINE_BUNDLE_BASE_IMAGE_PATH.format(
+                    series=series, filename=filename),
+                BASE_IMAGE_PATH.format(arch=arch))
+        elif images_directory is not None and base_image_cache is None:
+            snippet = WORKER_BASE_IMAGE_TEMPLATE.format(
+                destination=BASE_IMAGE_PATH.format(arch=arch),
+                directory=images_directory, filename=filename,
+                url=BASE_IMAGE_URLS[series])
+            if prefetch:
+                prefetches.append((
+                    '{}/{}'.format(images_directory, filename), 'newer',
+                    None, [BASE_IMAGE_URLS[series] + filename]))
+                # Only keep the link to the fetched image
+                snippet = snippet.splitlines()[-1]
+        elif prefetch:
+            entry, snippet = _cached(
+                cache, ('base_image_prefetch', series, arch,
+                        base_image_cache),
+                _get_base_image_prefetch, arch, base_image_cache, series)
+            prefetches.append(entry)
+        else:
+            snippet = _cached(
+                cache, ('base_image', series, arch, base_image_cache),
+                _get_base_image_snippet, arch, base_image_cache, series)
+        snippets.append(snippet)
+    return '\n'.join(snippet for snippet in snippets if snippet), prefetches
+
+
+def _get_offline_bundle_unpack(offline_bundle, homedir, bundle_directory,
+                               required, prefetch=False):
+    """
+    Return a yaml snippet which (fetches and) unpacks an offline bundle, and
+    the prefetch manifest entries (if any) which fetch it instead.
+
+    :param offline_bundle:
+        The path on the build instance, or URL, of the offline bundle.
+    :param homedir:
+        The build home directory, to which a bundle URL is fetched.
+    :param bundle_directory:
+        The directory to unpack the bundle in to.
+    :param required:
+        The paths in the bundle that the build needs, which are checked
+        against its index.
+    :param prefetch:
+        If True, a bundle URL is fetched with the other prefetches.
+    """
+    prefetches = []
+    unpack = []
+    if offline_bundle.startswith(('http://', 'https://')):
+        archive = '{}/offline-bundle.tar'.format(homedir)
+        if prefetch:
+            prefetches.append((archive, 'url', None, [offline_bundle]))
+        else:
+            unpack.append(OFFLINE_BUNDLE_FETCH_TEMPLATE.format(
+                archive=archive, url=offline_bundle))
+    else:
+        archive = offline_bundle
+    unpack.append(OFFLINE_BUNDLE_UNPACK_TEMPLATE.format(
+        archive=archive, directory=bundle_directory,
+        index=OFFLINE_BUNDLE_INDEX, required=' '.join(sorted(required))))
+    return '\n'.join(unpack), prefetches
+
+
+def _write_cloud_config(output_file, apt_cache_local=False, apt_proxy=None,
+                        architectures=None, artifact_manifest=False,
+                        artifacts=None, base_image_cache=None,
+                        binary_customisation_script=None,
+                        binary_hook_filter=None, build_ppa=None,
+                        build_ppa_key=None, chroot_snapshot_dir=None,
+                        chroot_storage=None, chroot_storage_size=None,
+                        compress_artifacts=None, compress_payloads=False,
+                        compression_level=None, customisation_dir=None,
+                        customisation_script=None, grub_probe_shim=None,
+                        homedir=None, image_ppa=None, instrument=False,
+                        launchpad_buildd=None,
+                        launchpad_buildd_sha256=None, offline_bundle=None,
+                        parallel_builds=None, prefetch=False,
+                        progress_log=None, projects=None,
+                        publish_chunk_size=None, publish_jobs=None,
+                        publish_url=None, series=None,
+                        squashfs_block_size=None, squashfs_compressor=None,
+                        unsquashfs_processors=None, user_data_limit=None,
+                        worker=False, worker_job=None, cache=None):
     """
     Write an image building cloud-config file to a given location.
 
     :param output_file:
         An open file object to write the output to.
+    :param apt_cache_local:
+        If True, install a caching apt proxy (apt-cacher-ng) on the build
+        instance, and use it for apt both on the instance and in the build
+        chroots.  If apt_proxy is also given, the local cache will fetch
+        through it.
+    :param apt_proxy:
+        The (optional) URL of an HTTP proxy (e.g. a shared apt cache) to use
+        for apt both on the build instance and in the build chroots.
+    :param architectures:
+        An (optional) list of architectures to build images for.  Each
+        architecture (and project) is built in its own chroot, with its own
+        build ID, and the builds are run concurrently.  Defaults to amd64.
+    :param artifact_manifest:
+        If True, checksum each built image (as it is collected) and write a
+        manifest of their names, sizes and SHA256 checksums (and of the
+        build's timings, if instrumented) to manifest.json alongside them.
+    :param artifacts:
+        An (optional) list of artifact names (keys of ARTIFACT_HOOKS) to
+        produce.  The binary hooks which only produce other artifacts are
+        skipped.  If not passed (and by default), all artifacts are produced.
+    :param base_image_cache:
+        An (optional) path to a directory on the build instance in which base
+        images are cached between builds, or the URL of an HTTP mirror of such
+        a directory.  Cached images are keyed by the checksum published in the
+        upstream SHA256SUMS file.
     :param binary_customisation_script:
         An (optional) path to a binary customisation script; this will be
         included as a binary hook in the build environment before it starts,
@@ -183,10 +1922,25 @@ def _write_cloud_config(output_file, binary_customisation_script=None,
         chroot should be preserved.  This is templated in to a shell script, so
         globs valid in that context are valid here.  If not passed (and by
         default), all binary hooks are preserved.
+    :param customisation_dir:
+        An (optional) path to a directory of hooks (files at its top level
+        ending in .chroot or .binary) and the assets they need.  The
+        directory is packed in to a single archive, which is unpacked at
+        build time; its hooks are run in sorted order, from the unpacked
+        directory (which is also in $CUSTOMISATION_DIR), before the
+        customisation scripts.
     :param customisation_script:
         An (optional) path to a customisation script; this will be included as
         a chroot hook in the build environment before it starts, allowing
         modifications to the image contents to be made.
+    :param grub_probe_shim:
+        How (optionally) to stand in for grub-probe while chroot hooks run
+        (as there are no real disks to probe); one of GRUB_PROBE_SHIMS.
+        "full" (the default) uses a getopt-based stand-in, and "fast" an
+        equivalent one which parses its options itself.  "none" uses no
+        stand-in, for hooks which don't touch kernels or bootloaders, and
+        "auto" uses none unless the hooks look like they might, in which
+        case it uses the fast one.
     :param homedir:
         An (optional) path to use for the build environment within the cloud
         instance.
@@ -198,59 +1952,1108 @@ def _write_cloud_config(output_file, binary_customisation_script=None,
         The (optional) hexadecimal key ID used to sign the builder PPA. This
         is only used if "build_ppa" points to a private PPA, and is ignored in
         every other case.
+    :param chroot_snapshot_dir:
+        An (optional) path to a directory on the build instance (e.g. on a
+        persistent volume) in which to keep snapshots of build chroots once
+        they have been updated.  Builds for the same architecture, with the
+        same build PPA, on the same day, will start from a snapshot rather
+        than unpacking and updating a new chroot.
+    :param chroot_storage:
+        Where (optionally) to put each build tree: "disk" (the default),
+        "tmpfs", "zram", or "auto", which uses tmpfs or zram if the instance
+        has enough available memory when the build starts, and disk
+        otherwise.
+    :param chroot_storage_size:
+        The (optional) size, in MiB, of each RAM-backed build tree.  Defaults
+        to DEFAULT_CHROOT_STORAGE_SIZE.
+    :param compress_artifacts:
+        The (optional) multi-threaded compressor (a key of
+        ARTIFACT_COMPRESSORS) with which to compress each built image that
+        isn't already compressed, replacing it.  Images are checksummed as
+        they are compressed, and a manifest written as for artifact_manifest.
+    :param compress_payloads:
+        If True, write_files payloads are gzipped (with gz+b64 encoding)
+        rather than only base64-encoded.
+    :param compression_level:
+        The (optional) level at which to compress_artifacts.  Defaults to the
+        compressor's default level in ARTIFACT_COMPRESSORS.
     :param image_ppa:
         The identifier for a PPA to be injected inside the built image,
         optionally with a pin-priority. Archives have a priority of 500 by
         default, anything above this will take pinning precedence. Example:
         foo/bar:1001
+    :param instrument:
+        If True, time each phase of the build, and write the timings to
+        timings.json alongside the images produced by each build.
+    :param launchpad_buildd:
+        An (optional) path to, or URL of, a tarball of a launchpad-buildd
+        tree (e.g. from "bzr export") to use instead of branching
+        launchpad-buildd from Launchpad.  A local tarball is embedded in the
+        cloud-config, while a URL is fetched by the build instance.
+    :param launchpad_buildd_sha256:
+        The SHA256 checksum of the launchpad-buildd tarball.  This is
+        required if launchpad_buildd is a URL, and is checked against the
+        tarball if it is a path.
+    :param offline_bundle:
+        The (optional) path on the build instance, or URL on a local mirror,
+        of an offline bundle (see make_offline_bundle).  If given, the base
+        images, launchpad-buildd and private PPA signing key are taken from
+        the bundle, which is checked against its index, so the build only
+        needs an apt archive (or apt_proxy) to be reachable.  Public PPAs,
+        image_ppa, base_image_cache and launchpad_buildd can't be used with
+        it.
+    :param parallel_builds:
+        The (optional) maximum number of builds to run at once, when more
+        than one architecture or project is being built.  By default, all
+        builds are run at once.
+    :param prefetch:
+        If True, every network input of the build which is known when the
+        config is generated (base images, launchpad-buildd and private PPA
+        signing keys) is listed in a manifest, and fetched at once (with
+        retries, and checked against its checksum if that is known) before
+        the build starts; the later steps then use the copies fetched.
+    :param progress_log:
+        An (optional) path on the build instance to which progress events
+        (phases starting and ending, base images downloaded, live-build
+        stages and build results) are appended, as lines of JSON.  See
+        build_progress.py for a command to follow them.
+    :param projects:
+        An (optional) list of livecd-rootfs projects to build images for.
+        Defaults to ubuntu-cpc.
+    :param publish_chunk_size:
+        The (optional) size, in MiB, above which images are published in
+        chunks (uploaded concurrently, to PATH.part-00000 and so on).  By
+        default, images are published whole.
+    :param publish_jobs:
+        The (optional) number of uploads to run at once when publishing
+        images.  Defaults to DEFAULT_PUBLISH_JOBS.
+    :param publish_url:
+        An (optional) HTTP(S) URL to publish the images to, once every build
+        has finished, with a PUT of each file to its path under the URL
+        (e.g. an S3-compatible bucket which allows them).  published.json is
+        uploaded last, listing the files, to signal that they are all there.
+    :param squashfs_block_size:
+        The (optional) block size, in KiB, of the squashfses built (a power
+        of two from 4 to 1024), in place of the one livecd-rootfs uses.
+    :param squashfs_compressor:
+        The (optional) compressor (a key of SQUASHFS_COMPRESSORS) for the
+        squashfses built, in place of the one livecd-rootfs uses; e.g. lz4
+        for faster test builds.
+    :param series:
+        The (optional) series to build images of; one of the keys of
+        BASE_IMAGE_URLS.  Defaults to xenial.
+    :param unsquashfs_processors:
+        The (optional) number of processors to unpack each base image with,
+        or "auto" to share the instance's CPUs between the builds running at
+        once.  By default, unsquashfs uses every CPU.
+    :param user_data_limit:
+        An (optional) maximum size, in bytes, of the cloud-config.  If given,
+        a report of the cloud-config's size is printed to stderr, and a
+        ValueError is raised (before anything is written) if it is too large.
+    :param worker:
+        If True, write a cloud-config which only sets up the instance (with
+        the packages, apt configuration and launchpad-buildd that builds
+        need), and then starts a worker which runs the build jobs (see
+        worker_job) put in homedir/jobs/queue, one at a time.
+    :param worker_job:
+        The (optional) name of a build job for a worker.  Instead of a
+        cloud-config, a shell script is written, to be put in the worker's
+        queue as NAME.sh.  The job builds in its own directory
+        (homedir/jobs/NAME, where its images are left), skipping the setup
+        the worker has already done; its build trees are removed once it
+        finishes.  Unless base_image_cache is given, base images are kept in
+        homedir/base-images, and only downloaded again once they change.
+    :param cache:
+        An (optional) dict which will be used to memoise script contents,
+        encoded write_files stanzas and rendered template text.  Passing the
+        same dict to many calls avoids repeating that work for each config.
     """
-    ppa_snippet = ""
-    if build_ppa is not None:
-        ppa_snippet = _get_ppa_snippet(build_ppa, build_ppa_key)
+    builds = _get_builds(architectures, projects)
+    if series is None:
+        series = DEFAULT_SERIES
+    if series not in BASE_IMAGE_URLS:
+        raise ValueError('series must be one of: {}'.format(
+            ', '.join(sorted(BASE_IMAGE_URLS))))
+    if parallel_builds is not None and parallel_builds < 1:
+        raise ValueError('parallel_builds must be at least 1.')
+    if chroot_storage is None:
+        chroot_storage = 'disk'
+    if chroot_storage not in CHROOT_STORAGE_MODES:
+        raise ValueError('chroot_storage must be one of: {}'.format(
+            ', '.join(CHROOT_STORAGE_MODES)))
+    if chroot_storage_size is None:
+        chroot_storage_size = DEFAULT_CHROOT_STORAGE_SIZE
+    if compress_artifacts is not None:
+        if compress_artifacts not in ARTIFACT_COMPRESSORS:
+            raise ValueError('compress_artifacts must be one of: {}'.format(
+                ', '.join(sorted(ARTIFACT_COMPRESSORS))))
+        _, levels, default_level = ARTIFACT_COMPRESSORS[compress_artifacts]
+        if compression_level is None:
+            compression_level = default_level
+        elif compression_level not in levels:
+            raise ValueError('compression_level must be from {} to {} for '
+                             '{}.'.format(levels[0], levels[-1],
+                                          compress_artifacts))
+    elif compression_level is not None:
+        raise ValueError('compression_level can only be given with '
+                         'compress_artifacts.')
+    if grub_probe_shim is None:
+        grub_probe_shim = 'full'
+    if grub_probe_shim not in GRUB_PROBE_SHIMS:
+        raise ValueError('grub_probe_shim must be one of: {}'.format(
+            ', '.join(GRUB_PROBE_SHIMS)))
+    if squashfs_compressor is not None:
+        if squashfs_compressor not in SQUASHFS_COMPRESSORS:
+            raise ValueError('squashfs_compressor must be one of: {}'.format(
+                ', '.join(sorted(SQUASHFS_COMPRESSORS))))
+        compressor_series = SQUASHFS_COMPRESSORS[squashfs_compressor]
+        if compressor_series is not None and series not in compressor_series:
+            raise ValueError('{} squashfses can only be built for: {}'.format(
+                squashfs_compressor, ', '.join(compressor_series)))
+    if squashfs_block_size is not None and (
+            squashfs_block_size not in [2 ** n for n in range(2, 11)]):
+        raise ValueError('squashfs_block_size must be a power of two from 4 '
+                         'to 1024.')
+    if unsquashfs_processors not in (None, 'auto') and (
+            not isinstance(unsquashfs_processors, int)
+            or unsquashfs_processors < 1):
+        raise ValueError('unsquashfs_processors must be "auto" or at least '
+                         '1.')
+    if publish_url is not None:
+        if not PUBLISH_URL_PATTERN.match(publish_url):
+            raise ValueError('publish_url must be an http:// or https:// URL '
+                             'without a query string or shell '
+                             'metacharacters.')
+        if publish_jobs is None:
+            publish_jobs = DEFAULT_PUBLISH_JOBS
+        if publish_chunk_size is None:
+            publish_chunk_size = 0
+        if publish_jobs < 1 or publish_chunk_size < 0:
+            raise ValueError('publish_jobs must be at least 1, and '
+                             'publish_chunk_size positive.')
+    if (launchpad_buildd is not None and launchpad_buildd_sha256 is None
+            and launchpad_buildd.startswith(('http://', 'https://'))):
+        raise ValueError('You must provide a launchpad-buildd checksum if '
+                         'using a launchpad-buildd URL.')
+    if offline_bundle is not None:
+        if not OFFLINE_BUNDLE_PATTERN.match(offline_bundle):
+            raise ValueError('offline_bundle must be an absolute path or an '
+                             'http:// or https:// URL, without shell '
+                             'metacharacters.')
+        if base_image_cache is not None or launchpad_buildd is not None:
+            raise ValueError('base_image_cache and launchpad_buildd cannot '
+                             'be given with offline_bundle.')
+        if image_ppa is not None or (build_ppa is not None
+                                     and not build_ppa.startswith('https://')):
+            raise ValueError('Public PPAs are fetched from Launchpad, so '
+                             'cannot be used with offline_bundle.')
+    if worker_job is not None:
+        if worker:
+            raise ValueError('worker and worker_job cannot both be given.')
+        if not WORKER_JOB_NAME_PATTERN.match(worker_job):
+            raise ValueError('worker_job must be a name of letters, digits, '
+                             '".", "_" and "-".')
     if homedir is None:
         homedir = '/home/ubuntu'
+    worker_homedir = homedir
+    if worker_job is not None:
+        homedir = '{}/jobs/{}'.format(worker_homedir, worker_job)
+    # Prefetch manifest entries; see _get_base_image_prefetch
+    prefetches = []
+    # The files the build needs from the offline bundle, if any
+    bundle_directory = '{}/offline-bundle'.format(worker_homedir)
+    bundle_required = []
+    ppa_snippet = ""
+    if build_ppa is not None:
+        key_path = None
+        if build_ppa.startswith('https://') and build_ppa_key is not None:
+            key_id = _get_ppa_key_id(build_ppa_key)
+            if offline_bundle is not None:
+                bundle_required.append(
+                    OFFLINE_BUNDLE_PPA_KEY_PATH.format(key_id=key_id))
+                key_path = '{}/{}'.format(bundle_directory,
+                                          bundle_required[-1])
+            elif prefetch:
+                key_path = '{}/build-ppa-key.asc'.format(homedir)
+                prefetches.append((key_path, 'url', None, [
+                    PPA_KEY_URL_TEMPLATE.format(key_id=key_id)]))
+        ppa_snippet = _get_ppa_snippet(build_ppa, build_ppa_key, series,
+                                       key_path)
     if image_ppa is None:
         image_ppa_command = ''
     else:
         image_ppa_command = '--extra-ppa {}'.format(image_ppa)
-    output_string = TEMPLATE.format(ppa_conf=ppa_snippet, homedir=homedir,
-                                    image_ppa=image_ppa_command)
+
+    write_files = []
+    base_image_arches = []
+    for _, arch, _ in builds:
+        if arch not in base_image_arches:
+            base_image_arches.append(arch)
+    if offline_bundle is not None:
+        # Workers check for these too, as their jobs use them
+        bundle_required.extend(
+            OFFLINE_BUNDLE_BASE_IMAGE_PATH.format(
+                series=series,
+                filename=BASE_IMAGE_FILENAME.format(arch=arch, series=series))
+            for arch in base_image_arches)
+    packages = list(PACKAGES)
+    if any(arch in QEMU_ARCHES for arch in base_image_arches):
+        packages.extend(FOREIGN_ARCH_PACKAGES)
+    if worker_job is not None:
+        # The worker has already installed launchpad-buildd
+        buildd_install = WORKER_JOB_BUILDD_TEMPLATE.format(
+            homedir=homedir, worker_homedir=worker_homedir)
+        if launchpad_buildd is not None or offline_bundle is not None:
+            packages = [package for package in packages
+                        if package not in BUILDD_BZR_PACKAGES]
+            buildd_install += '\n- export PYTHONPATH={}'.format(
+                '{}/launchpad-buildd'.format(homedir))
+    elif offline_bundle is not None:
+        packages = [package for package in packages
+                    if package not in BUILDD_BZR_PACKAGES]
+        bundle_required.append(OFFLINE_BUNDLE_BUILDD_PATH)
+        # The bundle has been checked against its index
+        buildd_install = BUILDD_UNPACK_TEMPLATE.format(
+            homedir=homedir, tarball='{}/{}'.format(
+                bundle_directory, OFFLINE_BUNDLE_BUILDD_PATH))
+    elif launchpad_buildd is None and prefetch:
+        prefetches.append(('{}/launchpad-buildd'.format(homedir), 'bzr',
+                           None, [BUILDD_BZR_BRANCH]))
+        buildd_install = BUILDD_BZR_INSTALL_TEMPLATE.format(homedir=homedir)
+    elif launchpad_buildd is None:
+        buildd_install = BUILDD_BZR_TEMPLATE.format(homedir=homedir)
+    else:
+        packages = [package for package in packages
+                    if package not in BUILDD_BZR_PACKAGES]
+        tarball = '{}/{}'.format(
+            homedir, launchpad_buildd.rstrip('/').rsplit('/', 1)[-1])
+        buildd_install = []
+        if launchpad_buildd.startswith(('http://', 'https://')):
+            sha256 = launchpad_buildd_sha256
+            if prefetch:
+                prefetches.append((tarball, 'url', sha256,
+                                   [launchpad_buildd]))
+            else:
+                buildd_install.append(BUILDD_FETCH_TEMPLATE.format(
+                    tarball=tarball, url=launchpad_buildd))
+        else:
+            content, sha256 = _cached(
+                cache, ('launchpad_buildd', launchpad_buildd),
+                _get_launchpad_buildd_tarball, launchpad_buildd)
+            if launchpad_buildd_sha256 not in (None, sha256):
+                raise ValueError('{} does not match the given '
+                                 'checksum.'.format(launchpad_buildd))
+            write_files.append((content, tarball, '0644'))
+        buildd_install.append(BUILDD_TARBALL_TEMPLATE.format(
+            homedir=homedir, sha256=sha256, tarball=tarball))
+        buildd_install = '\n'.join(buildd_install)
+    apt_proxy_setup = apt_proxy_conf = ''
+    if apt_proxy is not None:
+        # This is in place before cloud-init installs packages
+        write_files.append((
+            APT_PROXY_CONF_TEMPLATE.format(url=apt_proxy),
+            APT_PROXY_CONF_PATH, '0644'))
+    if apt_cache_local:
+        packages.append('apt-cacher-ng')
+        if apt_proxy is not None:
+            write_files.append((
+                LOCAL_APT_CACHE_CONF_TEMPLATE.format(url=apt_proxy),
+                LOCAL_APT_CACHE_CONF_PATH, '0644'))
+        write_files.append((
+            APT_PROXY_CONF_TEMPLATE.format(url=LOCAL_APT_CACHE_URL),
+            LOCAL_APT_CACHE_STAGED_CONF_PATH, '0644'))
+        apt_proxy_setup = LOCAL_APT_CACHE_SETUP_TEMPLATE.format(
+            conf_path=APT_PROXY_CONF_PATH,
+            staged_conf_path=LOCAL_APT_CACHE_STAGED_CONF_PATH)
+    if apt_proxy is not None or apt_cache_local:
+        apt_proxy_conf = APT_PROXY_CHROOT_TEMPLATE.format(
+            conf_path=APT_PROXY_CONF_PATH)
+
+    # Worker jobs use the bundle the worker unpacked
+    offline_bundle_unpack = None
+    if offline_bundle is not None and worker_job is None:
+        offline_bundle_unpack, bundle_prefetches = _get_offline_bundle_unpack(
+            offline_bundle, homedir, bundle_directory, bundle_required,
+            prefetch)
+        prefetches.extend(bundle_prefetches)
+
+    if worker:
+        write_files.extend(_get_worker_files(homedir))
+        template = _add_setup_steps(
+            WORKER_TEMPLATE, prefetch=prefetch,
+            offline_bundle=offline_bundle_unpack is not None)
+        if prefetch:
+            write_files.extend(_get_prefetch_files(prefetches, homedir))
+        _write_cloud_config_pieces(output_file, _render_cloud_config(
+            template, write_files, cache=cache,
+            compress_payloads=compress_payloads,
+            apt_proxy_setup=apt_proxy_setup, buildd_install=buildd_install,
+            homedir=homedir, offline_bundle=offline_bundle_unpack,
+            packages=packages, worker_unit=WORKER_UNIT),
+            user_data_limit)
+        return
+    if worker_job is not None:
+        # The worker has already set up apt
+        apt_proxy_setup = ''
+    base_image_snippet, base_image_prefetches = _get_base_image_snippets(
+        base_image_arches, series, base_image_cache=base_image_cache,
+        bundle_directory=bundle_directory if offline_bundle else None,
+        images_directory='{}/base-images/{}'.format(worker_homedir, series)
+        if worker_job is not None else None,
+        prefetch=prefetch, cache=cache)
+    prefetches.extend(base_image_prefetches)
+
+    template = _add_setup_steps(
+        TEMPLATE if worker_job is None else WORKER_JOB_TEMPLATE,
+        prefetch=prefetch, offline_bundle=offline_bundle_unpack is not None)
+    if prefetch:
+        write_files.extend(_get_prefetch_files(prefetches, homedir))
+    build_template = BUILD_TEMPLATE
+    if publish_url is not None:
+        template += PUBLISH_TEMPLATE.format(
+            chunk_size=publish_chunk_size, jobs=publish_jobs, url=publish_url)
+        write_files.append(
+            (PUBLISH_CONTENT, '{}/publish.sh'.format(homedir), '0755'))
+    post_process = artifact_manifest or compress_artifacts is not None
+    if post_process:
+        build_template += POST_PROCESS_TEMPLATE.format(
+            compressor=compress_artifacts or 'none',
+            level=compression_level or 0)
+        if compress_artifacts is not None:
+            packages.append(ARTIFACT_COMPRESSORS[compress_artifacts][0])
+        write_files.append((POST_PROCESS_CONTENT,
+                            '{}/post-process.sh'.format(homedir), '0755'))
+    if instrument:
+        template = _instrument_template(template, SHARED_TIMINGS_LOG)
+        build_template = _instrument_template(
+            build_template, BUILD_TIMINGS_LOG) + TIMINGS_JSON_TEMPLATE
+        write_files.append((
+            PHASE_TIMER_CONTENT, '{}/phase-timer.sh'.format(homedir), '0755'))
+    if post_process:
+        build_template += POST_PROCESS_MANIFEST_TEMPLATE
+    if progress_log is not None:
+        template = _instrument_template(
+            template, None, PROGRESS_PHASE_TEMPLATE).replace(
+                '- export HOME={homedir}\n', '- export HOME={homedir}\n' +
+                PROGRESS_SETUP_TEMPLATE.format(builds=len(builds),
+                                               progress_log=progress_log) +
+                '\n', 1) + PROGRESS_FINISHED_TEMPLATE.format(
+                    builds=len(builds), homedir='{homedir}')
+        build_template = _add_build_progress(_instrument_template(
+            build_template, None, PROGRESS_PHASE_TEMPLATE))
+        base_image_snippet = '\n'.join(
+            [base_image_snippet] + [PROGRESS_DOWNLOADED_TEMPLATE.format(
+                homedir=homedir, path=BASE_IMAGE_PATH.format(arch=arch))
+                for arch in base_image_arches])
+        write_files.append(
+            (PROGRESS_CONTENT, '{}/progress.sh'.format(homedir), '0755'))
+    if worker_job is not None:
+        template += WORKER_JOB_CHECK_TEMPLATE
+
+    concurrent_builds = min(parallel_builds or len(builds), len(builds))
+    storage_conf = storage_release = ''
+    if chroot_storage != 'disk':
+        # Builds share the instance's memory, so in auto mode only use it if
+        # there is enough for every build that may be running at once
+        storage_conf = CHROOT_STORAGE_MOUNT_TEMPLATE.format(
+            homedir=homedir, mode=chroot_storage, size=chroot_storage_size,
+            required=chroot_storage_size * concurrent_builds)
+        storage_release = CHROOT_STORAGE_RELEASE_TEMPLATE.format(
+            homedir=homedir)
+        write_files.append((
+            CHROOT_STORAGE_CONTENT,
+            '{}/chroot-storage.sh'.format(homedir), '0755'))
+    processors = ''
+    if unsquashfs_processors == 'auto':
+        processors = ' -processors ' + (
+            '$(nproc)' if concurrent_builds == 1 else
+            UNSQUASHFS_PROCESSORS_AUTO.format(builds=concurrent_builds))
+    elif unsquashfs_processors is not None:
+        processors = ' -processors {}'.format(unsquashfs_processors)
+    squashfs_conf = ''
+    if squashfs_compressor is not None or squashfs_block_size is not None:
+        squashfs_conf = SQUASHFS_CONF_TEMPLATE.format(homedir=homedir)
+        write_files.append((
+            MKSQUASHFS_CONTENT.format(
+                block_size='{}K'.format(squashfs_block_size)
+                if squashfs_block_size is not None else '',
+                compressor=squashfs_compressor or ''),
+            '{}/mksquashfs'.format(homedir), '0755'))
+    build_snippets = []
+    for build_id, arch, project in builds:
+        if len(builds) == 1:
+            images = '{}/images'.format(homedir)
+        else:
+            images = '{}/images/{}'.format(homedir, build_id)
+        qemu_conf = ''
+        if arch in QEMU_ARCHES:
+            qemu_conf = QEMU_TEMPLATE.format(qemu_arch=QEMU_ARCHES[arch])
+        unpack_chroot = UNPACK_CHROOT_TEMPLATE.format(
+            base_image=BASE_IMAGE_PATH.format(arch=arch),
+            processors=processors)
+        update_chroot = UPDATE_CHROOT_TEMPLATE.format(
+            homedir=homedir, ppa_conf=ppa_snippet)
+        if chroot_snapshot_dir is not None:
+            unpack_chroot, update_chroot = _get_chroot_snapshot_snippets(
+                series, arch, unpack_chroot, update_chroot,
+                chroot_snapshot_dir)
+        build_args = dict(apt_proxy_conf=apt_proxy_conf,
+                          arch=arch, build_id=build_id, homedir=homedir,
+                          image_ppa=image_ppa_command, images=images,
+                          project=project, qemu_conf=qemu_conf,
+                          series=series, squashfs_conf=squashfs_conf,
+                          storage_conf=storage_conf,
+                          storage_release=storage_release,
+                          unpack_chroot=unpack_chroot,
+                          update_chroot=update_chroot)
+        build_snippets.append(_cached(
+            cache, ('build', build_template) + tuple(
+                sorted(build_args.items())),
+            _render_template, build_template, **build_args))
+    if len(builds) == 1:
+        builds_snippet = build_snippets[0]
+    else:
+        for (build_id, _, _), build_snippet in zip(builds, build_snippets):
+            write_files.append((
+                _cached(cache, ('build_script', build_snippet),
+                        _build_script_from_snippet, build_snippet),
+                '{}/build-{}.sh'.format(homedir, build_id), '0755'))
+        builds_snippet = PARALLEL_BUILDS_TEMPLATE.format(
+            build_ids=' '.join(build_id for build_id, _, _ in builds),
+            homedir=homedir, parallelism=parallel_builds or len(builds))
+
+    write_files.extend(_get_hook_files(_get_hooks(
+        customisation_script=customisation_script,
+        binary_customisation_script=binary_customisation_script,
+        customisation_dir=customisation_dir, grub_probe_shim=grub_probe_shim,
+        binary_hook_filter=binary_hook_filter, artifacts=artifacts,
+        cache=cache), builds, homedir))
+
+    if worker_job is not None:
+        packages = ' '.join(packages)
+    pieces = _render_cloud_config(
+        template, write_files, cache=cache,
+        compress_payloads=compress_payloads,
+        apt_proxy_setup=apt_proxy_setup, base_image_fetch=base_image_snippet,
+        buildd_install=buildd_install, builds=builds_snippet, homedir=homedir,
+        offline_bundle=offline_bundle_unpack, packages=packages)
+    if worker_job is not None:
+        pieces = [_get_worker_job_script(''.join(pieces))]
+    _write_cloud_config_pieces(output_file, pieces, user_data_limit)
+
+
+def _get_worker_job_script(cloud_config):
+    """
+    Convert a rendered worker job cloud-config to the script the worker
+    runs: it writes the files, then runs the commands.
+    """
+    cloud_config = yaml.safe_load(cloud_config)
+    write_files = []
+    for stanza in cloud_config.get('write_files') or []:
+        write_files.append(WORKER_JOB_FILE_TEMPLATE.format(
+            content=stanza['content'],
+            decompress='| gunzip -c '
+            if stanza['encoding'] == 'gz+b64' else '',
+            directory=os.path.dirname(stanza['path']), path=stanza['path'],
+            permissions=stanza['permissions']))
+    return WORKER_JOB_SCRIPT_TEMPLATE.format(
+        runcmd='\n'.join(cloud_config['runcmd']),
+        write_files='\n'.join(write_files))
+
+
+def _render_cloud_config(template, write_files, cache=None,
+                         compress_payloads=False, **template_args):
+    """
+    Render a cloud-config template, followed by its write_files stanzas.
+
+    Returns the list of pieces of the cloud-config.
+
+    :param template:
+        The (instrumented, and otherwise extended) template to render, e.g.
+        TEMPLATE.
+    :param write_files:
+        A list of (content, path, permissions) tuples of files to write.
+    :param template_args:
+        The arguments to render the template with; packages may be given as
+        a list, to render as a YAML list.
+    """
+    # Identical payloads (e.g. the same hook for each build) are only
+    # embedded once, and copied in to their other locations at boot
     write_files_stanzas = []
-    for hook_type, script in (('chroot', customisation_script),
-                              ('binary', binary_customisation_script)):
+    payload_paths = {}
+    copy_payloads = []
+    for content, path, permissions in write_files:
+        if (content, permissions) in payload_paths:
+            copy_payloads.append(COPY_PAYLOAD_TEMPLATE.format(
+                path=path, permissions=permissions,
+                source=payload_paths[content, permissions]))
+            continue
+        payload_paths[content, permissions] = path
+        write_files_stanzas.append(_cached(
+            cache, ('stanza', content, path, permissions, compress_payloads),
+            _produce_write_files_stanza, content, path, permissions,
+            compress_payloads))
+
+    template_args['copy_payloads'] = '\n'.join(copy_payloads)
+    if isinstance(template_args.get('packages'), list):
+        template_args['packages'] = ''.join(
+            '- {}\n'.format(package)
+            for package in template_args['packages']).rstrip('\n')
+    pieces = [_cached(
+        cache, ('template', template) + tuple(sorted(template_args.items())),
+        _render_template, template, **template_args)]
+    if write_files_stanzas:
+        pieces.append('\nwrite_files:\n')
+        pieces.extend(write_files_stanzas)
+    return pieces
+
+
+def _write_cloud_config_pieces(output_file, pieces, user_data_limit=None):
+    # Checks the size of a cloud-config (if limited) before writing it
+    if user_data_limit is not None:
+        output_string = ''.join(pieces)
+        print(_format_size_report(output_string, user_data_limit),
+              file=sys.stderr)
+        size = len(output_string.encode('utf-8'))
+        if size > user_data_limit:
+            raise ValueError(
+                'The cloud-config is {} bytes, which exceeds the user-data '
+                'limit of {} bytes.'.format(size, user_data_limit))
+    _write_pieces(output_file, pieces)
+
+
+MATRIX_SCRIPT_ARGUMENTS = ('binary_customisation_script',
+                           'customisation_dir', 'customisation_script')
+MATRIX_DEFAULT_OUTPUT = 'build-config-{index}.yaml'
+
+
+def _get_matrix_arguments():
+    """
+    Return the names of the _write_cloud_config arguments that may be given
+    in a matrix file.
+    """
+    return [arg for arg in getargspec(_write_cloud_config).args
+            if arg not in ('output_file', 'cache')]
+
+
+class BuildConfig(object):
+    """
+    An image build configuration, which can be rendered to cloud-config.
+
+    This is the importable equivalent of the generate_build_config command:
+    each attribute is one of the _write_cloud_config arguments (documented
+    there), and defaults to the same value.  For example::
+
+        config = BuildConfig(architectures=['amd64', 'arm64'],
+                             customisation_script='customise.sh')
+        with open('build-config.yaml', 'wb') as f:
+            config.render(f)
+
+    When rendering many configs, pass the same cache dict to each render()
+    call so that scripts, base image checksums and rendered snippets are
+    only produced once.
+    """
+
+    __slots__ = tuple(_get_matrix_arguments())
+
+    _defaults = dict(zip(reversed(getargspec(_write_cloud_config).args),
+                         reversed(getargspec(_write_cloud_config).defaults)))
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.pop(name, self._defaults[name]))
+        if kwargs:
+            raise TypeError('Unexpected BuildConfig arguments: {}'.format(
+                ', '.join(sorted(kwargs))))
+
+    def __eq__(self, other):
+        if not isinstance(other, BuildConfig):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name)
+                   for name in self.__slots__)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'BuildConfig({})'.format(', '.join(
+            '{}={!r}'.format(name, getattr(self, name))
+            for name in self.__slots__
+            if getattr(self, name) != self._defaults[name]))
+
+    def render(self, output_file=None, cache=None):
+        """
+        Render this configuration as cloud-config.
+
+        :param output_file:
+            An (optional) file-like object to stream the cloud-config to;
+            files opened in binary mode (and bytes buffers) are written
+            UTF-8.  If not given, the cloud-config is returned as a string.
+        :param cache:
+            An (optional) dict to memoise work in between renders.
+        """
+        kwargs = dict((name, getattr(self, name)) for name in self.__slots__)
+        if output_file is not None:
+            _write_cloud_config(output_file, cache=cache, **kwargs)
+            return None
+        output = io.BytesIO()
+        _write_cloud_config(output, cache=cache, **kwargs)
+        return output.getvalue().decode('utf-8')
+
+
+def _matrix_name_part(argument, value):
+    # Produce something suitable for use in a filename from an axis value
+    if value is None:
+        return 'none'
+    value = str(value)
+    if argument in MATRIX_SCRIPT_ARGUMENTS:
+        value = os.path.splitext(os.path.basename(value))[0]
+    return re.sub(r'[^A-Za-z0-9._-]+', '_', value).strip('_')
+
+
+def _expand_matrix(matrix, defaults=None):
+    """
+    Expand a build matrix in to the combinations of _write_cloud_config
+    arguments it describes.
+
+    Returns a list of (output path, keyword arguments) tuples.
+
+    :param matrix:
+        A dict as loaded from a matrix file.  Its "matrix" key maps
+        _write_cloud_config argument names to a list of values (a single
+        value is treated as a one-element list); one config is produced for
+        every combination of these values.  Its (optional) "output" key is a
+        format string for the output path of each config, which is passed
+        "index" and each matrix argument.
+    :param defaults:
+        An (optional) dict of _write_cloud_config keyword arguments that apply
+        to every combination, unless overridden by the matrix.
+    """
+    axes = matrix.get('matrix') or {}
+    unknown = sorted(set(axes) - set(_get_matrix_arguments()))
+    if unknown:
+        raise ValueError('Unknown matrix argument(s): {}'.format(
+            ', '.join(unknown)))
+    names = sorted(axes)
+    values = [axes[name] if isinstance(axes[name], list) else [axes[name]]
+              for name in names]
+    output = matrix.get('output', MATRIX_DEFAULT_OUTPUT)
+    combinations = []
+    for index, combination in enumerate(itertools.product(*values)):
+        kwargs = dict(defaults or {})
+        kwargs.update(zip(names, combination))
+        name_parts = dict((name, _matrix_name_part(name, value))
+                          for name, value in zip(names, combination))
+        try:
+            path = output.format(index=index, **name_parts)
+        except KeyError as e:
+            raise ValueError(
+                'Matrix output {!r} refers to {}, which is not a matrix '
+                'argument.'.format(output, e))
+        combinations.append((path, kwargs))
+    return combinations
+
+
+def _load_matrix(matrix_file):
+    """
+    Load a YAML matrix file, making the script paths in it absolute.
+
+    Returns a (directory containing the file, matrix) tuple.
+    """
+    with open(matrix_file) as f:
+        matrix = yaml.safe_load(f) or {}
+    base_dir = os.path.dirname(os.path.abspath(matrix_file))
+    axes = matrix.get('matrix') or {}
+    for argument in MATRIX_SCRIPT_ARGUMENTS:
+        if argument in axes:
+            scripts = axes[argument]
+            if not isinstance(scripts, list):
+                scripts = [scripts]
+            axes[argument] = [
+                None if script is None else os.path.join(base_dir, script)
+                for script in scripts]
+    return base_dir, matrix
+
+
+def _write_matrix_cloud_configs(matrix_file, defaults=None):
+    """
+    Write a cloud-config file for every combination in a build matrix file.
+
+    Script and output paths in the matrix file are relative to the directory
+    containing it.  Each distinct script is only read and encoded once, and
+    the template is only rendered once for each distinct set of template
+    arguments.  Returns the list of paths written.
+
+    :param matrix_file:
+        The path to a YAML matrix file; see _expand_matrix for its format.
+    :param defaults:
+        An (optional) dict of _write_cloud_config keyword arguments that apply
+        to every combination, unless overridden by the matrix.
+    """
+    base_dir, matrix = _load_matrix(matrix_file)
+    cache = {}
+    paths = []
+    for path, kwargs in _expand_matrix(matrix, defaults):
+        path = os.path.join(base_dir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as output_file:
+            _write_cloud_config(output_file, cache=cache, **kwargs)
+        paths.append(path)
+    return paths
+
+
+DEFAULT_RENDER_CACHE_SIZE = 100
+
+
+def _get_file_sha256(path):
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def _get_render_cache_key(kwargs):
+    """
+    Return the key under which a render is cached: a hash of the (canonical
+    JSON of the) _write_cloud_config arguments, the SHA256 of each local file
+    or directory they refer to, and of this generator itself.
+
+    :param kwargs:
+        The _write_cloud_config keyword arguments to be rendered.
+    """
+    file_checksums = {}
+    for argument in MATRIX_SCRIPT_ARGUMENTS + ('launchpad_buildd',):
+        path = kwargs.get(argument)
+        if path is None or path.startswith(('http://', 'https://')):
+            continue
+        if os.path.isdir(path):
+            file_checksums[argument] = hashlib.sha256(
+                _get_customisation_dir_archive(path)).hexdigest()
+        elif os.path.exists(path):
+            file_checksums[argument] = _get_file_sha256(path)
+    key_material = json.dumps(
+        {'arguments': kwargs, 'files': file_checksums,
+         'generator': _get_file_sha256(__file__)},
+        sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(key_material.encode('utf-8')).hexdigest()
+
+
+def _evict_render_cache(cache_dir, max_size):
+    """
+    Remove the least recently used renders from a render cache until it is
+    no larger than max_size bytes.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.yaml'):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:  # Removed by a concurrent eviction
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total_size -= size
+
+
+def _write_cloud_config_cached(output_file, cache_dir,
+                               cache_size=DEFAULT_RENDER_CACHE_SIZE,
+                               verify=False, **kwargs):
+    """
+    Write an image building cloud-config file, reusing a previous render of
+    the same inputs from an on-disk cache if there is one.
+
+    Configs which look up base image checksums (i.e. use base_image_cache)
+    depend on upstream state, so are always rendered afresh.
+
+    Returns True if a cached render was used.
+
+    :param output_file:
+        An open file object to write the output to.
+    :param cache_dir:
+        The directory to keep rendered configs in.
+    :param cache_size:
+        The maximum total size of cached renders, in MiB; the least recently
+        used renders are evicted to keep the cache under it.
+    :param verify:
+        If True, configs are rendered even when cached, and a ValueError is
+        raised (and the cache entry removed) if the cached render differs.
+    :param kwargs:
+        The arguments to pass to _write_cloud_config.
+    """
+    if kwargs.get('base_image_cache') is not None:
+        _write_cloud_config(output_file, **kwargs)
+        return False
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    path = os.path.join(cache_dir,
+                        _get_render_cache_key(kwargs) + '.yaml')
+    try:
+        with open(path, 'rb') as f:
+            cached = f.read()
+    except (IOError, OSError):
+        cached = None
+    if cached is not None and not verify:
+        # Mark the render as recently used
+        os.utime(path, None)
+        output_string = cached.decode('utf-8')
+        if kwargs.get('user_data_limit') is not None:
+            print(_format_size_report(output_string,
+                                      kwargs['user_data_limit']),
+                  file=sys.stderr)
+        _write_pieces(output_file, [output_string])
+        return True
+    fresh = io.BytesIO()
+    _write_cloud_config(fresh, **kwargs)
+    fresh = fresh.getvalue()
+    if cached is None:
+        partial_path = '{}.{}.part'.format(path, os.getpid())
+        with open(partial_path, 'wb') as f:
+            f.write(fresh)
+        os.rename(partial_path, path)
+        _evict_render_cache(cache_dir, cache_size * 1024 * 1024)
+    elif cached != fresh:
+        os.remove(path)
+        raise ValueError('The cached render in {} differs from a fresh '
+                         'render of the same inputs; it has been '
+                         'removed.'.format(path))
+    else:
+        os.utime(path, None)
+    _write_pieces(output_file, [fresh.decode('utf-8')])
+    return cached is not None
+
+
+IMAGE_PPA_PATTERN = re.compile(
+    r'^[a-z0-9][a-z0-9.+-]*/[a-z0-9][a-z0-9.+-]*(:-?[0-9]+)?$')
+PPA_PATTERN = re.compile(r'^ppa:[a-z0-9][a-z0-9.+-]*/[a-z0-9][a-z0-9.+-]*$')
+PPA_KEY_PATTERN = re.compile(r'^(0x)?([0-9A-Fa-f]{8}|[0-9A-Fa-f]{16}|'
+                             r'[0-9A-Fa-f]{40})$')
+SHELLS = ('sh', 'dash', 'bash')
+
+
+def _check_shell_syntax(content, name):
+    """
+    Check the syntax of a (hook) script with its shell's -n option.
+
+    Returns a list of diagnostics; scripts for other interpreters are not
+    checked.
+    """
+    if not isinstance(content, bytes):
+        content = content.encode('utf-8')
+    first_line = content.split(b'\n', 1)[0].decode('utf-8', 'replace')
+    if not first_line.startswith('#!'):
+        return ['{}: has no "#!" line, so cannot be run as a hook'.format(
+            name)]
+    interpreter = first_line[2:].split()
+    if not interpreter:
+        return ['{}: has an empty "#!" line'.format(name)]
+    shell = os.path.basename(interpreter[0])
+    if shell == 'env' and len(interpreter) > 1:
+        shell = interpreter[1]
+    if shell not in SHELLS:
+        return []
+    process = subprocess.Popen([shell, '-n'], stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    _, stderr = process.communicate(content)
+    if process.returncode == 0:
+        return []
+    return ['{}: {}'.format(name, line.replace('{}: '.format(shell), '', 1))
+            for line in stderr.decode('utf-8', 'replace').splitlines()]
+
+
+def _get_write_files_content(stanza):
+    content = base64.b64decode(stanza['content'])
+    if stanza.get('encoding') == 'gz+b64':
+        content = gzip.GzipFile(fileobj=io.BytesIO(content)).read()
+    return content
+
+
+def _check_build_config(**kwargs):
+    """
+    Lint the arguments for a cloud-config, without network access.
+
+    This checks the formats of PPAs and pins, that scripts exist and are not
+    empty, and that a binary hook filter matches some known hooks; it then
+    renders the cloud-config and checks that it fits in any user-data limit,
+    that it round-trips as YAML, and that its runcmd and every hook it
+    writes are valid shell.
+
+    Returns a list of diagnostics, which is empty if no problems were found.
+
+    :param kwargs:
+        The _write_cloud_config keyword arguments to check.
+    """
+    diagnostics = []
+    image_ppa = kwargs.get('image_ppa')
+    if image_ppa is not None and not IMAGE_PPA_PATTERN.match(image_ppa):
+        diagnostics.append(
+            '--image-ppa: {!r} is not of the form OWNER/NAME or '
+            'OWNER/NAME:PIN_PRIORITY (e.g. "foo/bar:1001")'.format(
+                image_ppa))
+    build_ppa = kwargs.get('build_ppa')
+    build_ppa_key = kwargs.get('build_ppa_key')
+    if build_ppa is not None:
+        if build_ppa.startswith('https://'):
+            if 'private-ppa' not in build_ppa:
+                diagnostics.append(
+                    '--build-ppa: {!r} is not a private PPA URL (on '
+                    'private-ppa.launchpad.net); use "ppa:OWNER/NAME" for '
+                    'public PPAs'.format(build_ppa))
+            elif build_ppa_key is None:
+                diagnostics.append('--build-ppa-key: must be given for the '
+                                   'private PPA {!r}'.format(build_ppa))
+        elif not PPA_PATTERN.match(build_ppa):
+            diagnostics.append('--build-ppa: {!r} is not of the form '
+                               '"ppa:OWNER/NAME"'.format(build_ppa))
+    if build_ppa_key is not None and not PPA_KEY_PATTERN.match(
+            build_ppa_key):
+        diagnostics.append('--build-ppa-key: {!r} is not a hexadecimal key '
+                           'ID or fingerprint'.format(build_ppa_key))
+    apt_proxy = kwargs.get('apt_proxy')
+    if apt_proxy is not None and not apt_proxy.startswith(
+            ('http://', 'https://')):
+        diagnostics.append('--apt-proxy: {!r} is not an http:// or https:// '
+                           'URL'.format(apt_proxy))
+    for argument in ('customisation_script', 'binary_customisation_script'):
+        script = kwargs.get(argument)
         if script is None:
             continue
-        with open(script, 'rb') as f:
-            content = f.read().decode('utf-8')
-        if not content:
+        option = '--' + argument.replace('_', '-')
+        if not os.path.isfile(script):
+            diagnostics.append('{}: {} does not exist'.format(option, script))
+        elif not _read_script(script).strip():
+            diagnostics.append('{}: {} is empty, so would not be '
+                               'run'.format(option, script))
+        else:
+            with open(script, 'rb') as f:
+                diagnostics.extend(_check_shell_syntax(f.read(), script))
+    customisation_dir = kwargs.get('customisation_dir')
+    if customisation_dir is not None:
+        try:
+            _get_customisation_dir_archive(customisation_dir)
+        except ValueError as e:
+            diagnostics.append('--customisation-dir: {}'.format(e))
+        else:
+            for name in sorted(os.listdir(customisation_dir)):
+                path = os.path.join(customisation_dir, name)
+                if (os.path.isfile(path) and name.rsplit('.', 1)[-1]
+                        in CUSTOMISATION_DIR_HOOK_TYPES):
+                    with open(path, 'rb') as f:
+                        diagnostics.extend(_check_shell_syntax(f.read(),
+                                                               path))
+    binary_hook_filter = kwargs.get('binary_hook_filter')
+    projects = kwargs.get('projects') or [DEFAULT_PROJECT]
+    if binary_hook_filter is not None and set(projects) == {'ubuntu-cpc'}:
+        # Matched as the filter hook would match them
+        matches = subprocess.Popen(
+            ['sh', '-c', 'for hook in "$@"; do case $hook in {}) '
+             'echo $hook;; esac; done'.format(binary_hook_filter), 'sh']
+            + list(UBUNTU_CPC_BINARY_HOOKS),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0]
+        if not matches.strip():
+            diagnostics.append(
+                '--binary-hook-filter: {!r} matches none of the known '
+                'ubuntu-cpc binary hooks, so all of them would be '
+                'skipped'.format(binary_hook_filter))
+    if diagnostics:
+        return diagnostics
+
+    # Base image checksums are looked up over the network, so aren't checked;
+    # the user-data limit is checked below, alongside everything else
+    render_kwargs = dict(kwargs, base_image_cache=None, user_data_limit=None)
+    output = io.BytesIO()
+    try:
+        _write_cloud_config(output, **render_kwargs)
+    except (ValueError, IOError, OSError) as e:
+        return ['{}'.format(e)]
+    output_string = output.getvalue().decode('utf-8')
+    user_data_limit = kwargs.get('user_data_limit')
+    if (user_data_limit is not None
+            and len(output.getvalue()) > user_data_limit):
+        diagnostics.append(
+            '--user-data-limit: the cloud-config is {} bytes, which exceeds '
+            'the limit of {} bytes'.format(len(output.getvalue()),
+                                           user_data_limit))
+    if kwargs.get('worker_job') is not None:
+        return diagnostics + _check_shell_syntax(output_string, 'job script')
+    try:
+        cloud_config = yaml.safe_load(output_string)
+    except yaml.YAMLError as e:
+        return diagnostics + ['cloud-config is not valid YAML: {}'.format(e)]
+    if not isinstance(cloud_config, dict) or 'runcmd' not in cloud_config:
+        return diagnostics + ['cloud-config does not contain a runcmd '
+                              'section']
+    if yaml.safe_load(yaml.safe_dump(cloud_config)) != cloud_config:
+        diagnostics.append('cloud-config does not round-trip as YAML')
+    runcmd = '#!/bin/sh\n' + ''.join(
+        '{}\n'.format(command) for command in cloud_config['runcmd'])
+    diagnostics.extend(_check_shell_syntax(runcmd, 'runcmd'))
+    for stanza in cloud_config.get('write_files') or []:
+        if '/hooks/' not in stanza['path'] and not stanza['path'].endswith(
+                '.sh'):
             continue
-        if hook_type == 'chroot':
-            write_files_stanzas.append(_produce_write_files_stanza(
-                content=SETUP_CONTENT, hook_type=hook_type, sequence=9997,
-                homedir=homedir))
-            write_files_stanzas.append(_produce_write_files_stanza(
-                content=TEARDOWN_CONTENT, hook_type=hook_type, sequence=9999,
-                homedir=homedir))
-        write_files_stanzas.append(_produce_write_files_stanza(
-            content=content, hook_type=hook_type, sequence=9998,
-            homedir=homedir))
-    if binary_hook_filter is not None:
-        write_files_stanzas.append(_produce_write_files_stanza(
-            content=BINARY_HOOK_FILTER_CONTENT.format(binary_hook_filter),
-            hook_type='binary',
-            sequence=0,
-            homedir=homedir))
-    if write_files_stanzas:
-        output_string += '\nwrite_files:\n'
-        for stanza in write_files_stanzas:
-            output_string += stanza
-    output_file.write(output_string)
+        content = _get_write_files_content(stanza)
+        if os.path.basename(stanza['path']).startswith(
+                '9998-{}.'.format(CUSTOMISATION_DIR_HOOK_NAME)):
+            # Only check the script, not the archive appended to it
+            content = b'\n'.join(content.split(b'\n')[
+                :CUSTOMISATION_DIR_HOOK_TEMPLATE.count('\n')])
+        diagnostics.extend(_check_shell_syntax(content, stanza['path']))
+    return diagnostics
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('outfile', nargs='?', type=argparse.FileType('w'),
-                        default=sys.stdout)
+    parser.add_argument('outfile', nargs='?')
+    parser.add_argument('--apt-cache-local', dest='apt_cache_local',
+                        action='store_true',
+                        help='Install a caching apt proxy on the build '
+                        'instance, and use it for apt both on the instance '
+                        'and in the build chroot.')
+    parser.add_argument('--apt-proxy', dest='apt_proxy', metavar='URL',
+                        help='The URL of an HTTP proxy (e.g. a shared apt '
+                        'cache) to use for apt both on the build instance '
+                        'and in the build chroot.')
+    parser.add_argument('--arch', dest='architectures', action='append',
+                        metavar='ARCH',
+                        help='An architecture to build images for; may be '
+                        'given more than once, in which case the builds for '
+                        'each architecture are run concurrently.  Defaults '
+                        'to amd64.')
+    parser.add_argument('--artifact-manifest', dest='artifact_manifest',
+                        action='store_true',
+                        help='Checksum the built images, and write a '
+                        'manifest of their names, sizes and SHA256 '
+                        'checksums to manifest.json alongside them.')
+    parser.add_argument('--artifacts', dest='artifacts',
+                        type=_parse_artifacts, metavar='ARTIFACT[,...]',
+                        help='A comma-separated list of the artifacts to '
+                        'build (from {}).  The binary hooks which only '
+                        'produce other artifacts are skipped.  Defaults to '
+                        'building all artifacts.'.format(
+                            ', '.join(sorted(ARTIFACT_HOOKS))))
+    parser.add_argument('--base-image-cache', dest='base_image_cache',
+                        metavar='DIR',
+                        help='A path on the build instance (e.g. a mounted '
+                        'volume) in which to cache base images between '
+                        'builds, or the URL of an HTTP mirror of such a '
+                        'cache.  The base image is only downloaded if a copy '
+                        'matching the upstream SHA256SUMS is not found.')
     parser.add_argument('--binary-customisation-script',
                         dest='binary_custom_script',
                         help='A path to a script which will be run outside of'
@@ -263,15 +3066,185 @@ def main():
                         help='A glob which will be used to remove binary'
                         ' hooks from within the build chroot.  If not'
                         ' specified, no binary hooks will be removed.')
+    parser.add_argument('--check', dest='check', action='store_true',
+                        help='Check the given options, scripts and the '
+                        'resulting cloud-config for problems (without '
+                        'network access), instead of writing it.  Exits '
+                        'non-zero if any are found.')
+    parser.add_argument('--chroot-snapshot-dir', dest='chroot_snapshot_dir',
+                        metavar='DIR',
+                        help='A path on the build instance (e.g. on a '
+                        'mounted volume) in which to keep snapshots of '
+                        'updated build chroots.  Later builds for the same '
+                        'series, architecture and build PPA on the same day '
+                        'will start from a snapshot, skipping the chroot '
+                        'unpack and update.')
+    parser.add_argument('--chroot-storage', dest='chroot_storage',
+                        choices=CHROOT_STORAGE_MODES,
+                        help='Where to put the build chroot: on disk (the '
+                        'default), on tmpfs or zram, or "auto", which uses '
+                        'RAM-backed storage if the instance has enough '
+                        'memory available when the build starts.')
+    parser.add_argument('--chroot-storage-size', dest='chroot_storage_size',
+                        type=int, metavar='MIB',
+                        help='The size of RAM-backed build chroots, in MiB. '
+                        'Defaults to {}.'.format(
+                            DEFAULT_CHROOT_STORAGE_SIZE))
+    parser.add_argument('--compress-artifacts', dest='compress_artifacts',
+                        choices=sorted(ARTIFACT_COMPRESSORS),
+                        help='Compress the built images (that are not '
+                        'already compressed) with a multi-threaded '
+                        'compressor, and write a manifest of them as for '
+                        '--artifact-manifest.')
+    parser.add_argument('--compress-payloads', dest='compress_payloads',
+                        action='store_true',
+                        help='Gzip the files (e.g. customisation scripts) '
+                        'embedded in the cloud-config, to fit it in to '
+                        'smaller user-data limits.')
+    parser.add_argument('--compression-level', dest='compression_level',
+                        type=int, metavar='LEVEL',
+                        help='The level at which to --compress-artifacts.  '
+                        'Defaults to {}.'.format(', '.join(
+                            '{} for {}'.format(default, compressor)
+                            for compressor, (_, _, default)
+                            in sorted(ARTIFACT_COMPRESSORS.items()))))
+    parser.add_argument('--customisation-dir', dest='customisation_dir',
+                        metavar='DIR',
+                        help='A directory of hooks (files ending in .chroot '
+                        'or .binary, run in sorted order) and any assets '
+                        'they need, which will be packed in to the '
+                        'cloud-config as a single archive.')
+    parser.add_argument('--customization-dir', dest='customisation_dir',
+                        help=argparse.SUPPRESS)
     parser.add_argument('--customisation-script', dest='custom_script',
                         help='A path to a script which will be run within'
                         ' the image chroot, to modify the content within the'
                         ' images produced.')
     parser.add_argument('--customization-script',
                         dest='custom_script', help=argparse.SUPPRESS)
+    parser.add_argument('--grub-probe-shim', dest='grub_probe_shim',
+                        choices=GRUB_PROBE_SHIMS,
+                        help='How to stand in for grub-probe while chroot '
+                        'hooks run: "full" (the default) or "fast" stand-ins, '
+                        '"none" if the hooks don\'t touch kernels or '
+                        'bootloaders, or "auto" to use none unless they look '
+                        'like they might.')
     parser.add_argument('--homedir', dest='homedir', metavar='PATH',
                         help='The path within the image where the build should'
                         ' be done')
+    parser.add_argument('--instrument', dest='instrument',
+                        action='store_true',
+                        help='Time each phase of the build, and write the '
+                        'timings to timings.json alongside the images.')
+    parser.add_argument('--launchpad-buildd', dest='launchpad_buildd',
+                        metavar='TARBALL',
+                        help='A path to, or URL of, a tarball of a '
+                        'launchpad-buildd tree (e.g. from "bzr export") to '
+                        'use instead of branching launchpad-buildd from '
+                        'Launchpad.  Local tarballs are embedded in the '
+                        'generated config.')
+    parser.add_argument('--launchpad-buildd-sha256',
+                        dest='launchpad_buildd_sha256', metavar='SHA256',
+                        help='The SHA256 checksum of the launchpad-buildd '
+                        'tarball; required if --launchpad-buildd is a URL.')
+    parser.add_argument('--matrix', dest='matrix', metavar='MATRIX_FILE',
+                        help='A path to a YAML build matrix; one config will '
+                        'be written for each combination of the arguments it '
+                        'lists, instead of writing a single config to '
+                        'outfile.  Other options given on the command line '
+                        'apply to every combination.')
+    parser.add_argument('--offline-bundle', dest='offline_bundle',
+                        metavar='PATH_OR_URL',
+                        help='The path on the build instance (or the URL on '
+                        'a local mirror) of a bundle made by '
+                        'make_offline_bundle, from which to take the base '
+                        'images, launchpad-buildd and private PPA signing '
+                        'key instead of downloading them.')
+    parser.add_argument('--parallel-builds', dest='parallel_builds',
+                        type=int, metavar='N',
+                        help='The maximum number of builds to run at once '
+                        'when building several architectures or projects.  '
+                        'By default, all of them are run at once.')
+    parser.add_argument('--prefetch', dest='prefetch', action='store_true',
+                        help='Fetch the base images, launchpad-buildd and '
+                        'private PPA signing key in parallel (with retries '
+                        'and checksum verification) before the build '
+                        'starts.')
+    parser.add_argument('--progress-log', dest='progress_log', metavar='PATH',
+                        help='A path on the build instance to which to '
+                        'append progress events, as lines of JSON, as the '
+                        'build runs.  Follow them with '
+                        'follow_build_progress.')
+    parser.add_argument('--project', dest='projects', action='append',
+                        metavar='PROJECT',
+                        help='A livecd-rootfs project to build images for; '
+                        'may be given more than once.  Defaults to '
+                        'ubuntu-cpc.')
+    parser.add_argument('--publish-chunk-size', dest='publish_chunk_size',
+                        type=int, metavar='MIB',
+                        help='Publish images larger than this in chunks, '
+                        'which are uploaded concurrently.  By default, '
+                        'images are published whole.')
+    parser.add_argument('--publish-jobs', dest='publish_jobs', type=int,
+                        metavar='N',
+                        help='The number of uploads to run at once when '
+                        'publishing.  Defaults to {}.'.format(
+                            DEFAULT_PUBLISH_JOBS))
+    parser.add_argument('--publish-url', dest='publish_url', metavar='URL',
+                        help='An HTTP(S) URL (e.g. of an S3-compatible '
+                        'bucket) to PUT the images under once the builds '
+                        'have finished; published.json is uploaded last, '
+                        'to signal that they are all there.')
+    parser.add_argument('--render-cache', dest='render_cache', metavar='DIR',
+                        help='A directory in which to cache rendered '
+                        'configs; a config whose options (and scripts) match '
+                        'an earlier render is copied from the cache.')
+    parser.add_argument('--render-cache-size', dest='render_cache_size',
+                        type=int, metavar='MIB',
+                        default=DEFAULT_RENDER_CACHE_SIZE,
+                        help='The maximum size of the render cache, beyond '
+                        'which the least recently used renders are removed. '
+                        ' Defaults to {} MiB.'.format(
+                            DEFAULT_RENDER_CACHE_SIZE))
+    parser.add_argument('--render-cache-verify', dest='render_cache_verify',
+                        action='store_true',
+                        help='Render configs even if they are cached, and '
+                        'fail if the cached render differs.')
+    parser.add_argument('--series', dest='series',
+                        choices=sorted(BASE_IMAGE_URLS),
+                        help='The series to build images of.  Defaults to '
+                        '{}.'.format(DEFAULT_SERIES))
+    parser.add_argument('--squashfs-block-size', dest='squashfs_block_size',
+                        type=int, metavar='KIB',
+                        help='The block size of the squashfses built (a '
+                        'power of two from 4 to 1024), in place of the one '
+                        'livecd-rootfs uses.')
+    parser.add_argument('--squashfs-compressor', dest='squashfs_compressor',
+                        choices=sorted(SQUASHFS_COMPRESSORS),
+                        help='The compressor for the squashfses built, in '
+                        'place of the one livecd-rootfs uses; e.g. lz4 for '
+                        'faster builds of larger images.')
+    parser.add_argument('--unsquashfs-processors',
+                        dest='unsquashfs_processors',
+                        type=_parse_unsquashfs_processors, metavar='N|auto',
+                        help='The number of processors to unpack each base '
+                        'image with, or "auto" to share the CPUs between the '
+                        'builds running at once.  By default, each uses '
+                        'every CPU.')
+    parser.add_argument('--user-data-limit', dest='user_data_limit',
+                        type=_parse_user_data_limit, metavar='CLOUD|BYTES',
+                        help='Print a report of the size of the cloud-config '
+                        'to stderr, and fail if it is larger than the given '
+                        'number of bytes, or than the user-data limit of the '
+                        'given cloud (one of {}).'.format(
+                            ', '.join(sorted(USER_DATA_LIMITS))))
+    parser.add_argument('--worker', dest='worker', action='store_true',
+                        help='Only set up the instance, and start a worker '
+                        'on it which runs the jobs written with --worker-job '
+                        'and put in its queue.')
+    parser.add_argument('--worker-job', dest='worker_job', metavar='NAME',
+                        help='Write a build job for a worker, to put in its '
+                        'queue as NAME.sh, instead of a cloud-config.')
     parser.add_argument('--build-ppa', dest='build_ppa', help='The URL of a '
                         'PPA to inject in the build chroot. This can be '
                         'either a ppa:<user>/<ppa> short URL or an https:// '
@@ -288,14 +3261,79 @@ def main():
                         'absence of "~".')
     args = parser.parse_args()
 
-    _write_cloud_config(args.outfile,
-                        homedir=args.homedir,
-                        customisation_script=args.custom_script,
-                        binary_customisation_script=args.binary_custom_script,
-                        binary_hook_filter=args.binary_hook_filter,
-                        build_ppa=args.build_ppa,
-                        build_ppa_key=args.build_ppa_key,
-                        image_ppa=args.image_ppa)
+    kwargs = dict(apt_cache_local=args.apt_cache_local,
+                  apt_proxy=args.apt_proxy,
+                  architectures=args.architectures,
+                  artifact_manifest=args.artifact_manifest,
+                  artifacts=args.artifacts,
+                  base_image_cache=args.base_image_cache,
+                  homedir=args.homedir,
+                  customisation_dir=args.customisation_dir,
+                  customisation_script=args.custom_script,
+                  grub_probe_shim=args.grub_probe_shim,
+                  binary_customisation_script=args.binary_custom_script,
+                  binary_hook_filter=args.binary_hook_filter,
+                  build_ppa=args.build_ppa,
+                  build_ppa_key=args.build_ppa_key,
+                  chroot_snapshot_dir=args.chroot_snapshot_dir,
+                  chroot_storage=args.chroot_storage,
+                  chroot_storage_size=args.chroot_storage_size,
+                  compress_artifacts=args.compress_artifacts,
+                  compress_payloads=args.compress_payloads,
+                  compression_level=args.compression_level,
+                  image_ppa=args.image_ppa,
+                  instrument=args.instrument,
+                  launchpad_buildd=args.launchpad_buildd,
+                  launchpad_buildd_sha256=args.launchpad_buildd_sha256,
+                  offline_bundle=args.offline_bundle,
+                  parallel_builds=args.parallel_builds,
+                  prefetch=args.prefetch,
+                  progress_log=args.progress_log,
+                  projects=args.projects,
+                  publish_chunk_size=args.publish_chunk_size,
+                  publish_jobs=args.publish_jobs,
+                  publish_url=args.publish_url,
+                  series=args.series,
+                  squashfs_block_size=args.squashfs_block_size,
+                  squashfs_compressor=args.squashfs_compressor,
+                  unsquashfs_processors=args.unsquashfs_processors,
+                  user_data_limit=args.user_data_limit,
+                  worker=args.worker,
+                  worker_job=args.worker_job)
+    if args.matrix is not None:
+        if args.outfile is not None:
+            parser.error('outfile cannot be used with --matrix')
+        if args.render_cache is not None:
+            parser.error('--render-cache cannot be used with --matrix')
+        if args.check:
+            parser.error('--check cannot be used with --matrix')
+        _write_matrix_cloud_configs(args.matrix, defaults=kwargs)
+        return
+    if args.check:
+        diagnostics = _check_build_config(**kwargs)
+        for diagnostic in diagnostics:
+            print(diagnostic, file=sys.stderr)
+        sys.exit(1 if diagnostics else 0)
+
+    def render(outfile):
+        if args.render_cache is not None:
+            _write_cloud_config_cached(
+                outfile, args.render_cache,
+                cache_size=args.render_cache_size,
+                verify=args.render_cache_verify, **kwargs)
+        else:
+            _write_cloud_config(outfile, **kwargs)
+
+    if args.outfile in (None, '-'):
+        render(sys.stdout)
+        return
+    # Only opened now, so that --check and --matrix leave it untouched
+    try:
+        outfile = open(args.outfile, 'w')
+    except (IOError, OSError) as e:
+        parser.error("can't open '{}': {}".format(args.outfile, e))
+    with outfile:
+        render(outfile)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+"""
+Run cloud-configs generated by ``generate_build_config`` in systemd-nspawn
+or LXD containers on this host, instead of on cloud instances.
+"""
+from __future__ import print_function
+
+import argparse
+import base64
+import glob
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+
+import yaml
+
+from generate_build_config import _get_write_files_content
+
+try:
+    from shlex import quote
+except ImportError:  # Python 2
+    from pipes import quote
+
+
+BACKENDS = ('lxd', 'nspawn')
+DEFAULT_HOMEDIR = '/home/ubuntu'
+DEFAULT_LXD_IMAGE = 'ubuntu:16.04'
+PROVISION_PATH = '/root/provision.sh'
+RUNCMD_PATH = '/root/runcmd.sh'
+
+# Builds mount filesystems, set up loop devices and register binfmt
+# handlers, so need privileged containers, with access to the loop devices
+# (block major 7) and /dev/loop-control.
+LOOP_DEVICE_GLOB = '/dev/loop[0-9]*'
+LOOP_DEVICES_ALLOW = ['b 7:* rwm', 'c 10:237 rwm']
+LXD_CONFIG = {
+    'security.privileged': 'true',
+    'security.nesting': 'true',
+}
+LXD_RAW_LXC = ['lxc.apparmor.profile = unconfined']
+NSPAWN_OPTIONS = ['--capability=all', '--bind=/dev/loop-control',
+                  '--property=DeviceAllow=block-loop rwm',
+                  '--property=DeviceAllow=/dev/loop-control rwm']
+# Only present on hosts using the unified (v2) cgroup hierarchy
+CGROUP2_CONTROLLERS = '/sys/fs/cgroup/cgroup.controllers'
+
+PROVISION_TEMPLATE = """\
+#!/bin/sh -eu
+# Provisions a container as cloud-init would an instance: writes files,
+# installs packages, then runs the runcmd script.
+export DEBIAN_FRONTEND=noninteractive
+{write_files}
+{packages}
+cat <<"RUNCMD" > {runcmd_path}
+#!/bin/sh
+{runcmd}
+RUNCMD
+exec sh {runcmd_path}
+"""
+
+WRITE_FILE_TEMPLATE = """\
+mkdir -p {directory}
+base64 -d <<"PAYLOAD" > {path}
+{content}
+PAYLOAD
+chmod {permissions} {path}"""
+
+PACKAGES_TEMPLATE = """\
+apt-get update -q
+apt-get install -qy {packages}"""
+
+
+def _get_homedir(cloud_config):
+    """
+    Return the build home directory that a cloud-config uses.
+    """
+    for command in cloud_config.get('runcmd') or []:
+        if (not isinstance(command, list)
+                and command.startswith('export HOME=')):
+            return command[len('export HOME='):]
+    return DEFAULT_HOMEDIR
+
+
+def _get_provision_script(cloud_config):
+    """
+    Produce a shell script which does what cloud-init would with a
+    cloud-config: writes its write_files, installs its packages, and runs
+    its runcmd entries (in a single script, as cloud-init does).
+    """
+    write_files = []
+    for stanza in cloud_config.get('write_files') or []:
+        if 'encoding' in stanza:
+            content = _get_write_files_content(stanza)
+        else:
+            content = stanza['content'].encode('utf-8')
+        path = quote(stanza['path'])
+        write_files.append(WRITE_FILE_TEMPLATE.format(
+            content=base64.b64encode(content).decode('utf-8'),
+            directory=quote(os.path.dirname(stanza['path'])), path=path,
+            permissions=stanza.get('permissions', '0644')))
+        if 'owner' in stanza:
+            write_files.append('chown {} {}'.format(
+                quote(stanza['owner']), path))
+    packages = ''
+    if cloud_config.get('packages'):
+        packages = PACKAGES_TEMPLATE.format(packages=' '.join(
+            quote(package) for package in cloud_config['packages']))
+    runcmd = [
+        ' '.join(quote(arg) for arg in command)
+        if isinstance(command, list) else command
+        for command in cloud_config.get('runcmd') or []]
+    return PROVISION_TEMPLATE.format(packages=packages,
+                                     runcmd='\n'.join(runcmd),
+                                     runcmd_path=RUNCMD_PATH,
+                                     write_files='\n'.join(write_files))
+
+
+def _get_loop_devices():
+    """
+    Return the loop devices on this host, which are bound in to containers
+    (whose /dev would otherwise have none for losetup to use).
+    """
+    return sorted(glob.glob(LOOP_DEVICE_GLOB),
+                  key=lambda path: int(path[len('/dev/loop'):]))
+
+
+def _get_lxd_config():
+    """
+    Return the configuration of LXD build containers; the keys which allow
+    the loop devices depend on the cgroup version of this host.
+    """
+    key = 'lxc.cgroup2.devices.allow' if os.path.exists(
+        CGROUP2_CONTROLLERS) else 'lxc.cgroup.devices.allow'
+    config = dict(LXD_CONFIG)
+    config['raw.lxc'] = '\n'.join(
+        ['{} = {}'.format(key, allow) for allow in LOOP_DEVICES_ALLOW]
+        + LXD_RAW_LXC)
+    return config
+
+
+def _get_lxd_commands(name, script_path, homedir, output_dir=None,
+                      image=DEFAULT_LXD_IMAGE, keep=False):
+    """
+    Return the commands which run a provisioning script in a new LXD
+    container, and (unless keep is True) the command which deletes the
+    container afterwards, whether or not the others succeed.
+    """
+    launch = ['lxc', 'launch', image, name]
+    for key, value in sorted(_get_lxd_config().items()):
+        launch.extend(['-c', '{}={}'.format(key, value)])
+    commands = [launch]
+    for path in _get_loop_devices():
+        commands.append([
+            'lxc', 'config', 'device', 'add', name, os.path.basename(path),
+            'unix-block', 'path={}'.format(path)])
+    if output_dir is not None:
+        commands.append([
+            'lxc', 'config', 'device', 'add', name, 'images', 'disk',
+            'source={}'.format(os.path.abspath(output_dir)),
+            'path={}/images'.format(homedir)])
+    commands.extend([
+        # Wait for the container's network before provisioning it
+        ['lxc', 'exec', name, '--', 'sh', '-c',
+         'for i in $(seq 60); do getent hosts archive.ubuntu.com && exit; '
+         'sleep 1; done; exit 1'],
+        ['lxc', 'file', 'push', script_path,
+         '{}{}'.format(name, PROVISION_PATH)],
+        ['lxc', 'exec', name, '--', 'sh', PROVISION_PATH],
+    ])
+    cleanup = None if keep else ['lxc', 'delete', '--force', name]
+    return commands, cleanup
+
+
+def _get_nspawn_commands(name, script_path, homedir, output_dir=None,
+                         directory=None, keep=False):
+    """
+    Return the commands which run a provisioning script in a systemd-nspawn
+    container of a root filesystem directory; unless keep is True, the
+    container is ephemeral (so the directory is left untouched).
+    """
+    command = ['systemd-nspawn', '--quiet', '--directory', directory,
+               '--machine', name] + NSPAWN_OPTIONS + [
+                   '--bind={}'.format(path) for path in _get_loop_devices()
+               ] + ['--bind-ro={}:{}'.format(os.path.abspath(script_path),
+                                             PROVISION_PATH)]
+    if not keep:
+        command.append('--ephemeral')
+    if output_dir is not None:
+        command.append('--bind={}:{}/images'.format(
+            os.path.abspath(output_dir), homedir))
+    command.extend(['sh', PROVISION_PATH])
+    return [command], None
+
+
+def _run_build(config_path, name, backend, output_dir=None, log=None,
+               **backend_kwargs):
+    """
+    Run a cloud-config in a new container, returning True if it succeeded
+    (and, if output_dir is given, produced images).
+
+    :param config_path:
+        The path of the cloud-config to run.
+    :param name:
+        The name of the container to run it in.
+    :param backend:
+        The container backend (one of BACKENDS) to use.
+    :param output_dir:
+        An (optional) directory on this host to bind to the images
+        directory in the container, so that the images are kept.
+    :param log:
+        An (optional) open file to which to write the build's output.
+    :param backend_kwargs:
+        Further arguments for the backend (e.g. the image or directory to
+        run the container from).
+    """
+    with open(config_path) as f:
+        cloud_config = yaml.safe_load(f)
+    homedir = _get_homedir(cloud_config)
+    if output_dir is not None and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    get_commands = {'lxd': _get_lxd_commands,
+                    'nspawn': _get_nspawn_commands}[backend]
+    handle, script_path = tempfile.mkstemp(prefix='provision-',
+                                           suffix='.sh')
+    try:
+        with os.fdopen(handle, 'w') as f:
+            f.write(_get_provision_script(cloud_config))
+        commands, cleanup = get_commands(name, script_path, homedir,
+                                         output_dir=output_dir,
+                                         **backend_kwargs)
+        try:
+            for command in commands:
+                if subprocess.call(command, stdout=log, stderr=log) != 0:
+                    return False
+        finally:
+            if cleanup is not None:
+                subprocess.call(cleanup, stdout=log, stderr=log)
+    finally:
+        os.unlink(script_path)
+    # runcmd's exit status is only that of its last command, so also check
+    # that the builds produced something
+    return output_dir is None or any(
+        filename.startswith('livecd.')
+        for _, _, filenames in os.walk(output_dir) for filename in filenames)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('configs', metavar='CONFIG', nargs='+',
+                        help='A cloud-config to run.')
+    parser.add_argument('--backend', dest='backend', choices=BACKENDS,
+                        default='lxd',
+                        help='How to run the containers.  Defaults to '
+                        '%(default)s.')
+    parser.add_argument('--directory', dest='directory', metavar='DIR',
+                        help='With the nspawn backend, the Ubuntu root '
+                        'filesystem to run each build in (ephemerally).')
+    parser.add_argument('--image', dest='image', default=DEFAULT_LXD_IMAGE,
+                        help='With the lxd backend, the image to launch each '
+                        'build from.  Defaults to %(default)s.')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+                        metavar='N',
+                        help='The number of builds to run at once.  '
+                        'Defaults to %(default)s.')
+    parser.add_argument('--keep', dest='keep', action='store_true',
+                        help='Keep the containers (or, with the nspawn '
+                        'backend, build in the root filesystem itself), for '
+                        'debugging.')
+    parser.add_argument('--output-dir', dest='output_dir', metavar='DIR',
+                        default='.',
+                        help='The directory in which to put the images (and '
+                        'log) of the build of each CONFIG, in a subdirectory '
+                        'named after it.  Defaults to the current '
+                        'directory.')
+    parser.add_argument('--print-script', dest='print_script',
+                        action='store_true',
+                        help='Only print the script which would provision '
+                        'the container for each CONFIG.')
+    args = parser.parse_args()
+    if args.print_script:
+        for config_path in args.configs:
+            with open(config_path) as f:
+                print(_get_provision_script(yaml.safe_load(f)), end='')
+        return
+    if args.backend == 'nspawn' and args.directory is None:
+        parser.error('--directory must be given with --backend nspawn')
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    backend_kwargs = {'keep': args.keep}
+    if args.backend == 'lxd':
+        backend_kwargs['image'] = args.image
+    else:
+        backend_kwargs['directory'] = args.directory
+
+    bases = [os.path.splitext(os.path.basename(config_path))[0]
+             for config_path in args.configs]
+    builds = []
+    for index, (config_path, base) in enumerate(zip(args.configs, bases)):
+        if bases.count(base) > 1:
+            # Keep the output of configs with the same name apart
+            base = '{}-{}'.format(base, index)
+        builds.append((index, config_path,
+                       'usb-{}-{}'.format(os.getpid(), index),
+                       os.path.join(args.output_dir, base)))
+    # Builds which don't finish (e.g. because they raised) leave None
+    results = [None] * len(builds)
+    slots = threading.Semaphore(args.jobs)
+
+    def run(index, config_path, name, output_dir):
+        with slots:
+            try:
+                if not os.path.isdir(output_dir):
+                    os.makedirs(output_dir)
+                with open(os.path.join(output_dir, 'build.log'), 'w') as log:
+                    results[index] = _run_build(
+                        config_path, name, args.backend,
+                        output_dir=os.path.join(output_dir, 'images'),
+                        log=log, **backend_kwargs)
+            except Exception as e:
+                print('{}: {}'.format(config_path, e), file=sys.stderr)
+                results[index] = False
+        print('{}: {}'.format(config_path, 'succeeded' if results[index]
+                              else 'failed'))
+        sys.stdout.flush()
+
+    threads = [threading.Thread(target=run, args=build) for build in builds]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+Gather the inputs that builds would otherwise download (base images,
+launchpad-buildd and private PPA signing keys) in to a single archive,
+indexed by a SHA256SUMS file, for generate_build_config's --offline-bundle.
+"""
+from __future__ import print_function
+
+import argparse
+import hashlib
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+
+from generate_build_config import (
+    BASE_IMAGE_FILENAME,
+    BASE_IMAGE_URLS,
+    BUILDD_BZR_BRANCH,
+    DEFAULT_SERIES,
+    OFFLINE_BUNDLE_BASE_IMAGE_PATH,
+    OFFLINE_BUNDLE_BUILDD_PATH,
+    OFFLINE_BUNDLE_INDEX,
+    OFFLINE_BUNDLE_PPA_KEY_PATH,
+    PPA_KEY_PATTERN,
+    PPA_KEY_URL_TEMPLATE,
+    _get_base_image_checksum,
+    _get_launchpad_buildd_tarball,
+    _get_ppa_key_id,
+    urlopen,
+)
+
+DEFAULT_ARCHITECTURE = 'amd64'
+
+
+def _sha256(path):
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def _download(path, url, sha256=None):
+    """
+    Download url to path, checking it against sha256 if that is given.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    response = urlopen(url)
+    try:
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(response, f)
+    finally:
+        response.close()
+    if sha256 is not None and _sha256(path) != sha256.lower():
+        raise ValueError('{} does not match its checksum.'.format(url))
+
+
+def _add_launchpad_buildd(path, launchpad_buildd=None,
+                          launchpad_buildd_sha256=None):
+    """
+    Put a launchpad-buildd tarball at path: the one given (as for
+    generate_build_config's --launchpad-buildd), or else an export of the
+    latest launchpad-buildd (which needs bzr).
+    """
+    if launchpad_buildd is None:
+        subprocess.check_call(['bzr', 'export', path, BUILDD_BZR_BRANCH])
+    elif launchpad_buildd.startswith(('http://', 'https://')):
+        if launchpad_buildd_sha256 is None:
+            raise ValueError('You must provide a launchpad-buildd checksum '
+                             'if using a launchpad-buildd URL.')
+        _download(path, launchpad_buildd, launchpad_buildd_sha256)
+    else:
+        _, sha256 = _get_launchpad_buildd_tarball(launchpad_buildd)
+        if launchpad_buildd_sha256 not in (None, sha256):
+            raise ValueError('{} does not match the given checksum.'.format(
+                launchpad_buildd))
+        shutil.copyfile(launchpad_buildd, path)
+    # Check that what was fetched is a launchpad-buildd tree
+    _get_launchpad_buildd_tarball(path)
+
+
+def make_offline_bundle(output_path, architectures=None, series=None,
+                        launchpad_buildd=None, launchpad_buildd_sha256=None,
+                        ppa_keys=None):
+    """
+    Write an offline bundle: an (uncompressed) tarball of the base images,
+    launchpad-buildd and PPA signing keys that builds need, and of a
+    SHA256SUMS file indexing them.
+
+    Returns the paths in the bundle, mapped to their checksums.
+
+    :param output_path:
+        The path to write the bundle to.
+    :param architectures:
+        The architectures to include base images for; by default, amd64.
+    :param series:
+        The series to include base images for; by default, DEFAULT_SERIES.
+    :param launchpad_buildd:
+        The (optional) path or URL of a launchpad-buildd tarball to include,
+        instead of an export of the latest launchpad-buildd.
+    :param launchpad_buildd_sha256:
+        The SHA256 checksum of the launchpad-buildd tarball; required if
+        launchpad_buildd is a URL.
+    :param ppa_keys:
+        The IDs (or fingerprints) of the private PPA signing keys to
+        include.
+    """
+    architectures = architectures or [DEFAULT_ARCHITECTURE]
+    series = series or [DEFAULT_SERIES]
+    for name in series:
+        if name not in BASE_IMAGE_URLS:
+            raise ValueError('series must be one of: {}'.format(
+                ', '.join(sorted(BASE_IMAGE_URLS))))
+    for ppa_key in ppa_keys or []:
+        if not PPA_KEY_PATTERN.match(ppa_key):
+            raise ValueError('{!r} is not a hexadecimal key ID or '
+                             'fingerprint.'.format(ppa_key))
+    directory = tempfile.mkdtemp(prefix='offline-bundle-')
+    try:
+        checksums = {}
+
+        def add(path, fetch, *args):
+            fetch(*((os.path.join(directory, path),) + args))
+            checksums[path] = _sha256(os.path.join(directory, path))
+
+        for name in series:
+            for arch in architectures:
+                filename = BASE_IMAGE_FILENAME.format(arch=arch, series=name)
+                base_url = BASE_IMAGE_URLS[name]
+                add(OFFLINE_BUNDLE_BASE_IMAGE_PATH.format(
+                    filename=filename, series=name), _download,
+                    base_url + filename,
+                    _get_base_image_checksum(filename, base_url))
+        add(OFFLINE_BUNDLE_BUILDD_PATH, _add_launchpad_buildd,
+            launchpad_buildd, launchpad_buildd_sha256)
+        for ppa_key in ppa_keys or []:
+            key_id = _get_ppa_key_id(ppa_key)
+            add(OFFLINE_BUNDLE_PPA_KEY_PATH.format(key_id=key_id), _download,
+                PPA_KEY_URL_TEMPLATE.format(key_id=key_id))
+
+        with open(os.path.join(directory, OFFLINE_BUNDLE_INDEX), 'w') as f:
+            for path in sorted(checksums):
+                f.write('{}  {}\n'.format(checksums[path], path))
+        # Written alongside, and moved in to place once complete
+        partial_path = '{}.part'.format(output_path)
+        with tarfile.open(partial_path, 'w') as bundle:
+            for path in [OFFLINE_BUNDLE_INDEX] + sorted(checksums):
+                bundle.add(os.path.join(directory, path), arcname=path)
+        os.rename(partial_path, output_path)
+    finally:
+        shutil.rmtree(directory)
+    return checksums
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('output', metavar='BUNDLE',
+                        help='The path to write the bundle to.')
+    parser.add_argument('--architecture', dest='architectures',
+                        action='append', metavar='ARCH',
+                        help='An architecture to include base images for; '
+                        'may be given more than once.  Defaults to '
+                        '{}.'.format(DEFAULT_ARCHITECTURE))
+    parser.add_argument('--series', dest='series', action='append',
+                        choices=sorted(BASE_IMAGE_URLS),
+                        help='A series to include base images for; may be '
+                        'given more than once.  Defaults to '
+                        '{}.'.format(DEFAULT_SERIES))
+    parser.add_argument('--launchpad-buildd', dest='launchpad_buildd',
+                        metavar='PATH_OR_URL',
+                        help='A launchpad-buildd tarball to include, instead '
+                        'of exporting the latest launchpad-buildd (which '
+                        'needs bzr).')
+    parser.add_argument('--launchpad-buildd-sha256',
+                        dest='launchpad_buildd_sha256', metavar='SHA256',
+                        help='The SHA256 checksum of the launchpad-buildd '
+                        'tarball; required if --launchpad-buildd is a URL.')
+    parser.add_argument('--ppa-key', dest='ppa_keys', action='append',
+                        metavar='KEY',
+                        help='The ID of a private PPA signing key to include '
+                        '(as passed to generate_build_config\'s '
+                        '--build-ppa-key); may be given more than once.')
+    args = parser.parse_args()
+    try:
+        checksums = make_offline_bundle(
+            args.output, architectures=args.architectures,
+            series=args.series, launchpad_buildd=args.launchpad_buildd,
+            launchpad_buildd_sha256=args.launchpad_buildd_sha256,
+            ppa_keys=args.ppa_keys)
+    except (EnvironmentError, ValueError,
+            subprocess.CalledProcessError) as e:
+        parser.error(str(e))
+    for path in sorted(checksums):
+        print('{}  {}'.format(checksums[path], path))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,13 +11,20 @@ setup(
     author_email='daniel.watkins@canonical.com',
     description='Build Ubuntu images without Launchpad',
     long_description=__doc__,
-    py_modules=['generate_build_config'],
+    py_modules=['build_progress', 'build_scheduler', 'build_timings',
+                'generate_build_config', 'local_build', 'offline_bundle'],
+    install_requires=['PyYAML'],
     include_package_data=True,
     zip_safe=False,
     platforms='any',
     entry_points={
         'console_scripts': [
+            'aggregate_build_timings = build_timings:main',
+            'follow_build_progress = build_progress:main',
             'generate_build_config = generate_build_config:main',
+            'make_offline_bundle = offline_bundle:main',
+            'run_local_build = local_build:main',
+            'schedule_builds = build_scheduler:main',
         ],
     },
 )
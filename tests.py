@@ -1,12 +1,32 @@
+import argparse
 import base64
+import fnmatch
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import os
+import re
+import subprocess
+import sys
+import tarfile
+import threading
+import timeit
 
 import py
 import pytest
 import yaml
 from six import StringIO
+from six.moves import BaseHTTPServer
 from six.moves.urllib.parse import urlparse
 
+import build_progress
+import build_scheduler
+import build_timings
 import generate_build_config
+import local_build
+import offline_bundle
 
 
 @pytest.fixture(scope='session')
@@ -14,6 +34,67 @@ def build_id():
     return 'root'
 
 
+class _StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.server.get_failures:
+            self.server.get_failures -= 1
+            self.send_error(503)
+            return
+        path = self.server.root.join(self.path.split('?')[0].lstrip('/'))
+        if not path.check(file=1):
+            self.send_error(404)
+            return
+        content = path.read_binary()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_PUT(self):
+        self.server.uploads.append(self.path)
+        content = self.rfile.read(int(self.headers['Content-Length']))
+        if self.server.failures:
+            self.server.failures -= 1
+            self.send_error(503)
+            return
+        self.server.root.join(self.path.lstrip('/')).write_binary(
+            content, ensure=True)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server(tmpdir):
+    """
+    A stand-in HTTP server, serving the contents of a temporary directory.
+
+    The served directory is available as the ``root`` attribute of the
+    returned server, its base URL as ``url``, and the paths of the requests
+    it has received as ``requests``.  Files PUT to it are written in to the
+    directory, and their paths recorded in ``uploads``; setting ``failures``
+    makes it fail that many PUTs first (and ``get_failures``, GETs).
+    """
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), _StandInHandler)
+    server.requests = []
+    server.uploads = []
+    server.failures = 0
+    server.get_failures = 0
+    server.root = tmpdir.mkdir('http-root')
+    server.url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
 class TestGetPPASnippet(object):
 
     def test_unknown_url(self):
@@ -34,124 +115,2784 @@ class TestGetPPASnippet(object):
             generate_build_config._get_ppa_snippet(
                 'https://private-ppa.example.com')
 
-    def test_private_ppa_with_key(self):
-        result = generate_build_config._get_ppa_snippet(
-            'https://private-ppa.example.com', 'DEADBEEF')
-        assert 'apt-get install -y apt-transport-https' in result
-        assert 'deb https://private-ppa.example.com xenial main' in result
-        assert ('apt-key adv --keyserver hkp://keyserver.ubuntu.com:80 '
-                '--recv-keys DEADBEEF' in result)
+    def test_private_ppa_with_key(self):
+        result = generate_build_config._get_ppa_snippet(
+            'https://private-ppa.example.com', 'DEADBEEF')
+        assert 'apt-get install -y apt-transport-https' in result
+        assert 'deb https://private-ppa.example.com xenial main' in result
+        assert ('apt-key adv --keyserver hkp://keyserver.ubuntu.com:80 '
+                '--recv-keys DEADBEEF' in result)
+
+    def test_private_ppa_with_key_path(self):
+        result = generate_build_config._get_ppa_snippet(
+            'https://private-ppa.example.com', 'DEADBEEF',
+            key_path='/home/ubuntu/key.asc')
+        assert 'apt-key add - < /home/ubuntu/key.asc' in result
+        assert 'keyserver' not in result
+
+
+class TestParseSha256sums(object):
+
+    def test_parses_text_and_binary_entries(self):
+        content = 'AAAA  foo.squashfs\nbbbb *bar.img\n'
+        assert {'foo.squashfs': 'aaaa', 'bar.img': 'bbbb'} == \
+            generate_build_config._parse_sha256sums(content)
+
+    def test_ignores_blank_lines(self):
+        assert {'foo': 'aaaa'} == \
+            generate_build_config._parse_sha256sums('\naaaa  foo\n\n')
+
+
+class TestGetBaseImageChecksum(object):
+
+    def test_checksum_read_from_mirror(self, http_server):
+        http_server.root.join('SHA256SUMS').write(
+            'aaaa *other.img\nbbbb *base.squashfs\n')
+        assert 'bbbb' == generate_build_config._get_base_image_checksum(
+            base_url=http_server.url, filename='base.squashfs')
+
+    def test_missing_image_raises_value_error(self, http_server):
+        http_server.root.join('SHA256SUMS').write('aaaa *other.img\n')
+        with pytest.raises(ValueError):
+            generate_build_config._get_base_image_checksum(
+                base_url=http_server.url, filename='base.squashfs')
+
+
+class TestGetBaseImageCachePath(object):
+
+    def test_path_is_sharded_by_checksum(self):
+        assert '/cache/xenial/ab/abcd.squashfs' == \
+            generate_build_config._get_base_image_cache_path(
+                '/cache/', 'xenial', 'abcd')
+
+    def test_mirror_url_layout_matches_directory_layout(self, http_server):
+        content = b'squashfs content'
+        checksum = hashlib.sha256(content).hexdigest()
+        http_server.root.join(
+            'xenial', checksum[:2], checksum + '.squashfs').write(
+                content, ensure=True)
+        url = generate_build_config._get_base_image_cache_path(
+            http_server.url, 'xenial', checksum)
+        response = generate_build_config.urlopen(url)
+        try:
+            assert content == response.read()
+        finally:
+            response.close()
+
+
+@pytest.fixture
+def write_cloud_config_in_memory():
+    def _write_cloud_config_in_memory(*args, **kwargs):
+        output_stream = StringIO()
+        generate_build_config._write_cloud_config(
+            output_stream, *args, **kwargs)
+        return output_stream.getvalue()
+    return _write_cloud_config_in_memory
+
+
+class TestWriteCloudConfig(object):
+
+    def test_writes_to_file(self, write_cloud_config_in_memory):
+        assert len(write_cloud_config_in_memory()) > 0
+
+    def test_written_output_is_yaml(self, write_cloud_config_in_memory):
+        yaml.load(write_cloud_config_in_memory())
+
+    def test_written_output_is_cloud_config(
+            self, write_cloud_config_in_memory):
+        assert '#cloud-config' \
+            == write_cloud_config_in_memory().splitlines()[0].strip()
+
+    def test_default_build_id_is_root(
+            self, build_id, write_cloud_config_in_memory):
+        assert '- export BUILD_ID={}'.format(build_id) in \
+            write_cloud_config_in_memory().splitlines()
+
+    def test_serial_includes_ubuntu_standalone_builder(
+            self, write_cloud_config_in_memory):
+        buildlivefs_line = [
+            line for line in write_cloud_config_in_memory().splitlines()
+            if 'buildlivefs' in line][0]
+        assert '--datestamp ubuntu-standalone-builder' in buildlivefs_line
+
+    def test_write_files_not_included_by_default(
+            self, write_cloud_config_in_memory):
+        cloud_config = yaml.load(write_cloud_config_in_memory())
+        assert 'write_files' not in cloud_config
+
+    def test_no_build_ppa_by_default(self, write_cloud_config_in_memory):
+        content = write_cloud_config_in_memory()
+        assert 'add-apt-repository' not in content
+        assert 'apt-transport-https' not in content
+
+    def _get_wget_line(self, output):
+        wget_lines = [ln for ln in output.splitlines() if 'wget' in ln]
+        assert 1 == len(wget_lines)
+        return wget_lines[0]
+
+    def test_daily_image_used(self, write_cloud_config_in_memory):
+        wget_line = self._get_wget_line(write_cloud_config_in_memory())
+        assert 'xenial-server-cloudimg-amd64.squashfs ' in wget_line
+
+    def test_latest_daily_image_used(self, write_cloud_config_in_memory):
+        url = self._get_wget_line(write_cloud_config_in_memory()).split()[2]
+        path = urlparse(url).path
+        assert 'current' == path.split('/')[2]
+
+    def test_base_image_cache_dir_used(
+            self, mocker, write_cloud_config_in_memory):
+        mocker.patch('generate_build_config._get_base_image_checksum',
+                     return_value='abcd')
+        output = write_cloud_config_in_memory(base_image_cache='/cache')
+        cloud_config = yaml.safe_load(output)
+        assert 'mkdir -p /cache/xenial/ab' in cloud_config['runcmd']
+        assert ('ln -sf /cache/xenial/ab/abcd.squashfs '
+                '/tmp/root-amd64.squashfs') in cloud_config['runcmd']
+        assert ("echo 'abcd  /cache/xenial/ab/abcd.squashfs' "
+                "| sha256sum -c -") in output
+
+    def test_base_image_cache_mirror_used(
+            self, mocker, write_cloud_config_in_memory):
+        mocker.patch('generate_build_config._get_base_image_checksum',
+                     return_value='abcd')
+        output = write_cloud_config_in_memory(
+            base_image_cache='http://mirror/cache')
+        wget_lines = [ln for ln in output.splitlines() if 'wget' in ln]
+        assert 1 == len(wget_lines)
+        assert wget_lines[0].index(
+            'http://mirror/cache/xenial/ab/abcd.squashfs') < \
+            wget_lines[0].index(
+                generate_build_config.BASE_IMAGE_URLS['xenial'])
+        assert "echo 'abcd  /tmp/root-amd64.squashfs' | sha256sum -c -" in \
+            output
+
+    @pytest.mark.parametrize('series', ['xenial', 'bionic'])
+    def test_series_base_image_used(
+            self, series, write_cloud_config_in_memory):
+        url = self._get_wget_line(
+            write_cloud_config_in_memory(series=series)).split()[2]
+        assert generate_build_config.BASE_IMAGE_URLS[series] + \
+            '{}-server-cloudimg-amd64.squashfs'.format(series) == url
+
+    def test_series_passed_to_buildlivefs(self, write_cloud_config_in_memory):
+        buildlivefs_line = [
+            line for line in write_cloud_config_in_memory(
+                series='bionic').splitlines() if 'buildlivefs' in line][0]
+        assert '--series bionic ' in buildlivefs_line
+
+    def test_private_ppa_uses_series(self, write_cloud_config_in_memory):
+        output = write_cloud_config_in_memory(
+            build_ppa='https://private-ppa.example.com', build_ppa_key='abc',
+            series='bionic')
+        assert 'deb https://private-ppa.example.com bionic main' in output
+
+    def test_unknown_series_raises_value_error(
+            self, write_cloud_config_in_memory):
+        with pytest.raises(ValueError):
+            write_cloud_config_in_memory(series='warty')
+
+    def test_base_image_checksum_looked_up_for_series(
+            self, mocker, write_cloud_config_in_memory):
+        checksum_mock = mocker.patch(
+            'generate_build_config._get_base_image_checksum',
+            return_value='abcd')
+        output = write_cloud_config_in_memory(base_image_cache='/cache',
+                                              series='bionic')
+        checksum_mock.assert_called_once_with(
+            'bionic-server-cloudimg-amd64.squashfs',
+            generate_build_config.BASE_IMAGE_URLS['bionic'])
+        assert 'mkdir -p /cache/bionic/ab' in output
+
+    def test_base_image_checksum_not_fetched_by_default(
+            self, mocker, write_cloud_config_in_memory):
+        checksum_mock = mocker.patch(
+            'generate_build_config._get_base_image_checksum')
+        write_cloud_config_in_memory()
+        assert 0 == checksum_mock.call_count
+
+    def test_build_ppa_snippet_included(self, write_cloud_config_in_memory):
+        output = write_cloud_config_in_memory(build_ppa='ppa:foo/bar')
+        assert 'add-apt-repository -y -u ppa:foo/bar' in output
+
+    def test_build_ppa_snippet_included_before_update_debian_chroot(
+            self, write_cloud_config_in_memory):
+        ppa_string = 'ppa:foo/bar'
+        output = write_cloud_config_in_memory(build_ppa=ppa_string)
+        assert output.find('add-apt-repository -y -u {}'.format(ppa_string)) \
+            < output.find('update-debian-chroot')
+
+    def test_image_ppa_not_by_default(self, write_cloud_config_in_memory):
+        content = write_cloud_config_in_memory()
+        assert '--extra-ppa' not in content
+
+    def test_image_ppa_added(self, write_cloud_config_in_memory):
+        image_ppa = 'foo/bar:1001'
+        content = write_cloud_config_in_memory(image_ppa=image_ppa)
+        assert '--extra-ppa {}'.format(image_ppa) in content
+
+    def test_binary_hook_filter_included(self, write_cloud_config_in_memory):
+        hook_filter = 'some*glob*'
+        output = write_cloud_config_in_memory(binary_hook_filter=hook_filter)
+        cloud_config = yaml.load(output)
+        for stanza in cloud_config['write_files']:
+            content = base64.b64decode(stanza['content']).decode('utf-8')
+            if '{}|9997*|9998*|9999*'.format(hook_filter) in content:
+                break
+        else:
+            pytest.fail('Binary hook filter not correctly included.')
+
+    def test_binary_hook_sequence_is_lower_than_030(
+            self, write_cloud_config_in_memory, monkeypatch):
+        # That's the lowest sequence of disks and we want to filter before that
+        filter_template = '-- binary hook filter:{} --'
+        hook_filter = 'some*glob'
+        monkeypatch.setattr(
+            generate_build_config,
+            "BINARY_HOOK_FILTER_CONTENT", filter_template)
+        output = write_cloud_config_in_memory(binary_hook_filter=hook_filter)
+        cloud_config = yaml.load(output)
+        expected_content = filter_template.format(hook_filter)
+        for stanza in cloud_config['write_files']:
+            content = base64.b64decode(stanza['content']).decode('utf-8')
+            if content == expected_content:
+                break
+        else:
+            pytest.fail('Binary hook filter not correctly included.')
+        path = stanza['path'].rsplit('/')[-1]
+        assert path < '030-some-file.binary'
+
+
+class TestGetArtifactFilter(object):
+
+    def test_all_artifacts_needs_no_filter(self):
+        assert generate_build_config._get_artifact_filter(
+            generate_build_config.ARTIFACT_HOOKS) is None
+
+    def test_shared_hooks_kept(self):
+        content = generate_build_config._get_artifact_filter(['qcow2'])
+        skipped = content.splitlines()[3].strip().rstrip(')').split('|')
+        assert '*-disk-image.binary' not in skipped
+        assert '*-qcow2-image.binary' not in skipped
+        assert '*-vmdk-image.binary' in skipped
+        assert '*-root-squashfs.binary' in skipped
+
+    def test_filter_skips_only_unrequested_hooks(self, tmpdir):
+        hooks_dir = tmpdir.mkdir('hooks')
+        for name in ['030-root-tarball.binary', '031-root-squashfs.binary',
+                     '040-disk-image.binary', '041-qcow2-image.binary',
+                     '042-vmdk-image.binary', '999-extras.binary']:
+            hooks_dir.join(name).write('original')
+        content = generate_build_config._get_artifact_filter(
+            ['squashfs', 'qcow2']).replace(
+                '/build/config/hooks', hooks_dir.strpath)
+        subprocess.check_call(['sh', '-c', content])
+        kept = sorted(hook.basename for hook in hooks_dir.listdir()
+                      if hook.read() == 'original')
+        assert ['031-root-squashfs.binary', '040-disk-image.binary',
+                '041-qcow2-image.binary', '999-extras.binary'] == kept
+
+
+class TestParseArtifacts(object):
+
+    def test_comma_separated(self):
+        assert ['squashfs', 'qcow2'] == \
+            generate_build_config._parse_artifacts('squashfs, qcow2')
+
+    @pytest.mark.parametrize('value', ['', 'squashfs,iso'])
+    def test_unknown_artifacts_rejected(self, value):
+        with pytest.raises(argparse.ArgumentTypeError):
+            generate_build_config._parse_artifacts(value)
+
+
+class TestWriteCloudConfigArtifacts(object):
+
+    def _get_hooks(self, output):
+        # Binary hooks written, by file name
+        return dict(
+            (stanza['path'].rsplit('/', 1)[-1],
+             generate_build_config._get_write_files_content(stanza))
+            for stanza in yaml.safe_load(output).get('write_files', [])
+            if stanza['path'].endswith('.binary'))
+
+    def test_no_filter_by_default(self, write_cloud_config_in_memory):
+        assert '010-artifact-filter.binary' not in self._get_hooks(
+            write_cloud_config_in_memory())
+
+    def test_filter_hook_written(self, write_cloud_config_in_memory):
+        hooks = self._get_hooks(write_cloud_config_in_memory(
+            artifacts=['squashfs']))
+        assert generate_build_config._get_artifact_filter(['squashfs']) == \
+            hooks['010-artifact-filter.binary'].decode('utf-8')
+
+    def test_binary_hook_sequence_is_lower_than_030(
+            self, write_cloud_config_in_memory):
+        # That's the lowest sequence of the artifact hooks, which the filter
+        # must run before; compare as C and (ignoring punctuation and case)
+        # en_US collation would
+        name = [name for name in self._get_hooks(
+            write_cloud_config_in_memory(artifacts=['squashfs']))
+            if 'artifact-filter' in name][0]
+        for key in (None, lambda name: re.sub('[^a-z0-9]', '', name.lower())):
+            assert [name, '030-root-tarball.binary'] == sorted(
+                [name, '030-root-tarball.binary'], key=key)
+
+    def test_filter_alongside_binary_hook_filter(
+            self, tmpdir, write_cloud_config_in_memory):
+        hooks_dir = tmpdir.mkdir('hooks')
+        for name in ['030-root-tarball.binary', '031-root-squashfs.binary',
+                     '040-disk-image.binary']:
+            hooks_dir.join(name).write('original')
+        hooks = self._get_hooks(write_cloud_config_in_memory(
+            artifacts=['squashfs'], binary_hook_filter='03*'))
+        for name, content in hooks.items():
+            hooks_dir.join(name).write_binary(content.replace(
+                b'/build/config/hooks', hooks_dir.strpath.encode('utf-8')))
+        # Run the filters in order, as live-build would
+        for name in sorted(hooks):
+            subprocess.check_call(['sh', hooks_dir.join(name).strpath])
+        kept = sorted(hook.basename for hook in hooks_dir.listdir()
+                      if hook.read() == 'original')
+        assert ['031-root-squashfs.binary'] == kept
+        # The binary hook filter left the artifact filter in place
+        assert b'case' in hooks_dir.join(
+            '010-artifact-filter.binary').read_binary()
+
+
+class TestProduceWriteFilesStanza(object):
+
+    def test_b64_by_default(self):
+        stanza = yaml.safe_load(
+            generate_build_config._produce_write_files_stanza(
+                'content', '/path'))[0]
+        assert 'b64' == stanza['encoding']
+        assert b'content' == base64.b64decode(stanza['content'])
+
+    def test_compressed(self):
+        stanza = yaml.safe_load(
+            generate_build_config._produce_write_files_stanza(
+                'content', '/path', compress=True))[0]
+        assert 'gz+b64' == stanza['encoding']
+        assert b'content' == gzip.GzipFile(fileobj=io.BytesIO(
+            base64.b64decode(stanza['content']))).read()
+
+    def test_compressed_output_is_deterministic(self):
+        stanzas = [generate_build_config._produce_write_files_stanza(
+            'content', '/path', compress=True) for _ in range(2)]
+        assert stanzas[0] == stanzas[1]
+
+
+class TestFormatSizeReport(object):
+
+    def test_report_lists_payloads_and_total(
+            self, write_cloud_config_in_memory):
+        output = write_cloud_config_in_memory(apt_proxy='http://proxy')
+        report = generate_build_config._format_size_report(output, 100000)
+        lines = report.splitlines()
+        assert generate_build_config.APT_PROXY_CONF_PATH in lines[1]
+        assert '{}  total'.format(len(output)) in lines[-1]
+        assert sum(int(line.split()[0]) for line in lines[:-1]) == \
+            len(output)
+
+
+class TestParseUserDataLimit(object):
+
+    def test_cloud_name(self):
+        assert generate_build_config.USER_DATA_LIMITS['aws'] == \
+            generate_build_config._parse_user_data_limit('aws')
+
+    def test_bytes(self):
+        assert 1000 == generate_build_config._parse_user_data_limit('1000')
+
+    @pytest.mark.parametrize('value', ['0', 'nimbus'])
+    def test_invalid_limit_rejected(self, value):
+        with pytest.raises(argparse.ArgumentTypeError):
+            generate_build_config._parse_user_data_limit(value)
+
+
+class TestWriteCloudConfigPayloads(object):
+
+    @pytest.fixture
+    def script(self, tmpdir):
+        script = tmpdir.join('script.sh')
+        script.write('#!/bin/sh\n' + 'echo customise\n' * 2000)
+        return script
+
+    def test_payloads_compressed(
+            self, script, write_cloud_config_in_memory):
+        uncompressed = write_cloud_config_in_memory(
+            customisation_script=script.strpath)
+        compressed = write_cloud_config_in_memory(
+            compress_payloads=True, customisation_script=script.strpath)
+        assert len(compressed) < len(uncompressed)
+        assert all('gz+b64' == stanza['encoding'] for stanza in
+                   yaml.safe_load(compressed)['write_files'])
+
+    def test_identical_payloads_embedded_once(
+            self, script, write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            architectures=['amd64', 'arm64'],
+            customisation_script=script.strpath))
+        hook_stanzas = [stanza for stanza in cloud_config['write_files']
+                        if stanza['path'].endswith('.chroot')]
+        assert 3 == len(hook_stanzas)
+        copies = [command for command in cloud_config['runcmd']
+                  if command.startswith('install -D')]
+        assert 3 == len(copies)
+        assert all('build-ubuntu-cpc-arm64' in copy.split()[-1]
+                   for copy in copies)
+
+    def test_copies_made_before_builds(
+            self, script, write_cloud_config_in_memory):
+        runcmd = yaml.safe_load(write_cloud_config_in_memory(
+            architectures=['amd64', 'arm64'],
+            customisation_script=script.strpath))['runcmd']
+        last_copy = max(index for index, command in enumerate(runcmd)
+                        if command.startswith('install -D'))
+        first_build = min(index for index, command in enumerate(runcmd)
+                          if 'xargs' in command)
+        assert last_copy < first_build
+
+    def test_no_size_report_by_default(
+            self, capsys, write_cloud_config_in_memory):
+        write_cloud_config_in_memory()
+        assert '' == capsys.readouterr().err
+
+    def test_size_report_printed(self, capsys, write_cloud_config_in_memory):
+        output = write_cloud_config_in_memory(user_data_limit=100000)
+        assert '{}  total'.format(len(output)) in capsys.readouterr().err
+
+    def test_exceeding_limit_raises_value_error(
+            self, script, write_cloud_config_in_memory):
+        with pytest.raises(ValueError):
+            write_cloud_config_in_memory(customisation_script=script.strpath,
+                                         user_data_limit=16384)
+
+    def test_compressed_payloads_fit_limit(
+            self, script, write_cloud_config_in_memory):
+        write_cloud_config_in_memory(
+            compress_payloads=True, customisation_script=script.strpath,
+            user_data_limit=16384)
+
+    def test_nothing_written_when_limit_exceeded(self, script):
+        output_stream = StringIO()
+        with pytest.raises(ValueError):
+            generate_build_config._write_cloud_config(
+                output_stream, customisation_script=script.strpath,
+                user_data_limit=16384)
+        assert '' == output_stream.getvalue()
+
+
+class TestGetBuilds(object):
+
+    def test_single_build_uses_root_build_id(self):
+        assert [('root', 'amd64', 'ubuntu-cpc')] == \
+            generate_build_config._get_builds()
+
+    def test_build_per_architecture_and_project(self):
+        builds = generate_build_config._get_builds(
+            ['amd64', 'arm64'], ['ubuntu-cpc', 'ubuntu-core'])
+        assert 4 == len(builds)
+        assert ('ubuntu-core-arm64', 'arm64', 'ubuntu-core') in builds
+
+    def test_single_architecture_string_accepted(self):
+        assert [('root', 'i386', 'ubuntu-cpc')] == \
+            generate_build_config._get_builds('i386')
+
+    def test_unknown_architecture_raises_value_error(self):
+        with pytest.raises(ValueError):
+            generate_build_config._get_builds(['sparc'])
+
+
+class TestWriteCloudConfigMultipleBuilds(object):
+
+    @pytest.fixture
+    def cloud_config(self, write_cloud_config_in_memory):
+        return yaml.safe_load(write_cloud_config_in_memory(
+            architectures=['amd64', 'arm64'], parallel_builds=1))
+
+    def _get_build_scripts(self, cloud_config):
+        return dict(
+            (stanza['path'],
+             base64.b64decode(stanza['content']).decode('utf-8'))
+            for stanza in cloud_config['write_files']
+            if stanza['path'].endswith('.sh'))
+
+    def test_build_script_per_build(self, cloud_config):
+        assert ['/home/ubuntu/build-ubuntu-cpc-amd64.sh',
+                '/home/ubuntu/build-ubuntu-cpc-arm64.sh'] == \
+            sorted(self._get_build_scripts(cloud_config))
+
+    def test_build_scripts_use_own_build_id_and_arch(self, cloud_config):
+        scripts = self._get_build_scripts(cloud_config)
+        script = scripts['/home/ubuntu/build-ubuntu-cpc-arm64.sh']
+        assert 'export BUILD_ID=ubuntu-cpc-arm64' in script.splitlines()
+        assert '--arch arm64 --project ubuntu-cpc' in script
+        assert '/tmp/root-arm64.squashfs' in script
+
+    def test_results_collected_per_build(self, cloud_config):
+        script = self._get_build_scripts(cloud_config)[
+            '/home/ubuntu/build-ubuntu-cpc-amd64.sh']
+        assert ('mv $CHROOT_ROOT/build/livecd.ubuntu-cpc.* '
+                '/home/ubuntu/images/ubuntu-cpc-amd64') in script.splitlines()
+
+    def test_builds_run_with_parallelism_limit(self, cloud_config):
+        xargs_lines = [line for line in cloud_config['runcmd']
+                       if 'xargs' in line]
+        assert 1 == len(xargs_lines)
+        assert 'echo ubuntu-cpc-amd64 ubuntu-cpc-arm64 | xargs -n 1 -P 1 ' \
+            in xargs_lines[0]
+
+    def test_parallelism_defaults_to_number_of_builds(
+            self, write_cloud_config_in_memory):
+        output = write_cloud_config_in_memory(
+            architectures=['amd64', 'i386'], projects=['a', 'b'])
+        assert 'xargs -n 1 -P 4 ' in output
+
+    def test_base_image_fetched_per_architecture(self, cloud_config):
+        wget_lines = [line for line in cloud_config['runcmd']
+                      if line.startswith('wget')]
+        assert 2 == len(wget_lines)
+
+    def test_foreign_architecture_uses_qemu(self, cloud_config):
+        assert 'qemu-user-static' in cloud_config['packages']
+        script = self._get_build_scripts(cloud_config)[
+            '/home/ubuntu/build-ubuntu-cpc-arm64.sh']
+        assert 'cp /usr/bin/qemu-aarch64-static $CHROOT_ROOT/usr/bin/' in \
+            script.splitlines()
+
+    def test_native_architectures_dont_use_qemu(
+            self, write_cloud_config_in_memory):
+        output = write_cloud_config_in_memory(
+            architectures=['amd64', 'i386'])
+        assert 'qemu' not in output
+
+    def test_hooks_written_to_each_chroot(
+            self, tmpdir, write_cloud_config_in_memory):
+        script = tmpdir.join('script.sh')
+        script.write('#!/bin/sh\n-- chroot --')
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            architectures=['amd64', 'arm64'], projects=['ubuntu-core'],
+            customisation_script=script.strpath))
+        # Identical hooks are embedded once and copied to the other chroots
+        hook_paths = [stanza['path'] for stanza in cloud_config['write_files']]
+        hook_paths.extend(command.split()[-1]
+                          for command in cloud_config['runcmd']
+                          if command.startswith('install -D'))
+        hook_dirs = set(py.path.local(path).dirname for path in hook_paths
+                        if path.endswith('.chroot'))
+        assert set(
+            '/home/ubuntu/build-ubuntu-core-{}/chroot-autobuild/usr/share/'
+            'livecd-rootfs/live-build/ubuntu-core/hooks'.format(arch)
+            for arch in ('amd64', 'arm64')) == hook_dirs
+
+    def test_invalid_parallelism_raises_value_error(
+            self, write_cloud_config_in_memory):
+        with pytest.raises(ValueError):
+            write_cloud_config_in_memory(parallel_builds=0)
+
+
+@pytest.fixture
+def launchpad_buildd_tarball(tmpdir):
+    tree = tmpdir.mkdir('launchpad-buildd-123')
+    tree.join('bin', 'buildlivefs').write('#!/bin/sh\n', ensure=True)
+    tree.join('lpbuildd', '__init__.py').write('', ensure=True)
+    path = tmpdir.join('launchpad-buildd-123.tar.gz')
+    with tarfile.open(path.strpath, 'w:gz') as tarball:
+        tarball.add(tree.strpath, arcname=tree.basename)
+    return path
+
+
+class TestGetLaunchpadBuilddTarball(object):
+
+    def test_content_and_checksum_returned(self, launchpad_buildd_tarball):
+        content, sha256 = \
+            generate_build_config._get_launchpad_buildd_tarball(
+                launchpad_buildd_tarball.strpath)
+        assert launchpad_buildd_tarball.read_binary() == content
+        assert hashlib.sha256(content).hexdigest() == sha256
+
+    def test_non_tarball_raises_value_error(self, tmpdir):
+        path = tmpdir.join('launchpad-buildd.tar')
+        path.write('not a tarball')
+        with pytest.raises(ValueError):
+            generate_build_config._get_launchpad_buildd_tarball(path.strpath)
+
+    def test_tarball_without_buildlivefs_raises_value_error(self, tmpdir):
+        tmpdir.join('tree', 'README').write('', ensure=True)
+        path = tmpdir.join('other.tar')
+        with tarfile.open(path.strpath, 'w') as tarball:
+            tarball.add(tmpdir.join('tree').strpath, arcname='tree')
+        with pytest.raises(ValueError):
+            generate_build_config._get_launchpad_buildd_tarball(path.strpath)
+
+
+class TestWriteCloudConfigLaunchpadBuildd(object):
+
+    def test_branched_from_bzr_by_default(
+            self, write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(
+            write_cloud_config_in_memory(homedir='/srv/build'))
+        assert 'bzr' in cloud_config['packages']
+        assert 'bzr branch lp:launchpad-buildd /srv/build/launchpad-buildd' \
+            in cloud_config['runcmd']
+        assert ('cd /srv/build/launchpad-buildd; python setup.py install; cd'
+                in cloud_config['runcmd'])
+
+    def test_local_tarball_embedded(
+            self, launchpad_buildd_tarball, write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            launchpad_buildd=launchpad_buildd_tarball.strpath))
+        stanzas = [stanza for stanza in cloud_config['write_files']
+                   if stanza['path'] ==
+                   '/home/ubuntu/launchpad-buildd-123.tar.gz']
+        assert 1 == len(stanzas)
+        assert launchpad_buildd_tarball.read_binary() == \
+            base64.b64decode(stanzas[0]['content'])
+
+    def test_tarball_verified_and_used_in_place(
+            self, launchpad_buildd_tarball, write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            launchpad_buildd=launchpad_buildd_tarball.strpath))
+        sha256 = hashlib.sha256(
+            launchpad_buildd_tarball.read_binary()).hexdigest()
+        runcmd = cloud_config['runcmd']
+        assert ("echo '{}  /home/ubuntu/launchpad-buildd-123.tar.gz' | "
+                "sha256sum -c -".format(sha256)) in runcmd
+        assert 'export PYTHONPATH=/home/ubuntu/launchpad-buildd' in runcmd
+        assert not [command for command in runcmd
+                    if 'bzr' in command or 'setup.py' in command]
+
+    def test_bzr_not_installed_with_tarball(
+            self, launchpad_buildd_tarball, write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            launchpad_buildd=launchpad_buildd_tarball.strpath))
+        for package in generate_build_config.BUILDD_BZR_PACKAGES:
+            assert package not in cloud_config['packages']
+        assert 'python-twisted' in cloud_config['packages']
+
+    def test_mismatched_checksum_raises_value_error(
+            self, launchpad_buildd_tarball, write_cloud_config_in_memory):
+        with pytest.raises(ValueError):
+            write_cloud_config_in_memory(
+                launchpad_buildd=launchpad_buildd_tarball.strpath,
+                launchpad_buildd_sha256='0' * 64)
+
+    def test_url_fetched_and_verified(self, write_cloud_config_in_memory):
+        runcmd = yaml.safe_load(write_cloud_config_in_memory(
+            launchpad_buildd='http://mirror/lpbuildd.tar.xz',
+            launchpad_buildd_sha256='abcd'))['runcmd']
+        fetch_index = runcmd.index(
+            'wget http://mirror/lpbuildd.tar.xz -O '
+            '/home/ubuntu/lpbuildd.tar.xz')
+        assert fetch_index < runcmd.index(
+            "echo 'abcd  /home/ubuntu/lpbuildd.tar.xz' | sha256sum -c -")
+
+    def test_url_without_checksum_raises_value_error(
+            self, write_cloud_config_in_memory):
+        with pytest.raises(ValueError):
+            write_cloud_config_in_memory(
+                launchpad_buildd='https://mirror/lpbuildd.tar.xz')
+
+
+class TestWriteCloudConfigChrootStorage(object):
+
+    def test_disk_by_default(self, write_cloud_config_in_memory):
+        assert 'chroot-storage' not in write_cloud_config_in_memory()
+
+    @pytest.mark.parametrize('mode', ['tmpfs', 'zram', 'auto'])
+    def test_build_tree_mounted_before_unpacking(
+            self, mode, write_cloud_config_in_memory):
+        runcmd = yaml.safe_load(write_cloud_config_in_memory(
+            chroot_storage=mode, chroot_storage_size=2048))['runcmd']
+        mount_command = (
+            '/home/ubuntu/chroot-storage.sh mount {} 2048 2048 '
+            '/home/ubuntu/build-$BUILD_ID'.format(mode))
+        assert runcmd.index(mount_command) < runcmd.index(
+            'mkdir -p $CHROOT_ROOT')
+
+    def test_build_tree_released_after_images_moved(
+            self, write_cloud_config_in_memory):
+        runcmd = yaml.safe_load(write_cloud_config_in_memory(
+            chroot_storage='tmpfs'))['runcmd']
+        assert runcmd[-1] == ('/home/ubuntu/chroot-storage.sh release '
+                              '/home/ubuntu/build-$BUILD_ID')
+        assert runcmd[-2].startswith('mv $CHROOT_ROOT/build/livecd')
+
+    def test_storage_script_written(self, write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            chroot_storage='auto'))
+        stanzas = [stanza for stanza in cloud_config['write_files']
+                   if stanza['path'] == '/home/ubuntu/chroot-storage.sh']
+        assert 1 == len(stanzas)
+        assert generate_build_config.CHROOT_STORAGE_CONTENT == \
+            base64.b64decode(stanzas[0]['content']).decode('utf-8')
+
+    def test_memory_required_for_all_concurrent_builds(
+            self, write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            architectures=['amd64', 'i386'], projects=['a', 'b'],
+            parallel_builds=3, chroot_storage='auto',
+            chroot_storage_size=1000))
+        build_scripts = [
+            base64.b64decode(stanza['content']).decode('utf-8')
+            for stanza in cloud_config['write_files']
+            if stanza['path'].startswith('/home/ubuntu/build-')]
+        assert 4 == len(build_scripts)
+        for build_script in build_scripts:
+            assert 'chroot-storage.sh mount auto 1000 3000 ' in build_script
+
+    def test_unknown_mode_raises_value_error(
+            self, write_cloud_config_in_memory):
+        with pytest.raises(ValueError):
+            write_cloud_config_in_memory(chroot_storage='floppy')
+
+
+class TestWriteCloudConfigAptProxy(object):
+
+    def _get_write_files(self, cloud_config):
+        return dict(
+            (stanza['path'], base64.b64decode(stanza['content']).decode(
+                'utf-8'))
+            for stanza in cloud_config.get('write_files', []))
+
+    def test_no_proxy_by_default(self, write_cloud_config_in_memory):
+        output = write_cloud_config_in_memory()
+        assert 'Proxy' not in output
+        assert 'apt-cacher-ng' not in output
+
+    def test_proxy_configured_on_host_before_packages(
+            self, write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            apt_proxy='http://proxy:3128'))
+        write_files = self._get_write_files(cloud_config)
+        assert 'Acquire::http::Proxy "http://proxy:3128";\n' == \
+            write_files[generate_build_config.APT_PROXY_CONF_PATH]
+
+    def test_proxy_configured_in_chroot_before_update(
+            self, write_cloud_config_in_memory):
+        runcmd = yaml.safe_load(write_cloud_config_in_memory(
+            apt_proxy='http://proxy:3128', build_ppa='ppa:foo/bar'))['runcmd']
+        copy_index = runcmd.index(
+            'cp {} $CHROOT_ROOT/etc/apt/apt.conf.d/'.format(
+                generate_build_config.APT_PROXY_CONF_PATH))
+        assert runcmd.index('unsquashfs -force -no-progress -dest '
+                            '$CHROOT_ROOT /tmp/root-amd64.squashfs') \
+            < copy_index
+        assert copy_index < runcmd.index(
+            'chroot $CHROOT_ROOT add-apt-repository -y -u ppa:foo/bar')
+
+    def test_local_cache_installed_and_used(
+            self, write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            apt_cache_local=True))
+        assert 'apt-cacher-ng' in cloud_config['packages']
+        write_files = self._get_write_files(cloud_config)
+        assert generate_build_config.APT_PROXY_CONF_PATH not in write_files
+        assert generate_build_config.LOCAL_APT_CACHE_URL in write_files[
+            generate_build_config.LOCAL_APT_CACHE_STAGED_CONF_PATH]
+        runcmd = cloud_config['runcmd']
+        assert runcmd.index('cp {} {}'.format(
+            generate_build_config.LOCAL_APT_CACHE_STAGED_CONF_PATH,
+            generate_build_config.APT_PROXY_CONF_PATH)) \
+            < runcmd.index('cp {} $CHROOT_ROOT/etc/apt/apt.conf.d/'.format(
+                generate_build_config.APT_PROXY_CONF_PATH))
+
+    def test_local_cache_chained_to_proxy(
+            self, write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            apt_cache_local=True, apt_proxy='http://proxy:3128'))
+        write_files = self._get_write_files(cloud_config)
+        assert 'Proxy: http://proxy:3128\n' == \
+            write_files[generate_build_config.LOCAL_APT_CACHE_CONF_PATH]
+
+    @pytest.mark.skipif(not py.path.local.sysfind('apt-get'),
+                        reason='apt-get is not available')
+    def test_apt_uses_proxy(self, http_server, tmpdir,
+                            write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            apt_proxy=http_server.url))
+        apt_dir = tmpdir.mkdir('apt')
+        apt_conf = apt_dir.join('apt.conf')
+        apt_conf.write(self._get_write_files(cloud_config)[
+            generate_build_config.APT_PROXY_CONF_PATH])
+        apt_dir.join('sources.list').write(
+            'deb http://archive.invalid/ubuntu xenial main\n')
+        for state_dir in ('lists/partial', 'archives/partial'):
+            apt_dir.ensure(state_dir, dir=True)
+        env = dict(os.environ, APT_CONFIG=apt_conf.strpath)
+        for variable in ('http_proxy', 'HTTP_PROXY'):
+            env.pop(variable, None)
+        subprocess.call([
+            'apt-get', 'update', '-qq',
+            '-o', 'Dir::Etc={}'.format(apt_dir.strpath),
+            '-o', 'Dir::State={}'.format(apt_dir.strpath),
+            '-o', 'Dir::Cache={}'.format(apt_dir.strpath),
+            '-o', 'APT::Sandbox::User=root'],
+            env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        assert http_server.requests
+        for request in http_server.requests:
+            assert request.startswith('http://archive.invalid/ubuntu/')
+
+
+class TestInstrumentTemplate(object):
+
+    def test_phases_wrapped_in_timer_calls(self, monkeypatch):
+        monkeypatch.setattr(generate_build_config, 'PHASES', {
+            '# One': 'one', '# Untimed': None, '# Two': 'two'})
+        template = '# One\n- a\n\n# Untimed\n- b\n# Two\n- c\n'
+        assert [
+            '# One',
+            '- {homedir}/phase-timer.sh LOG start one',
+            '- a',
+            '- {homedir}/phase-timer.sh LOG end one',
+            '',
+            '# Untimed',
+            '- b',
+            '# Two',
+            '- {homedir}/phase-timer.sh LOG start two',
+            '- c',
+            '- {homedir}/phase-timer.sh LOG end two',
+        ] == generate_build_config._instrument_template(
+            template, 'LOG').splitlines()
+
+    def test_all_phases_present_in_templates(self):
+        template_lines = (
+            generate_build_config.TEMPLATE.splitlines()
+            + generate_build_config.BUILD_TEMPLATE.splitlines()
+            + generate_build_config.POST_PROCESS_TEMPLATE.splitlines()
+            + generate_build_config.PUBLISH_TEMPLATE.splitlines()
+            + generate_build_config.WORKER_TEMPLATE.splitlines()
+            + generate_build_config.WORKER_JOB_TEMPLATE.splitlines()
+            + generate_build_config.PREFETCH_TEMPLATE.splitlines()
+            + generate_build_config.OFFLINE_BUNDLE_TEMPLATE.splitlines())
+        for comment in generate_build_config.PHASES:
+            assert comment in template_lines
+
+
+class TestWriteCloudConfigInstrument(object):
+
+    def test_not_instrumented_by_default(self, write_cloud_config_in_memory):
+        assert 'phase-timer' not in write_cloud_config_in_memory()
+
+    def test_every_phase_timed(self, write_cloud_config_in_memory):
+        runcmd = yaml.safe_load(write_cloud_config_in_memory(
+            artifact_manifest=True, instrument=True,
+            offline_bundle='/srv/offline-bundle.tar', prefetch=True,
+            publish_url='http://example.com/'))['runcmd']
+        for phase in generate_build_config.PHASES.values():
+            if phase is None:
+                continue
+            starts = [index for index, command in enumerate(runcmd)
+                      if command.endswith(' start ' + phase)]
+            ends = [index for index, command in enumerate(runcmd)
+                    if command.endswith(' end ' + phase)]
+            assert 1 == len(starts) == len(ends)
+            assert starts[0] < ends[0]
+
+    def test_phases_timed_around_their_commands(
+            self, write_cloud_config_in_memory):
+        runcmd = yaml.safe_load(write_cloud_config_in_memory(
+            instrument=True))['runcmd']
+        buildlivefs_index = [index for index, command in enumerate(runcmd)
+                             if 'bin/buildlivefs' in command][0]
+        assert runcmd[buildlivefs_index - 1] == (
+            '/home/ubuntu/phase-timer.sh /home/ubuntu/timings-$BUILD_ID.log '
+            'start buildlivefs')
+
+    def test_timings_written_alongside_images(
+            self, write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            instrument=True))
+        assert cloud_config['runcmd'][-1] == (
+            '/home/ubuntu/phase-timer.sh json /home/ubuntu/images/timings.json'
+            ' /home/ubuntu/timings.log /home/ubuntu/timings-$BUILD_ID.log')
+        assert '/home/ubuntu/phase-timer.sh' in [
+            stanza['path'] for stanza in cloud_config['write_files']]
+
+    def test_timings_written_per_build(self, write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            architectures=['amd64', 'i386'], instrument=True))
+        for stanza in cloud_config['write_files']:
+            if stanza['path'] == '/home/ubuntu/build-ubuntu-cpc-i386.sh':
+                script = base64.b64decode(stanza['content']).decode('utf-8')
+                assert ('/home/ubuntu/images/ubuntu-cpc-i386/timings.json'
+                        in script.splitlines()[-1])
+                break
+        else:
+            pytest.fail('No build script for i386.')
+
+
+class TestPhaseTimerScript(object):
+
+    @pytest.fixture
+    def run_script(self, tmpdir):
+        script = tmpdir.join('phase-timer.sh')
+        script.write(generate_build_config.PHASE_TIMER_CONTENT)
+
+        def _run_script(*args):
+            env = dict(os.environ, BUILD_ID='test-build')
+            subprocess.check_call(['sh', script.strpath] + list(args),
+                                  env=env)
+        return _run_script
+
+    def test_json_includes_phases_in_order(self, run_script, tmpdir):
+        shared_log = tmpdir.join('timings.log').strpath
+        build_log = tmpdir.join('timings-test-build.log').strpath
+        run_script(shared_log, 'start', 'fetch')
+        run_script(shared_log, 'end', 'fetch')
+        run_script(build_log, 'start', 'build')
+        run_script(build_log, 'end', 'build')
+        output = tmpdir.join('timings.json')
+        run_script('json', output.strpath, shared_log, build_log)
+        timings = json.loads(output.read())
+        assert 'test-build' == timings['build_id']
+        assert ['fetch', 'build'] == [
+            phase['name'] for phase in timings['phases']]
+        for phase in timings['phases']:
+            assert phase['end'] >= phase['start']
+            assert phase['duration'] >= 0
+
+    def test_incomplete_phase_has_null_duration(self, run_script, tmpdir):
+        log = tmpdir.join('timings.log').strpath
+        run_script(log, 'start', 'build')
+        output = tmpdir.join('timings.json')
+        run_script('json', output.strpath, log)
+        phase = json.loads(output.read())['phases'][0]
+        assert phase['end'] is None
+        assert phase['duration'] is None
+
+
+def _write_timings(path, durations):
+    path.write(json.dumps({'build_id': 'root', 'phases': [
+        {'name': name, 'start': 0, 'end': duration, 'duration': duration}
+        for name, duration in durations]}), ensure=True)
+
+
+class TestBuildTimings(object):
+
+    @pytest.mark.parametrize('percentile,expected', [
+        (0, 1), (50, 2.5), (90, 3.7), (100, 4)])
+    def test_percentile_interpolated(self, percentile, expected):
+        assert expected == pytest.approx(
+            build_timings._percentile([4, 1, 3, 2], percentile))
+
+    def test_percentile_of_single_value(self):
+        assert 5 == build_timings._percentile([5], 99)
+
+    def test_timings_files_found_recursively(self, tmpdir):
+        _write_timings(tmpdir.join('a', 'timings.json'), [])
+        _write_timings(tmpdir.join('b', 'c', 'timings.json'), [])
+        tmpdir.join('b', 'other.json').write('{}')
+        explicit = tmpdir.join('explicit.json')
+        assert sorted([
+            tmpdir.join('a', 'timings.json').strpath,
+            tmpdir.join('b', 'c', 'timings.json').strpath,
+            explicit.strpath]) == sorted(build_timings._find_timings_files(
+                [tmpdir.join('a').strpath, tmpdir.join('b').strpath,
+                 explicit.strpath]))
+
+    def test_durations_grouped_by_phase(self, tmpdir):
+        _write_timings(tmpdir.join('1.json'), [('fetch', 1), ('build', 10)])
+        _write_timings(tmpdir.join('2.json'), [('fetch', 2), ('build', None)])
+        assert {'fetch': [1, 2], 'build': [10]} == \
+            build_timings._load_durations(
+                [tmpdir.join('1.json').strpath, tmpdir.join('2.json').strpath])
+
+    def test_aggregate(self):
+        assert {'fetch': {'count': 3, 'percentiles': {'50': 2}}} == \
+            build_timings._aggregate({'fetch': [1, 2, 3]}, [50])
+
+    def test_main_outputs_table(self, capsys, mocker, tmpdir):
+        for index in range(4):
+            _write_timings(tmpdir.join(str(index), 'timings.json'),
+                           [('fetch', index + 1)])
+        mocker.patch('sys.argv', ['aggregate_build_timings', tmpdir.strpath,
+                                  '--percentiles', '50,100'])
+        build_timings.main()
+        assert ['phase  count  p50   p100', 'fetch  4      2.50  4.00'] == \
+            capsys.readouterr()[0].splitlines()
+
+    def test_main_outputs_json(self, capsys, mocker, tmpdir):
+        _write_timings(tmpdir.join('timings.json'), [('fetch', 1)])
+        mocker.patch('sys.argv', ['aggregate_build_timings', tmpdir.strpath,
+                                  '--json'])
+        build_timings.main()
+        assert 1 == json.loads(capsys.readouterr()[0])['fetch']['count']
+
+    def test_main_exits_nonzero_without_timings(self, mocker, tmpdir):
+        mocker.patch('sys.argv', ['aggregate_build_timings', tmpdir.strpath])
+        with pytest.raises(SystemExit) as excinfo:
+            build_timings.main()
+        assert excinfo.value.code > 0
+
+
+class TestWriteCloudConfigProgress(object):
+
+    def test_no_progress_by_default(self, write_cloud_config_in_memory):
+        assert 'progress.sh' not in write_cloud_config_in_memory()
+
+    def test_phases_reported(self, write_cloud_config_in_memory):
+        runcmd = yaml.safe_load(write_cloud_config_in_memory(
+            artifact_manifest=True, offline_bundle='/srv/offline-bundle.tar',
+            prefetch=True, progress_log='/var/log/progress.log',
+            publish_url='http://example.com/'))['runcmd']
+        for phase in generate_build_config.PHASES.values():
+            if phase is None:
+                continue
+            assert ('/home/ubuntu/progress.sh phase-start phase ' + phase
+                    in runcmd)
+
+    def test_started_and_finished_reported(
+            self, write_cloud_config_in_memory):
+        runcmd = yaml.safe_load(write_cloud_config_in_memory(
+            architectures=['amd64', 'i386'],
+            progress_log='/var/log/progress.log'))['runcmd']
+        assert 'export PROGRESS_LOG=/var/log/progress.log' in runcmd
+        assert '/home/ubuntu/progress.sh started builds 2' in runcmd
+        assert runcmd[-1].startswith(
+            '/home/ubuntu/progress.sh finished builds 2 succeeded ')
+
+    def test_buildlivefs_output_passed_through_stages(
+            self, write_cloud_config_in_memory):
+        runcmd = yaml.safe_load(write_cloud_config_in_memory(
+            progress_log='/var/log/progress.log'))['runcmd']
+        buildlivefs = [command for command in runcmd
+                       if 'bin/buildlivefs' in command][0]
+        assert buildlivefs.endswith('| /home/ubuntu/progress.sh stages')
+
+    def test_script_written(self, write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            progress_log='/var/log/progress.log'))
+        assert '/home/ubuntu/progress.sh' in [
+            stanza['path'] for stanza in cloud_config['write_files']]
+
+    def test_shell_syntax_valid(self):
+        assert [] == generate_build_config._check_build_config(
+            architectures=['amd64', 'i386'], instrument=True,
+            progress_log='/var/log/progress.log')
+
+
+class TestProgressScript(object):
+
+    @pytest.fixture
+    def run_script(self, tmpdir):
+        script = tmpdir.join('progress.sh')
+        script.write(generate_build_config.PROGRESS_CONTENT)
+        log = tmpdir.join('progress.log')
+
+        def _run_script(*args, **kwargs):
+            env = dict(os.environ, BUILD_ID='test-build',
+                       PROGRESS_LOG=log.strpath)
+            process = subprocess.Popen(
+                ['sh', script.strpath] + list(args), env=env,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            output = process.communicate(kwargs.get('input', b''))[0]
+            assert 0 == process.returncode
+            return output, [json.loads(line)
+                            for line in log.read().splitlines()]
+        return _run_script
+
+    def test_event_written(self, run_script):
+        events = run_script('build-end', 'status', '0', 'name', 'amd64')[1]
+        assert 1 == len(events)
+        event = events[0]
+        assert isinstance(event.pop('time'), float)
+        assert {'event': 'build-end', 'build_id': 'test-build',
+                'status': 0, 'name': 'amd64'} == event
+
+    def test_unsafe_characters_removed(self, run_script):
+        events = run_script('note', 'text', 'a"b\\c\td')[1]
+        assert 'abcd' == events[0]['text']
+
+    def test_stages_recorded_and_output_passed_through(self, run_script):
+        output, events = run_script(
+            'stages', input=b'one\nP: Begin bootstrapping\ntwo\n')
+        assert b'one\nP: Begin bootstrapping\ntwo\n' == output
+        assert [('stage', 'Begin bootstrapping')] == [
+            (event['event'], event['stage']) for event in events]
+
+
+class TestWriteCloudConfigPostProcess(object):
+
+    def test_no_post_processing_by_default(
+            self, write_cloud_config_in_memory):
+        assert 'post-process.sh' not in write_cloud_config_in_memory()
+
+    def test_manifest_written_after_images_collected(
+            self, write_cloud_config_in_memory):
+        runcmd = yaml.safe_load(write_cloud_config_in_memory(
+            artifact_manifest=True))['runcmd']
+        assert runcmd[-2:] == [
+            '/home/ubuntu/post-process.sh artifacts /home/ubuntu/images '
+            'none 0',
+            '/home/ubuntu/post-process.sh manifest /home/ubuntu/images']
+        assert runcmd.index('mv $CHROOT_ROOT/build/livecd.ubuntu-cpc.* '
+                            '/home/ubuntu/images') < len(runcmd) - 2
+
+    def test_script_written(self, write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            artifact_manifest=True))
+        assert '/home/ubuntu/post-process.sh' in [
+            stanza['path'] for stanza in cloud_config['write_files']]
+
+    @pytest.mark.parametrize('compressor,package,level', [
+        ('gzip', 'pigz', 6), ('xz', 'xz-utils', 6), ('zstd', 'zstd', 3)])
+    def test_compressor_installed_and_used(
+            self, write_cloud_config_in_memory, compressor, package, level):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            compress_artifacts=compressor))
+        assert package in cloud_config['packages']
+        assert ('/home/ubuntu/post-process.sh artifacts /home/ubuntu/images '
+                '{} {}'.format(compressor, level)) in cloud_config['runcmd']
+
+    def test_compression_level(self, write_cloud_config_in_memory):
+        runcmd = yaml.safe_load(write_cloud_config_in_memory(
+            compress_artifacts='zstd', compression_level=19))['runcmd']
+        assert ('/home/ubuntu/post-process.sh artifacts /home/ubuntu/images '
+                'zstd 19') in runcmd
+
+    @pytest.mark.parametrize('kwargs', [
+        {'compress_artifacts': 'bzip2'},
+        {'compress_artifacts': 'gzip', 'compression_level': 0},
+        {'compress_artifacts': 'zstd', 'compression_level': 20},
+        {'compression_level': 1},
+    ])
+    def test_invalid_compression_rejected(
+            self, write_cloud_config_in_memory, kwargs):
+        with pytest.raises(ValueError):
+            write_cloud_config_in_memory(**kwargs)
+
+    def test_post_processing_timed_before_manifest(
+            self, write_cloud_config_in_memory):
+        runcmd = yaml.safe_load(write_cloud_config_in_memory(
+            artifact_manifest=True, instrument=True))['runcmd']
+        assert runcmd[-4:] == [
+            '/home/ubuntu/post-process.sh artifacts /home/ubuntu/images '
+            'none 0',
+            '/home/ubuntu/phase-timer.sh /home/ubuntu/timings-$BUILD_ID.log '
+            'end post-process-images',
+            '/home/ubuntu/phase-timer.sh json /home/ubuntu/images/timings.json'
+            ' /home/ubuntu/timings.log /home/ubuntu/timings-$BUILD_ID.log',
+            '/home/ubuntu/post-process.sh manifest /home/ubuntu/images']
+
+    def test_shell_syntax_valid(self):
+        assert [] == generate_build_config._check_build_config(
+            architectures=['amd64', 'i386'], compress_artifacts='xz',
+            instrument=True)
+
+
+class TestPostProcessScript(object):
+
+    @pytest.fixture
+    def images(self, tmpdir):
+        images = tmpdir.join('images')
+        images.join('livecd.ubuntu-cpc.img').write(b'a' * 10000, 'wb',
+                                                   ensure=True)
+        images.join('livecd.ubuntu-cpc.squashfs').write(b'squashfs', 'wb')
+        return images
+
+    @pytest.fixture
+    def run_script(self, tmpdir):
+        script = tmpdir.join('post-process.sh')
+        script.write(generate_build_config.POST_PROCESS_CONTENT)
+
+        def _run_script(*args):
+            env = dict(os.environ, BUILD_ID='test-build')
+            subprocess.check_call(['sh', script.strpath] + list(args),
+                                  env=env)
+        return _run_script
+
+    def _get_manifest(self, images):
+        return dict((artifact['name'], artifact) for artifact in json.loads(
+            images.join('manifest.json').read())['artifacts'])
+
+    def test_images_checksummed(self, images, run_script):
+        run_script('artifacts', images.strpath, 'none', '0')
+        run_script('manifest', images.strpath)
+        manifest = self._get_manifest(images)
+        assert sorted(['livecd.ubuntu-cpc.img',
+                       'livecd.ubuntu-cpc.squashfs']) == sorted(manifest)
+        image = manifest['livecd.ubuntu-cpc.img']
+        assert 10000 == image['size']
+        assert hashlib.sha256(b'a' * 10000).hexdigest() == image['sha256']
+        assert image['duration'] >= 0
+
+    @pytest.mark.skipif(
+        subprocess.call(['sh', '-c', 'command -v xz'],
+                        stdout=subprocess.PIPE) != 0,
+        reason='xz is not installed')
+    def test_images_compressed_and_checksummed(self, images, run_script):
+        run_script('artifacts', images.strpath, 'xz', '1')
+        run_script('manifest', images.strpath)
+        assert sorted(['livecd.ubuntu-cpc.img.xz',
+                       'livecd.ubuntu-cpc.squashfs', 'manifest.json']) == \
+            sorted(os.listdir(images.strpath))
+        manifest = self._get_manifest(images)
+        image = manifest['livecd.ubuntu-cpc.img.xz']
+        compressed = images.join('livecd.ubuntu-cpc.img.xz').read('rb')
+        assert len(compressed) == image['size']
+        assert hashlib.sha256(compressed).hexdigest() == image['sha256']
+        assert {'name': 'livecd.ubuntu-cpc.img', 'size': 10000,
+                'sha256': hashlib.sha256(b'a' * 10000).hexdigest()} == \
+            image['uncompressed']
+        assert 'uncompressed' not in manifest['livecd.ubuntu-cpc.squashfs']
+
+    def test_timings_included(self, images, run_script):
+        images.join('timings.json').write('{"phases": []}')
+        run_script('artifacts', images.strpath, 'none', '0')
+        run_script('manifest', images.strpath)
+        manifest = json.loads(images.join('manifest.json').read())
+        assert 'test-build' == manifest['build_id']
+        assert {'phases': []} == manifest['timings']
+
+    def test_timings_null_if_not_instrumented(self, images, run_script):
+        run_script('manifest', images.strpath)
+        assert {'build_id': 'test-build', 'artifacts': [],
+                'timings': None} == json.loads(
+                    images.join('manifest.json').read())
+
+
+class TestWriteCloudConfigPublish(object):
+
+    def test_not_published_by_default(self, write_cloud_config_in_memory):
+        assert 'publish.sh' not in write_cloud_config_in_memory()
+
+    def test_published_after_builds(self, write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            architectures=['amd64', 'i386'],
+            publish_url='http://example.com/images/'))
+        assert cloud_config['runcmd'][-1] == (
+            '/home/ubuntu/publish.sh http://example.com/images/ '
+            '/home/ubuntu/images 0 4')
+        assert '/home/ubuntu/publish.sh' in [
+            stanza['path'] for stanza in cloud_config['write_files']]
+
+    def test_chunk_size_and_jobs(self, write_cloud_config_in_memory):
+        runcmd = yaml.safe_load(write_cloud_config_in_memory(
+            publish_url='https://example.com/images', publish_chunk_size=512,
+            publish_jobs=8))['runcmd']
+        assert runcmd[-1] == ('/home/ubuntu/publish.sh '
+                              'https://example.com/images /home/ubuntu/images '
+                              '512 8')
+
+    @pytest.mark.parametrize('kwargs', [
+        {'publish_url': 'ftp://example.com/images'},
+        {'publish_url': 'https://example.com/images?X-Amz-Signature=abc'},
+        {'publish_url': 'https://example.com/$(reboot)'},
+        {'publish_url': 'https://example.com/', 'publish_jobs': 0},
+        {'publish_url': 'https://example.com/', 'publish_chunk_size': -1},
+    ])
+    def test_invalid_options_rejected(
+            self, write_cloud_config_in_memory, kwargs):
+        with pytest.raises(ValueError):
+            write_cloud_config_in_memory(**kwargs)
+
+    def test_shell_syntax_valid(self):
+        assert [] == generate_build_config._check_build_config(
+            architectures=['amd64', 'i386'], instrument=True,
+            publish_url='https://example.com/images')
+
+
+class TestPublishScript(object):
+
+    @pytest.fixture
+    def images(self, tmpdir):
+        images = tmpdir.mkdir('images')
+        images.join('livecd.ubuntu-cpc.squashfs').write_binary(
+            os.urandom(3 * 1024 * 1024 + 10))
+        images.join('amd64', 'livecd.ubuntu-cpc.manifest').write_binary(
+            b'pkg 1\n', ensure=True)
+        return images
+
+    @pytest.fixture
+    def publish(self, http_server, images, tmpdir):
+        script = tmpdir.join('publish.sh')
+        script.write(generate_build_config.PUBLISH_CONTENT)
+
+        def _publish(chunk_size=0, retries=3):
+            env = dict(os.environ, PUBLISH_RETRIES=str(retries),
+                       PUBLISH_RETRY_DELAY='0')
+            return subprocess.call(
+                ['sh', script.strpath, http_server.url + 'out',
+                 images.strpath, str(chunk_size), '2'],
+                env=env, stderr=subprocess.PIPE)
+        return _publish
+
+    def test_files_uploaded_then_completion_signalled(
+            self, http_server, images, publish):
+        assert 0 == publish()
+        out = http_server.root.join('out')
+        for name in ['livecd.ubuntu-cpc.squashfs',
+                     'amd64/livecd.ubuntu-cpc.manifest']:
+            assert images.join(name).read_binary() == \
+                out.join(name).read_binary()
+        assert '/out/published.json' == http_server.uploads[-1]
+        assert {'files': [
+            {'name': 'amd64/livecd.ubuntu-cpc.manifest', 'size': 6,
+             'chunks': 0},
+            {'name': 'livecd.ubuntu-cpc.squashfs', 'size': 3145738,
+             'chunks': 0},
+        ]} == json.loads(out.join('published.json').read())
+
+    def test_large_files_uploaded_in_chunks(
+            self, http_server, images, publish):
+        assert 0 == publish(chunk_size=1)
+        out = http_server.root.join('out')
+        parts = sorted(path.basename for path in out.listdir(
+            'livecd.ubuntu-cpc.squashfs.part-*'))
+        assert ['livecd.ubuntu-cpc.squashfs.part-0000{}'.format(index)
+                for index in range(4)] == parts
+        assert images.join('livecd.ubuntu-cpc.squashfs').read_binary() == \
+            b''.join(out.join(part).read_binary() for part in parts)
+        assert out.join('amd64', 'livecd.ubuntu-cpc.manifest').check()
+        assert 4 == json.loads(out.join('published.json').read())[
+            'files'][1]['chunks']
+
+    def test_failed_uploads_retried(self, http_server, publish):
+        http_server.failures = 2
+        assert 0 == publish()
+        assert 5 == len(http_server.uploads)
+        assert http_server.root.join('out', 'published.json').check()
+
+    def test_completion_not_signalled_after_failure(
+            self, http_server, publish):
+        http_server.failures = 100
+        assert 0 != publish(retries=2)
+        assert not http_server.root.join('out', 'published.json').check()
+
+
+class TestParseUnsquashfsProcessors(object):
+
+    @pytest.mark.parametrize('value,expected', [('auto', 'auto'), ('4', 4)])
+    def test_valid(self, value, expected):
+        assert expected == \
+            generate_build_config._parse_unsquashfs_processors(value)
+
+    @pytest.mark.parametrize('value', ['0', '-1', 'all'])
+    def test_invalid(self, value):
+        with pytest.raises(argparse.ArgumentTypeError):
+            generate_build_config._parse_unsquashfs_processors(value)
+
+
+class TestWriteCloudConfigSquashfs(object):
+
+    def _get_unsquashfs(self, runcmd):
+        return [command for command in runcmd
+                if 'unsquashfs' in command][0]
+
+    def test_defaults_unchanged(self, write_cloud_config_in_memory):
+        output = write_cloud_config_in_memory()
+        assert 'mksquashfs' not in output
+        assert '-processors' not in output
+
+    @pytest.mark.parametrize('processors,expected', [
+        (3, '-processors 3 '), ('auto', '-processors $(nproc) ')])
+    def test_unsquashfs_processors(
+            self, write_cloud_config_in_memory, processors, expected):
+        runcmd = yaml.safe_load(write_cloud_config_in_memory(
+            unsquashfs_processors=processors))['runcmd']
+        assert expected in self._get_unsquashfs(runcmd)
+
+    def test_auto_processors_shared_between_concurrent_builds(
+            self, write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            architectures=['amd64', 'i386', 'armhf'], parallel_builds=2,
+            unsquashfs_processors='auto'))
+        script = [
+            base64.b64decode(stanza['content']).decode('utf-8')
+            for stanza in cloud_config['write_files']
+            if stanza['path'] == '/home/ubuntu/build-ubuntu-cpc-i386.sh'][0]
+        assert '-processors $(( ($(nproc) + 2 - 1) / 2 )) ' in script
+
+    def test_mksquashfs_wrapped_after_chroot_updated(
+            self, write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            squashfs_compressor='lz4', squashfs_block_size=256))
+        runcmd = cloud_config['runcmd']
+        divert = runcmd.index(
+            'chroot $CHROOT_ROOT dpkg-divert --local --rename --divert '
+            '/usr/bin/mksquashfs.distrib --add /usr/bin/mksquashfs')
+        assert runcmd[divert + 1] == (
+            'cp /home/ubuntu/mksquashfs $CHROOT_ROOT/usr/bin/mksquashfs')
+        assert 'update-debian-chroot' in runcmd[divert - 1]
+        wrapper = [
+            base64.b64decode(stanza['content']).decode('utf-8')
+            for stanza in cloud_config['write_files']
+            if stanza['path'] == '/home/ubuntu/mksquashfs'][0]
+        assert 'COMPRESSOR=lz4\nBLOCK_SIZE=256K\n' in wrapper
+
+    @pytest.mark.parametrize('kwargs', [
+        {'squashfs_compressor': 'bzip2'},
+        {'squashfs_compressor': 'zstd', 'series': 'bionic'},
+        {'squashfs_block_size': 3},
+        {'squashfs_block_size': 2048},
+        {'unsquashfs_processors': 0},
+        {'unsquashfs_processors': 'all'},
+    ])
+    def test_invalid_options_rejected(
+            self, write_cloud_config_in_memory, kwargs):
+        with pytest.raises(ValueError):
+            write_cloud_config_in_memory(**kwargs)
+
+    def test_zstd_allowed_for_newer_series(
+            self, write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            squashfs_compressor='zstd', series='focal'))
+        assert [b'COMPRESSOR=zstd'] == [
+            line for stanza in cloud_config['write_files']
+            if stanza['path'] == '/home/ubuntu/mksquashfs'
+            for line in generate_build_config._get_write_files_content(
+                stanza).splitlines() if line.startswith(b'COMPRESSOR=')]
+
+    def test_shell_syntax_valid(self):
+        assert [] == generate_build_config._check_build_config(
+            architectures=['amd64', 'i386'], squashfs_block_size=1024,
+            squashfs_compressor='xz', unsquashfs_processors='auto')
+
+
+def _get_prefetch_manifest(cloud_config):
+    return [line.split() for stanza in cloud_config['write_files']
+            if stanza['path'] == '/home/ubuntu/prefetch.manifest'
+            for line in generate_build_config._get_write_files_content(
+                stanza).decode('utf-8').splitlines()]
+
+
+class TestWriteCloudConfigPrefetch(object):
+
+    def test_no_prefetch_by_default(self, write_cloud_config_in_memory):
+        assert 'prefetch' not in write_cloud_config_in_memory()
+
+    def test_inputs_prefetched_before_use(
+            self, write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            architectures=['amd64', 'i386'],
+            build_ppa='https://private-ppa.example.com',
+            build_ppa_key='0xDEADBEEF', prefetch=True))
+        url = generate_build_config.BASE_IMAGE_URLS['xenial']
+        assert [
+            ['/home/ubuntu/build-ppa-key.asc', 'url', '-',
+             generate_build_config.PPA_KEY_URL_TEMPLATE.format(
+                 key_id='DEADBEEF')],
+            ['/home/ubuntu/launchpad-buildd', 'bzr', '-',
+             'lp:launchpad-buildd'],
+            ['/tmp/root-amd64.squashfs', 'url', '-',
+             url + 'xenial-server-cloudimg-amd64.squashfs'],
+            ['/tmp/root-i386.squashfs', 'url', '-',
+             url + 'xenial-server-cloudimg-i386.squashfs'],
+        ] == sorted(_get_prefetch_manifest(cloud_config))
+        runcmd = cloud_config['runcmd']
+        prefetch_index = runcmd.index(
+            '/home/ubuntu/prefetch.sh /home/ubuntu/prefetch.manifest '
+            '|| exit 1')
+        assert prefetch_index < runcmd.index(
+            'cd /home/ubuntu/launchpad-buildd; python setup.py install; cd')
+        assert not any(command.startswith(('bzr branch', 'wget'))
+                       for command in runcmd)
+        build_script = [
+            generate_build_config._get_write_files_content(stanza)
+            for stanza in cloud_config['write_files']
+            if stanza['path'] == '/home/ubuntu/build-ubuntu-cpc-amd64.sh'][0]
+        assert (b'chroot $CHROOT_ROOT apt-key add - < '
+                b'/home/ubuntu/build-ppa-key.asc') in build_script
+        assert b'keyserver.ubuntu.com:80' not in build_script
+
+    def test_cached_base_image_checksum_prefetched(
+            self, mocker, write_cloud_config_in_memory):
+        mocker.patch('generate_build_config._get_base_image_checksum',
+                     return_value='abcd')
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            base_image_cache='/cache', prefetch=True))
+        assert ['/cache/xenial/ab/abcd.squashfs', 'url', 'abcd'] in [
+            entry[:3] for entry in _get_prefetch_manifest(cloud_config)]
+        assert ('ln -sf /cache/xenial/ab/abcd.squashfs '
+                '/tmp/root-amd64.squashfs') in cloud_config['runcmd']
+
+    def test_launchpad_buildd_tarball_prefetched(
+            self, write_cloud_config_in_memory):
+        url = 'https://example.com/launchpad-buildd.tar.gz'
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            launchpad_buildd=url, launchpad_buildd_sha256='a' * 64,
+            prefetch=True))
+        assert ['a' * 64, url] in [
+            entry[2:] for entry in _get_prefetch_manifest(cloud_config)]
+        assert not any(url in command for command in cloud_config['runcmd'])
+
+    def test_job_base_images_kept(self, write_cloud_config_in_memory):
+        lines = write_cloud_config_in_memory(
+            prefetch=True, worker_job='job').splitlines()
+        assert not any(line.startswith('wget') for line in lines)
+        assert ('/home/ubuntu/jobs/job/prefetch.sh '
+                '/home/ubuntu/jobs/job/prefetch.manifest || exit 1') in lines
+
+    def test_check_prefetch(self):
+        assert [] == generate_build_config._check_build_config(
+            prefetch=True)
+
+
+class TestPrefetchScript(object):
+
+    @pytest.fixture
+    def run_prefetch(self, tmpdir):
+        script = tmpdir.join('prefetch.sh')
+        script.write(generate_build_config.PREFETCH_CONTENT)
+
+        def _run_prefetch(entries):
+            manifest = tmpdir.join('prefetch.manifest')
+            manifest.write(
+                generate_build_config._format_prefetch_manifest(entries))
+            return subprocess.call(
+                ['sh', script.strpath, manifest.strpath],
+                env=dict(os.environ, PREFETCH_RETRY_DELAY='0'))
+        return _run_prefetch
+
+    def test_inputs_fetched(self, http_server, run_prefetch, tmpdir):
+        http_server.root.join('one').write('one')
+        http_server.root.join('two').write('two')
+        assert 0 == run_prefetch([
+            (tmpdir.join('out', 'one').strpath, 'url',
+             hashlib.sha256(b'one').hexdigest(), [http_server.url + 'one']),
+            (tmpdir.join('out', 'two').strpath, 'newer', None,
+             [http_server.url + 'two'])])
+        assert 'one' == tmpdir.join('out', 'one').read()
+        assert 'two' == tmpdir.join('out', 'two').read()
+
+    def test_failures_retried(self, http_server, run_prefetch, tmpdir):
+        http_server.root.join('file').write('content')
+        http_server.get_failures = 2
+        assert 0 == run_prefetch([(tmpdir.join('file').strpath, 'url', None,
+                                   [http_server.url + 'file'])])
+        assert 'content' == tmpdir.join('file').read()
+
+    def test_later_sources_tried(self, http_server, run_prefetch, tmpdir):
+        http_server.root.join('file').write('content')
+        assert 0 == run_prefetch([(
+            tmpdir.join('file').strpath, 'url', None,
+            [http_server.url + 'missing', http_server.url + 'file'])])
+        assert 'content' == tmpdir.join('file').read()
+
+    def test_checksum_mismatch_fails(self, http_server, run_prefetch,
+                                     tmpdir):
+        http_server.root.join('file').write('content')
+        assert 0 != run_prefetch([(tmpdir.join('file').strpath, 'url',
+                                   'a' * 64, [http_server.url + 'file'])])
+        assert [] == tmpdir.listdir('file*')
+        assert 3 == len(http_server.requests)
+
+    def test_matching_destination_not_fetched(self, http_server,
+                                              run_prefetch, tmpdir):
+        tmpdir.join('file').write('content')
+        assert 0 == run_prefetch([(
+            tmpdir.join('file').strpath, 'url',
+            hashlib.sha256(b'content').hexdigest(),
+            [http_server.url + 'file'])])
+        assert [] == http_server.requests
+
+    def test_empty_manifest(self, run_prefetch):
+        assert 0 == run_prefetch([])
+
+
+@pytest.fixture
+def offline_bundle_inputs(http_server, launchpad_buildd_tarball, mocker):
+    """
+    Serve a base image and PPA signing key from the stand-in HTTP server, in
+    place of the upstream ones; returns the launchpad-buildd tarball to
+    bundle.
+    """
+    image = b'squashfs content'
+    http_server.root.join('xenial-server-cloudimg-amd64.squashfs').write(
+        image, 'wb')
+    http_server.root.join('SHA256SUMS').write(
+        '{} *xenial-server-cloudimg-amd64.squashfs\n'.format(
+            hashlib.sha256(image).hexdigest()))
+    http_server.root.join('keys', 'DEADBEEF').write('key', ensure=True)
+    mocker.patch.dict(generate_build_config.BASE_IMAGE_URLS,
+                      {'xenial': http_server.url})
+    mocker.patch('offline_bundle.PPA_KEY_URL_TEMPLATE',
+                 http_server.url + 'keys/{key_id}')
+    return launchpad_buildd_tarball
+
+
+class TestWriteCloudConfigOfflineBundle(object):
+
+    def test_inputs_taken_from_bundle(self, write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            architectures=['amd64', 'arm64'],
+            build_ppa='https://private-ppa.launchpad.net/foo/bar/ubuntu',
+            build_ppa_key='0xdeadbeef',
+            offline_bundle='/srv/offline-bundle.tar'))
+        runcmd = cloud_config['runcmd']
+        assert ('tar -xf /srv/offline-bundle.tar '
+                '-C /home/ubuntu/offline-bundle') in runcmd
+        assert (
+            'cd /home/ubuntu/offline-bundle; sha256sum -c --quiet SHA256SUMS '
+            '&& ls base-images/xenial/xenial-server-cloudimg-amd64.squashfs '
+            'base-images/xenial/xenial-server-cloudimg-arm64.squashfs '
+            'launchpad-buildd.tar.gz ppa-keys/DEADBEEF.asc '
+            '> /dev/null || exit 1; cd') in runcmd
+        assert ('ln -sf /home/ubuntu/offline-bundle/base-images/xenial/'
+                'xenial-server-cloudimg-arm64.squashfs '
+                '/tmp/root-arm64.squashfs') in runcmd
+        assert ('tar -xf /home/ubuntu/offline-bundle/launchpad-buildd.tar.gz '
+                '-C /home/ubuntu/launchpad-buildd --strip-components=1') \
+            in runcmd
+        assert not any(command.startswith(('bzr', 'wget'))
+                       for command in runcmd)
+        assert 'bzr' not in cloud_config['packages']
+        build_script = [
+            generate_build_config._get_write_files_content(stanza)
+            for stanza in cloud_config['write_files']
+            if stanza['path'] == '/home/ubuntu/build-ubuntu-cpc-amd64.sh'][0]
+        assert (b'chroot $CHROOT_ROOT apt-key add - < /home/ubuntu/'
+                b'offline-bundle/ppa-keys/DEADBEEF.asc') in build_script
+
+    def test_bundle_url_fetched(self, write_cloud_config_in_memory):
+        runcmd = yaml.safe_load(write_cloud_config_in_memory(
+            offline_bundle='http://mirror/offline-bundle.tar'))['runcmd']
+        fetch_index = runcmd.index('wget -nv http://mirror/offline-bundle.tar '
+                                   '-O /home/ubuntu/offline-bundle.tar')
+        assert fetch_index < runcmd.index(
+            'tar -xf /home/ubuntu/offline-bundle.tar '
+            '-C /home/ubuntu/offline-bundle')
+
+    def test_bundle_url_prefetched(self, write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            offline_bundle='http://mirror/offline-bundle.tar', prefetch=True))
+        assert [['/home/ubuntu/offline-bundle.tar', 'url', '-',
+                 'http://mirror/offline-bundle.tar']] == \
+            _get_prefetch_manifest(cloud_config)
+        assert not any(command.startswith('wget')
+                       for command in cloud_config['runcmd'])
+
+    @pytest.mark.parametrize('kwargs', [
+        {'offline_bundle': 'offline-bundle.tar'},
+        {'offline_bundle': 'ftp://mirror/offline-bundle.tar'},
+        {'offline_bundle': '/srv/$(reboot).tar'},
+        {'offline_bundle': '/srv/b.tar', 'base_image_cache': '/cache'},
+        {'offline_bundle': '/srv/b.tar',
+         'launchpad_buildd': 'https://example.com/launchpad-buildd.tar.gz',
+         'launchpad_buildd_sha256': 'a' * 64},
+        {'offline_bundle': '/srv/b.tar', 'image_ppa': 'foo/bar'},
+        {'offline_bundle': '/srv/b.tar', 'build_ppa': 'ppa:foo/bar'},
+    ])
+    def test_invalid_offline_bundle_arguments(
+            self, kwargs, write_cloud_config_in_memory):
+        with pytest.raises(ValueError):
+            write_cloud_config_in_memory(**kwargs)
+
+    def test_worker_unpacks_bundle(self, write_cloud_config_in_memory):
+        runcmd = yaml.safe_load(write_cloud_config_in_memory(
+            architectures=['amd64', 'arm64'],
+            offline_bundle='/srv/offline-bundle.tar', series='bionic',
+            worker=True))['runcmd']
+        assert ('tar -xf /srv/offline-bundle.tar '
+                '-C /home/ubuntu/offline-bundle') in runcmd
+        # The base images that the worker's jobs will use are checked
+        assert (
+            'cd /home/ubuntu/offline-bundle; sha256sum -c --quiet SHA256SUMS '
+            '&& ls base-images/bionic/bionic-server-cloudimg-amd64.squashfs '
+            'base-images/bionic/bionic-server-cloudimg-arm64.squashfs '
+            'launchpad-buildd.tar.gz > /dev/null || exit 1; cd') in runcmd
+        assert 'export PYTHONPATH=/home/ubuntu/launchpad-buildd' in runcmd
+
+    def test_job_uses_worker_bundle(self, write_cloud_config_in_memory):
+        lines = write_cloud_config_in_memory(
+            offline_bundle='/srv/offline-bundle.tar',
+            worker_job='job').splitlines()
+        assert '/srv/offline-bundle.tar' not in '\n'.join(lines)
+        assert ('ln -sf /home/ubuntu/offline-bundle/base-images/xenial/'
+                'xenial-server-cloudimg-amd64.squashfs '
+                '/tmp/root-amd64.squashfs') in lines
+        assert 'export PYTHONPATH=/home/ubuntu/jobs/job/launchpad-buildd' \
+            in lines
+
+    def test_bundle_unpacked_and_checked(self, offline_bundle_inputs,
+                                         tmpdir, write_cloud_config_in_memory):
+        bundle = tmpdir.join('offline-bundle.tar')
+        offline_bundle.make_offline_bundle(
+            bundle.strpath, launchpad_buildd=offline_bundle_inputs.strpath)
+        homedir = tmpdir.mkdir('home')
+
+        def unpack(**kwargs):
+            runcmd = yaml.safe_load(write_cloud_config_in_memory(
+                homedir=homedir.strpath, offline_bundle=bundle.strpath,
+                **kwargs))['runcmd']
+            start = runcmd.index('mkdir -p {}/offline-bundle'.format(
+                homedir.strpath))
+            return subprocess.call(
+                ['sh', '-c', '\n'.join(runcmd[start:start + 3])])
+        assert 0 == unpack()
+        assert homedir.join('offline-bundle', 'base-images', 'xenial',
+                            'xenial-server-cloudimg-amd64.squashfs').check()
+        # The bundle has no key for this PPA
+        assert 0 != unpack(
+            build_ppa='https://private-ppa.launchpad.net/foo/bar/ubuntu',
+            build_ppa_key='DEADBEEF')
+
+    def test_check_offline_bundle(self):
+        assert [] == generate_build_config._check_build_config(
+            offline_bundle='/srv/offline-bundle.tar')
+
+
+class TestOfflineBundle(object):
+
+    def test_bundle_indexed(self, offline_bundle_inputs, tmpdir):
+        bundle = tmpdir.join('offline-bundle.tar')
+        checksums = offline_bundle.make_offline_bundle(
+            bundle.strpath, launchpad_buildd=offline_bundle_inputs.strpath,
+            ppa_keys=['0xdeadbeef'])
+        assert [
+            'base-images/xenial/xenial-server-cloudimg-amd64.squashfs',
+            'launchpad-buildd.tar.gz',
+            'ppa-keys/DEADBEEF.asc',
+        ] == sorted(checksums)
+        with tarfile.open(bundle.strpath) as archive:
+            assert ['SHA256SUMS'] + sorted(checksums) == archive.getnames()
+            index = archive.extractfile('SHA256SUMS').read().decode('utf-8')
+            assert offline_bundle_inputs.read_binary() == archive.extractfile(
+                'launchpad-buildd.tar.gz').read()
+        assert checksums == generate_build_config._parse_sha256sums(index)
+        assert not tmpdir.join('offline-bundle.tar.part').check()
+
+    def test_base_image_checksum_mismatch(self, http_server,
+                                          offline_bundle_inputs, tmpdir):
+        http_server.root.join('xenial-server-cloudimg-amd64.squashfs').write(
+            'corrupt')
+        with pytest.raises(ValueError):
+            offline_bundle.make_offline_bundle(
+                tmpdir.join('offline-bundle.tar').strpath,
+                launchpad_buildd=offline_bundle_inputs.strpath)
+        assert [] == tmpdir.listdir('offline-bundle.tar*')
+
+    def test_launchpad_buildd_url_needs_checksum(
+            self, offline_bundle_inputs, tmpdir):
+        with pytest.raises(ValueError):
+            offline_bundle.make_offline_bundle(
+                tmpdir.join('offline-bundle.tar').strpath,
+                launchpad_buildd='https://example.com/launchpad-buildd.tar.gz')
+
+    def test_launchpad_buildd_exported_by_default(
+            self, mocker, offline_bundle_inputs, tmpdir):
+        check_call = mocker.patch(
+            'subprocess.check_call',
+            side_effect=lambda args: offline_bundle_inputs.copy(
+                py.path.local(args[2])))
+        offline_bundle.make_offline_bundle(
+            tmpdir.join('offline-bundle.tar').strpath)
+        assert ['bzr', 'export'] == check_call.call_args[0][0][:2]
+        assert 'lp:launchpad-buildd' == check_call.call_args[0][0][3]
+
+    @pytest.mark.parametrize('kwargs', [
+        {'series': ['warty']}, {'ppa_keys': ['not-a-key']}])
+    def test_invalid_arguments(self, kwargs, tmpdir):
+        with pytest.raises(ValueError):
+            offline_bundle.make_offline_bundle(
+                tmpdir.join('offline-bundle.tar').strpath, **kwargs)
+
+    def test_main(self, capsys, mocker, offline_bundle_inputs, tmpdir):
+        bundle = tmpdir.join('offline-bundle.tar')
+        mocker.patch('sys.argv', [
+            'make_offline_bundle', '--launchpad-buildd',
+            offline_bundle_inputs.strpath, bundle.strpath])
+        offline_bundle.main()
+        assert bundle.check()
+        assert 'launchpad-buildd.tar.gz' in capsys.readouterr()[0]
+
+
+class TestMksquashfsScript(object):
+
+    @pytest.fixture
+    def run_wrapper(self, tmpdir):
+        fake = tmpdir.join('mksquashfs.distrib')
+        fake.write('#!/bin/sh\nfor arg; do echo "$arg"; done\n')
+        fake.chmod(0o755)
+
+        def _run_wrapper(args, compressor='', block_size=''):
+            wrapper = tmpdir.join('mksquashfs')
+            wrapper.write(generate_build_config.MKSQUASHFS_CONTENT.format(
+                block_size=block_size, compressor=compressor))
+            env = dict(os.environ, MKSQUASHFS=fake.strpath)
+            return subprocess.check_output(
+                ['sh', wrapper.strpath] + args,
+                env=env).decode('utf-8').splitlines()
+        return _run_wrapper
+
+    ARGS = ['chroot', 'out.squashfs', '-no-progress', '-xattrs', '-comp',
+            'xz', '-Xbcj', 'x86', '-Xdict-size', '100%', '-b', '1M',
+            '-noappend']
+
+    def test_arguments_passed_through_if_unconfigured(self, run_wrapper):
+        assert self.ARGS == run_wrapper(self.ARGS)
+
+    def test_compressor_and_its_options_replaced(self, run_wrapper):
+        assert ['chroot', 'out.squashfs', '-no-progress', '-xattrs', '-b',
+                '1M', '-noappend', '-comp', 'lz4'] == run_wrapper(
+                    self.ARGS, compressor='lz4')
+
+    def test_block_size_replaced(self, run_wrapper):
+        assert ['chroot', 'out.squashfs', '-no-progress', '-xattrs',
+                '-comp', 'xz', '-Xbcj', 'x86', '-Xdict-size', '100%',
+                '-noappend', '-b', '256K'] == run_wrapper(
+                    self.ARGS, block_size='256K')
+
+    def test_compressor_options_without_values_dropped(self, run_wrapper):
+        assert ['chroot', 'out', '-noappend', '-comp', 'gzip'] == \
+            run_wrapper(['chroot', 'out', '-comp', 'lz4', '-Xhc',
+                         '-noappend'], compressor='gzip')
+
+    def test_compressor_added_if_not_given(self, run_wrapper):
+        assert ['chroot', 'out', '-comp', 'xz', '-b', '1M'] == run_wrapper(
+            ['chroot', 'out'], compressor='xz', block_size='1M')
+
+
+class TestWriteCloudConfigWorker(object):
+
+    def test_worker_only_sets_up(self, write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+            customisation_script=__file__, worker=True))
+        assert generate_build_config.PACKAGES == cloud_config['packages']
+        runcmd = cloud_config['runcmd']
+        assert ('bzr branch lp:launchpad-buildd '
+                '/home/ubuntu/launchpad-buildd') in runcmd
+        assert not any('buildlivefs' in command or 'wget' in command
+                       for command in runcmd)
+        assert ('systemctl enable --now --no-block '
+                'ubuntu-standalone-builder-worker.service') == runcmd[-1]
+        assert [
+            '/home/ubuntu/worker.sh',
+            '/etc/systemd/system/ubuntu-standalone-builder-worker.service',
+        ] == [stanza['path'] for stanza in cloud_config['write_files']]
+
+    @pytest.mark.parametrize('kwargs', [
+        {'worker': True, 'worker_job': 'job'},
+        {'worker_job': ''},
+        {'worker_job': '../job'},
+        {'worker_job': 'a job'},
+    ])
+    def test_invalid_worker_arguments(self, kwargs,
+                                      write_cloud_config_in_memory):
+        with pytest.raises(ValueError):
+            write_cloud_config_in_memory(**kwargs)
+
+    def test_job_builds_in_its_own_directory(
+            self, write_cloud_config_in_memory):
+        script = write_cloud_config_in_memory(worker_job='job-1')
+        assert script.startswith('#!/bin/sh\n')
+        lines = script.splitlines()
+        assert 'export HOME=/home/ubuntu/jobs/job-1' in lines
+        assert ('ln -sfn /home/ubuntu/launchpad-buildd '
+                '/home/ubuntu/jobs/job-1/launchpad-buildd') in lines
+        assert 'bzr branch' not in script
+        assert ('mv $CHROOT_ROOT/build/livecd.ubuntu-cpc.* '
+                '/home/ubuntu/jobs/job-1/images') in lines
+        assert ('for tree in /home/ubuntu/jobs/job-1/build-*/; do '
+                'rm -rf --one-file-system $tree; done') == lines[-2]
+        assert [] == generate_build_config._check_shell_syntax(script, 'job')
+
+    def test_job_keeps_base_images(self, write_cloud_config_in_memory):
+        lines = write_cloud_config_in_memory(
+            worker_job='job', series='bionic').splitlines()
+        assert ('wget -N -nv -P /home/ubuntu/base-images/bionic '
+                'http://cloud-images.ubuntu.com/bionic/current/'
+                'bionic-server-cloudimg-amd64.squashfs') in lines
+        assert ('ln -sf /home/ubuntu/base-images/bionic/'
+                'bionic-server-cloudimg-amd64.squashfs '
+                '/tmp/root-amd64.squashfs') in lines
+
+    def test_job_uses_launchpad_buildd_tarball_installed(
+            self, write_cloud_config_in_memory):
+        script = write_cloud_config_in_memory(
+            launchpad_buildd='https://example.com/launchpad-buildd.tar.gz',
+            launchpad_buildd_sha256='a' * 64, worker_job='job')
+        assert 'example.com' not in script
+        assert ('export PYTHONPATH=/home/ubuntu/jobs/job/launchpad-buildd'
+                in script.splitlines())
+
+    @pytest.mark.parametrize('compress_payloads', [True, False])
+    def test_job_writes_files(self, compress_payloads, tmpdir,
+                              write_cloud_config_in_memory):
+        script = tmpdir.join('customise.sh')
+        script.write('#!/bin/sh\necho customised\n')
+        lines = write_cloud_config_in_memory(
+            compress_payloads=compress_payloads,
+            customisation_script=script.strpath, homedir=tmpdir.strpath,
+            worker_job='job').splitlines()
+        # Only run the part of the job which writes its files
+        subprocess.check_call(['sh', '-e', '-c', '\n'.join(
+            lines[:lines.index('export HOME={}/jobs/job'.format(
+                tmpdir.strpath))])])
+        hooks = tmpdir.join('jobs', 'job', 'build-root', 'chroot-autobuild',
+                            'usr', 'share', 'livecd-rootfs', 'live-build',
+                            'ubuntu-cpc', 'hooks')
+        hook = hooks.join('9998-local-modifications.chroot')
+        assert script.read() == hook.read()
+        assert 0o755 == hook.stat().mode & 0o777
+
+    def test_check_job(self):
+        assert [] == generate_build_config._check_build_config(
+            worker_job='job')
+
+
+def _run_worker(homedir):
+    worker = homedir.join('worker.sh')
+    worker.write(generate_build_config.WORKER_CONTENT)
+    subprocess.check_call(['sh', worker.strpath, homedir.strpath],
+                          env=dict(os.environ, WORKER_ONCE='1'))
+
+
+class TestWorkerScript(object):
+
+    def test_jobs_run_in_order(self, tmpdir):
+        queue = tmpdir.ensure('jobs', 'queue', dir=True)
+        order = tmpdir.join('order')
+        for age, name in enumerate(['second', 'first']):
+            job = queue.join('{}.sh'.format(name))
+            job.write('pwd >> {}\necho output\n'.format(order.strpath))
+            job.setmtime(1000000 - age)
+        queue.join('partial.sh.part').write('exit 1\n')
+        _run_worker(tmpdir)
+        assert [tmpdir.join('jobs', name).strpath
+                for name in ('first', 'second')] == order.read().split()
+        for name in ('first', 'second'):
+            job_dir = tmpdir.join('jobs', name)
+            assert '0\n' == job_dir.join('exit-status').read()
+            assert 'output\n' == job_dir.join('job.log').read()
+            assert job_dir.join('job.sh').check()
+        assert ['partial.sh.part'] == [path.basename
+                                       for path in queue.listdir()]
+
+    def test_exit_status_recorded(self, tmpdir):
+        tmpdir.ensure('jobs', 'queue', 'failing.sh').write('exit 3\n')
+        _run_worker(tmpdir)
+        assert '3\n' == tmpdir.join('jobs', 'failing', 'exit-status').read()
+
+    def test_job_names_not_reused(self, tmpdir):
+        tmpdir.ensure('jobs', 'job', 'images', dir=True)
+        tmpdir.ensure('jobs', 'queue', 'job.sh').write('exit 0\n')
+        _run_worker(tmpdir)
+        assert not tmpdir.join('jobs', 'job', 'exit-status').check()
+        assert tmpdir.join('jobs', 'queue', 'job.duplicate').check()
+
+
+def _write_events(path, events, mode='a'):
+    with open(path, mode) as f:
+        for event in events:
+            f.write(json.dumps(event) + '\n')
+
+
+class TestBuildProgress(object):
+
+    def test_follow_yields_complete_lines(self, tmpdir):
+        log = tmpdir.join('progress.log')
+        log.write('one\ntwo\nthr')
+        assert [('one', 4), ('two', 8)] == [
+            (line, offset) for line, offset, _ in build_progress._follow(
+                log.strpath, follow=False)]
+
+    def test_follow_resumes_from_offset(self, tmpdir):
+        log = tmpdir.join('progress.log')
+        log.write('one\ntwo\n')
+        inode = os.stat(log.strpath).st_ino
+        assert ['two'] == [line for line, _, _ in build_progress._follow(
+            log.strpath, 4, inode, follow=False)]
+
+    def test_follow_restarts_replaced_file(self, tmpdir):
+        log = tmpdir.join('progress.log')
+        log.write('one\ntwo\n')
+        inode = os.stat(log.strpath).st_ino
+        log.remove()
+        tmpdir.join('other').write('new\n')
+        tmpdir.join('other').rename(log)
+        assert ['new'] == [line for line, _, _ in build_progress._follow(
+            log.strpath, 8, inode, follow=False)]
+
+    def test_follow_restarts_truncated_file(self, tmpdir):
+        log = tmpdir.join('progress.log')
+        log.write('new\n')
+        assert ['new'] == [line for line, _, _ in build_progress._follow(
+            log.strpath, 100, follow=False)]
+
+    def test_follow_waits_for_more_lines(self, tmpdir):
+        log = tmpdir.join('progress.log')
+        log.write('one\n')
+        lines = build_progress._follow(log.strpath, poll_interval=0.01)
+        assert 'one' == next(lines)[0]
+        threading.Timer(0.05, log.write, ['two\n', 'a']).start()
+        assert 'two' == next(lines)[0]
+
+    def test_follow_follows_rotated_file(self, tmpdir):
+        log = tmpdir.join('progress.log')
+        log.write('one\n')
+        lines = build_progress._follow(log.strpath, poll_interval=0.01)
+        assert 'one' == next(lines)[0]
+
+        def _rotate():
+            log.rename(tmpdir.join('progress.log.1'))
+            log.write('two\n')
+        threading.Timer(0.05, _rotate).start()
+        assert ('two', 4) == next(lines)[:2]
+
+    def test_follow_skips_overlong_lines(self, tmpdir):
+        log = tmpdir.join('progress.log')
+        log.write('x' * 100 + '\nshort\n')
+        assert [('short', 107)] == [
+            (line, offset) for line, offset, _ in build_progress._follow(
+                log.strpath, follow=False, max_line_length=10)]
+
+    @pytest.mark.parametrize('line', ['', 'not json', '[1]', '{"a": 1}'])
+    def test_non_events_ignored(self, line):
+        assert build_progress._parse_event(line) is None
+
+    def test_status_keeps_latest_state_per_build(self):
+        status = {}
+        for event in [
+                {'event': 'started', 'builds': 2},
+                {'event': 'phase-start', 'phase': 'fetch'},
+                {'event': 'phase-start', 'phase': 'build', 'build_id': 'a'},
+                {'event': 'stage', 'stage': 'one', 'build_id': 'a'},
+                {'event': 'stage', 'stage': 'two', 'build_id': 'a'},
+                {'event': 'build-end', 'status': 0, 'images': 3,
+                 'build_id': 'b'}]:
+            build_progress._update_status(status, event)
+        assert {
+            'builds_expected': 2,
+            'shared': {'phase': 'fetch'},
+            'builds': {
+                'a': {'phase': 'build', 'stage': 'two'},
+                'b': {'status': 0, 'images': 3}},
+        } == status
+
+    def test_main_outputs_events(self, capsys, mocker, tmpdir):
+        log = tmpdir.join('progress.log')
+        _write_events(log.strpath, [
+            {'time': 0, 'event': 'stage', 'build_id': 'a', 'stage': 'x'}])
+        mocker.patch('sys.argv', ['follow_build_progress', log.strpath,
+                                  '--no-follow'])
+        build_progress.main()
+        assert capsys.readouterr()[0].split(' ', 1)[1] == 'a stage stage=x\n'
+
+    def test_main_outputs_json(self, capsys, mocker, tmpdir):
+        log = tmpdir.join('progress.log')
+        event = {'time': 0, 'event': 'stage', 'stage': 'x'}
+        _write_events(log.strpath, [event])
+        mocker.patch('sys.argv', ['follow_build_progress', log.strpath,
+                                  '--no-follow', '--json'])
+        build_progress.main()
+        assert event == json.loads(capsys.readouterr()[0])
+
+    def test_main_resumes_from_offset_file(self, capsys, mocker, tmpdir):
+        log = tmpdir.join('progress.log')
+        offset_file = tmpdir.join('offset.json')
+        _write_events(log.strpath, [{'event': 'one'}])
+        mocker.patch('sys.argv', ['follow_build_progress', log.strpath,
+                                  '--no-follow', '--json',
+                                  '--offset-file', offset_file.strpath])
+        build_progress.main()
+        _write_events(log.strpath, [{'event': 'two'}])
+        build_progress.main()
+        assert ['one', 'two'] == [
+            json.loads(line)['event']
+            for line in capsys.readouterr()[0].splitlines()]
+
+    @pytest.mark.parametrize('succeeded,code', [(2, 0), (1, 1)])
+    def test_main_until_finished(self, mocker, tmpdir, succeeded, code):
+        log = tmpdir.join('progress.log')
+        _write_events(log.strpath, [
+            {'event': 'finished', 'builds': 2, 'succeeded': succeeded},
+            {'event': 'never-reached'}])
+        mocker.patch('sys.argv', ['follow_build_progress', log.strpath,
+                                  '--until-finished'])
+        with pytest.raises(SystemExit) as excinfo:
+            build_progress.main()
+        assert code == excinfo.value.code
+
+    def test_main_until_finished_without_finish(self, mocker, tmpdir):
+        log = tmpdir.join('progress.log')
+        _write_events(log.strpath, [{'event': 'started', 'builds': 1}])
+        mocker.patch('sys.argv', ['follow_build_progress', log.strpath,
+                                  '--until-finished', '--no-follow'])
+        with pytest.raises(SystemExit) as excinfo:
+            build_progress.main()
+        assert 2 == excinfo.value.code
+
+
+class TestLocalBuild(object):
+
+    def test_get_homedir(self):
+        assert '/home/builder' == local_build._get_homedir(
+            {'runcmd': [['ls'], 'export HOME=/home/builder', 'true']})
+
+    def test_get_homedir_defaults(self):
+        assert local_build.DEFAULT_HOMEDIR == local_build._get_homedir({})
+
+    def test_provision_script_does_what_cloud_init_would(
+            self, monkeypatch, tmpdir):
+        monkeypatch.setattr(local_build, 'RUNCMD_PATH',
+                            tmpdir.join('runcmd.sh').strpath)
+        plain, encoded = tmpdir.join('a', 'plain'), tmpdir.join('b', 'gz')
+        stanza = yaml.safe_load(
+            generate_build_config._produce_write_files_stanza(
+                b'encoded\n', encoded.strpath, '0600', compress=True))[0]
+        # So that this can run as any user
+        del stanza['owner']
+        cloud_config = {
+            'write_files': [
+                {'path': plain.strpath, 'content': 'plain\n',
+                 'permissions': '0755'},
+                stanza,
+            ],
+            'runcmd': [
+                'export OUTPUT={}'.format(tmpdir.join('output').strpath),
+                'echo first > "$OUTPUT"',
+                ['sh', '-c', 'echo "second one" >> "$OUTPUT"'],
+            ],
+        }
+        subprocess.check_call(
+            ['sh', '-c', local_build._get_provision_script(cloud_config)])
+        assert 'plain\n' == plain.read()
+        assert 0o755 == plain.stat().mode & 0o777
+        assert 'encoded\n' == encoded.read()
+        assert 0o600 == encoded.stat().mode & 0o777
+        assert 'first\nsecond one\n' == tmpdir.join('output').read()
+
+    def test_provision_script_of_build_config_is_valid_shell(
+            self, write_cloud_config_in_memory):
+        cloud_config = yaml.safe_load(write_cloud_config_in_memory())
+        script = local_build._get_provision_script(cloud_config)
+        assert 'apt-get install' in script
+        assert [] == generate_build_config._check_shell_syntax(
+            script, 'provision.sh')
+
+    @pytest.fixture
+    def loop_devices(self, mocker):
+        mocker.patch('local_build.glob.glob',
+                     return_value=['/dev/loop10', '/dev/loop1', '/dev/loop0'])
+        return ['/dev/loop0', '/dev/loop1', '/dev/loop10']
+
+    def test_get_loop_devices(self, loop_devices):
+        assert loop_devices == local_build._get_loop_devices()
+
+    @pytest.mark.parametrize('cgroup2,key', [
+        (False, 'lxc.cgroup.devices.allow'),
+        (True, 'lxc.cgroup2.devices.allow'),
+    ])
+    def test_lxd_config_allows_loop_devices(self, mocker, cgroup2, key):
+        exists = mocker.patch('local_build.os.path.exists',
+                              return_value=cgroup2)
+        raw_lxc = local_build._get_lxd_config()['raw.lxc'].splitlines()
+        exists.assert_called_once_with(local_build.CGROUP2_CONTROLLERS)
+        assert ['{} = b 7:* rwm'.format(key),
+                '{} = c 10:237 rwm'.format(key)] == raw_lxc[:2]
+        assert 'lxc.apparmor.profile = unconfined' in raw_lxc
+
+    def test_lxd_commands(self, loop_devices):
+        commands, cleanup = local_build._get_lxd_commands(
+            'name', 'provision.sh', '/home/ubuntu', output_dir='out')
+        assert ['lxc', 'launch', local_build.DEFAULT_LXD_IMAGE,
+                'name'] == commands[0][:4]
+        assert 'security.privileged=true' in commands[0]
+        assert [
+            ['lxc', 'config', 'device', 'add', 'name', 'loop0',
+             'unix-block', 'path=/dev/loop0'],
+            ['lxc', 'config', 'device', 'add', 'name', 'loop1',
+             'unix-block', 'path=/dev/loop1'],
+            ['lxc', 'config', 'device', 'add', 'name', 'loop10',
+             'unix-block', 'path=/dev/loop10'],
+        ] == commands[1:4]
+        assert 'source={}'.format(os.path.abspath('out')) in commands[4]
+        assert 'path=/home/ubuntu/images' in commands[4]
+        assert ['lxc', 'exec', 'name', '--', 'sh',
+                local_build.PROVISION_PATH] == commands[-1]
+        assert ['lxc', 'delete', '--force', 'name'] == cleanup
+
+    def test_lxd_commands_keep(self, mocker):
+        mocker.patch('local_build.glob.glob', return_value=[])
+        commands, cleanup = local_build._get_lxd_commands(
+            'name', 'provision.sh', '/home/ubuntu', keep=True)
+        assert cleanup is None
+        assert not any('device' in command for command in commands)
+
+    @pytest.mark.parametrize('keep', [True, False])
+    def test_nspawn_commands(self, keep, loop_devices):
+        commands, cleanup = local_build._get_nspawn_commands(
+            'name', 'provision.sh', '/home/ubuntu', output_dir='out',
+            directory='/srv/xenial', keep=keep)
+        assert cleanup is None
+        assert 1 == len(commands)
+        command = commands[0]
+        assert ['/srv/xenial', 'name'] == [
+            command[command.index('--directory') + 1],
+            command[command.index('--machine') + 1]]
+        assert '--bind={}:/home/ubuntu/images'.format(
+            os.path.abspath('out')) in command
+        assert keep != ('--ephemeral' in command)
+        assert ['sh', local_build.PROVISION_PATH] == command[-2:]
+        for path in loop_devices + ['/dev/loop-control']:
+            assert '--bind={}'.format(path) in command
+        assert '--property=DeviceAllow=block-loop rwm' in command
+
+    @pytest.mark.parametrize('returncodes,images,expected', [
+        ([0, 0, 0, 0, 0], True, True),
+        ([0, 0, 0, 0, 0], False, False),
+        ([0, 1], True, False),
+    ])
+    def test_run_build(self, mocker, tmpdir, returncodes, images, expected):
+        config = tmpdir.join('config.yaml')
+        config.write(yaml.safe_dump({'runcmd': ['true']}))
+        output_dir = tmpdir.join('images')
+        calls = []
+
+        def call(command, **kwargs):
+            calls.append(command)
+            if images:
+                output_dir.ensure('livecd.ubuntu-cpc.img')
+            if command[:2] == ['lxc', 'delete']:
+                return 0
+            return returncodes.pop(0)
+
+        mocker.patch('subprocess.call', side_effect=call)
+        mocker.patch('local_build.glob.glob', return_value=[])
+        assert expected == local_build._run_build(
+            config.strpath, 'name', 'lxd', output_dir=output_dir.strpath)
+        assert ['lxc', 'delete', '--force', 'name'] == calls[-1]
+        assert [] == tmpdir.listdir(lambda path: 'provision-' in path.basename)
+
+    def test_main_print_script(self, capsys, mocker, tmpdir):
+        config = tmpdir.join('config.yaml')
+        config.write(yaml.safe_dump({'runcmd': ['echo hello']}))
+        mocker.patch('sys.argv', ['run_local_build', '--print-script',
+                                  config.strpath])
+        local_build.main()
+        assert '\necho hello\n' in capsys.readouterr()[0]
+
+    def test_main_nspawn_requires_directory(self, mocker, tmpdir):
+        mocker.patch('sys.argv', ['run_local_build', '--backend', 'nspawn',
+                                  tmpdir.join('config.yaml').strpath])
+        with pytest.raises(SystemExit) as excinfo:
+            local_build.main()
+        assert excinfo.value.code > 0
+
+    def test_main_runs_each_config(self, capsys, mocker, tmpdir):
+        # The builds run in threads, so fail two.yaml's by its path
+        run_build = mocker.patch(
+            'local_build._run_build',
+            side_effect=lambda config_path, *args, **kwargs: (
+                config_path != 'two.yaml'))
+        mocker.patch('sys.argv', [
+            'run_local_build', '--output-dir', tmpdir.strpath,
+            'one.yaml', 'two.yaml'])
+        with pytest.raises(SystemExit) as excinfo:
+            local_build.main()
+        assert 1 == excinfo.value.code
+        assert 2 == run_build.call_count
+        assert sorted([tmpdir.join('one', 'images').strpath,
+                       tmpdir.join('two', 'images').strpath]) == sorted(
+            call[1]['output_dir'] for call in run_build.call_args_list)
+        assert tmpdir.join('one', 'build.log').check()
+        output = capsys.readouterr()[0]
+        assert 'one.yaml: succeeded' in output
+        assert 'two.yaml: failed' in output
+
+    @pytest.mark.parametrize('error', [
+        IOError(2, 'No such file or directory'),
+        OSError(2, 'No such file or directory: systemd-nspawn'),
+    ])
+    def test_main_fails_builds_which_raise(self, capsys, error, mocker,
+                                           tmpdir):
+        mocker.patch('local_build._run_build', side_effect=error)
+        mocker.patch('sys.argv', [
+            'run_local_build', '--output-dir', tmpdir.strpath, 'one.yaml'])
+        with pytest.raises(SystemExit) as excinfo:
+            local_build.main()
+        assert 1 == excinfo.value.code
+        output, errors = capsys.readouterr()
+        assert 'one.yaml: failed' in output
+        assert 'No such file or directory' in errors
+
+    def test_main_fails_missing_config(self, capsys, mocker, tmpdir):
+        mocker.patch('sys.argv', [
+            'run_local_build', '--output-dir', tmpdir.strpath,
+            tmpdir.join('missing.yaml').strpath])
+        with pytest.raises(SystemExit) as excinfo:
+            local_build.main()
+        assert 1 == excinfo.value.code
+        assert 'missing.yaml: failed' in capsys.readouterr()[0]
+
+    def test_main_keeps_configs_with_the_same_name_apart(
+            self, mocker, tmpdir):
+        run_build = mocker.patch(
+            'local_build._run_build',
+            side_effect=lambda config_path, *args, **kwargs: (
+                config_path == 'a/config.yaml'))
+        mocker.patch('sys.argv', [
+            'run_local_build', '--output-dir', tmpdir.strpath,
+            'a/config.yaml', 'b/config.yaml', 'a/config.yaml'])
+        with pytest.raises(SystemExit) as excinfo:
+            local_build.main()
+        # b/config.yaml's failure isn't hidden by a success of the same name
+        assert 1 == excinfo.value.code
+        assert sorted(tmpdir.join('config-{}'.format(index), 'images').strpath
+                      for index in range(3)) == sorted(
+            call[1]['output_dir'] for call in run_build.call_args_list)
+
+
+class FakeBackend(build_scheduler.InstanceBackend):
+    """
+    An in-process instance backend, whose jobs finish when told to (or, with
+    auto_finish, succeed when first polled).
+    """
+
+    max_jobs_per_instance = None
+
+    def __init__(self, auto_finish=False, fail_launch=False):
+        self.auto_finish = auto_finish
+        self.fail_launch = fail_launch
+        self.launched = []
+        self.terminated = []
+        self.results = {}
+
+    def launch(self, name, resources, jobs):
+        if self.fail_launch:
+            raise RuntimeError('no capacity')
+        self.launched.append((name, resources, [job.id for job in jobs]))
+        return name
+
+    def poll(self, instance):
+        job_ids = dict((name, ids) for name, _, ids in self.launched)[instance]
+        if self.auto_finish:
+            for job_id in job_ids:
+                self.results.setdefault(job_id, (build_scheduler.SUCCEEDED,
+                                                 None))
+        return dict((job_id, self.results[job_id])
+                    for job_id in job_ids if job_id in self.results)
+
+    def terminate(self, instance):
+        self.terminated.append(instance)
+
+    def finish(self, job, state=build_scheduler.SUCCEEDED, error=None):
+        self.results[job.id] = (state, error)
+
+
+class TestBuildScheduler(object):
+
+    @pytest.mark.parametrize('kwargs,expected', [
+        ({}, (2, 4096, 20)),
+        ({'architectures': ['amd64', 'arm64', 'i386']}, (6, 12288, 60)),
+        ({'architectures': ['amd64', 'arm64', 'i386'], 'parallel_builds': 1},
+         (2, 4096, 60)),
+        ({'chroot_storage': 'tmpfs'}, (2, 4096 + 10240, 20)),
+        ({'chroot_storage': 'zram', 'chroot_storage_size': 2048},
+         (2, 6144, 20)),
+    ])
+    def test_get_job_resources(self, kwargs, expected):
+        assert expected == build_scheduler._get_job_resources(
+            generate_build_config.BuildConfig(**kwargs))
+
+    def test_identical_configs_are_one_job(self):
+        scheduler = build_scheduler.Scheduler(FakeBackend())
+        first = scheduler.submit(generate_build_config.BuildConfig(
+            series='bionic'))
+        second = scheduler.submit(generate_build_config.BuildConfig(
+            series='bionic'))
+        third = scheduler.submit(generate_build_config.BuildConfig())
+        assert first is second
+        assert 2 == first.submissions
+        assert third is not first
+        assert 2 == len(scheduler.jobs)
+
+    def test_job_too_big_for_an_instance(self):
+        scheduler = build_scheduler.Scheduler(
+            FakeBackend(), budget=build_scheduler.Resources(8, 16384, 40))
+        with pytest.raises(ValueError):
+            scheduler.submit(generate_build_config.BuildConfig(
+                architectures=['amd64', 'arm64', 'i386']))
+
+    def test_jobs_are_packed_on_to_instances(self):
+        backend = FakeBackend()
+        scheduler = build_scheduler.Scheduler(backend)
+        big = scheduler.submit(generate_build_config.BuildConfig(
+            architectures=['amd64', 'arm64', 'i386']))
+        small = [scheduler.submit(generate_build_config.BuildConfig(
+            series=series)) for series in ('xenial', 'bionic', 'focal')]
+        assert 2 == len(scheduler.schedule())
+        assert [((8, 16384, 80), [big.id, small[0].id]),
+                ((4, 8192, 40), [small[1].id, small[2].id])] == [
+            (resources, job_ids) for _, resources, job_ids in backend.launched]
+        assert all(build_scheduler.RUNNING == job.state
+                   for job in scheduler.jobs.values())
+
+    def test_one_job_per_instance_by_default(self, monkeypatch):
+        backend = FakeBackend()
+        monkeypatch.setattr(backend, 'max_jobs_per_instance', 1)
+        scheduler = build_scheduler.Scheduler(backend)
+        jobs = [scheduler.submit(generate_build_config.BuildConfig(
+            series=series)) for series in ('xenial', 'bionic')]
+        assert 2 == len(scheduler.schedule())
+        assert sorted([[job.id] for job in jobs]) == sorted(
+            job_ids for _, _, job_ids in backend.launched)
+        assert 1 == build_scheduler.InstanceBackend.max_jobs_per_instance
+
+    def test_max_instances(self):
+        backend = FakeBackend()
+        scheduler = build_scheduler.Scheduler(
+            backend, budget=build_scheduler.Resources(2, 4096, 20),
+            max_instances=1)
+        first, second = [scheduler.submit(generate_build_config.BuildConfig(
+            series=series)) for series in ('xenial', 'bionic')]
+        assert ['usb-0'] == scheduler.schedule()
+        assert [] == scheduler.schedule()
+        assert build_scheduler.QUEUED == second.state
+        backend.finish(first)
+        scheduler.poll()
+        assert build_scheduler.SUCCEEDED == first.state
+        assert ['usb-0'] == backend.terminated
+        assert ['usb-1'] == scheduler.schedule()
+        assert 'usb-1' == second.instance
+
+    def test_instance_kept_until_all_its_jobs_finish(self):
+        backend = FakeBackend()
+        scheduler = build_scheduler.Scheduler(backend)
+        first, second = [scheduler.submit(generate_build_config.BuildConfig(
+            series=series)) for series in ('xenial', 'bionic')]
+        scheduler.schedule()
+        backend.finish(first, build_scheduler.FAILED, 'oops')
+        scheduler.poll()
+        assert (build_scheduler.FAILED, 'oops') == (first.state, first.error)
+        assert [] == backend.terminated
+        backend.finish(second)
+        scheduler.poll()
+        assert ['usb-0'] == backend.terminated
+        assert {'queued': 0, 'running': 0, 'succeeded': 1,
+                'failed': 1} == scheduler.get_summary()
+
+    def test_failed_launch_fails_jobs(self):
+        scheduler = build_scheduler.Scheduler(FakeBackend(fail_launch=True))
+        job = scheduler.submit(generate_build_config.BuildConfig())
+        assert scheduler.run(poll_interval=0) is False
+        assert (build_scheduler.FAILED, 'no capacity') == (job.state,
+                                                           job.error)
+
+    def test_resubmitting_failed_job_queues_it(self):
+        backend = FakeBackend()
+        scheduler = build_scheduler.Scheduler(backend)
+        job = scheduler.submit(generate_build_config.BuildConfig())
+        scheduler.schedule()
+        backend.finish(job, build_scheduler.FAILED, 'oops')
+        scheduler.poll()
+        assert job is scheduler.submit(generate_build_config.BuildConfig())
+        assert (build_scheduler.QUEUED, None) == (job.state, job.error)
+
+    def test_run(self):
+        backend = FakeBackend(auto_finish=True)
+        scheduler = build_scheduler.Scheduler(
+            backend, budget=build_scheduler.Resources(2, 4096, 20))
+        for series in ('xenial', 'bionic'):
+            scheduler.submit(generate_build_config.BuildConfig(series=series))
+        assert scheduler.run(poll_interval=0) is True
+        assert ['usb-0', 'usb-1'] == sorted(backend.terminated)
+
+    def test_local_build_backend(self, mocker, tmpdir):
+        # The builds run in threads, so fail bionic's by its config path
+        run_build = mocker.patch(
+            'local_build._run_build',
+            side_effect=lambda config_path, *args, **kwargs: (
+                'bionic' not in config_path))
+        backend = build_scheduler.LocalBuildBackend(tmpdir.strpath,
+                                                    image='ubuntu:18.04')
+        scheduler = build_scheduler.Scheduler(backend)
+        jobs = [scheduler.submit(generate_build_config.BuildConfig(
+            series=series), name=series) for series in ('xenial', 'bionic')]
+        assert scheduler.run(poll_interval=0.01) is False
+        assert [build_scheduler.SUCCEEDED, build_scheduler.FAILED] == [
+            job.state for job in jobs]
+        assert jobs[0].cloud_config == tmpdir.join(
+            'xenial', 'build-config.yaml').read()
+        assert tmpdir.join('bionic', 'build.log').strpath in jobs[1].error
+        assert ['usb-0-0', 'usb-0-1'] == sorted(
+            call[0][1] for call in run_build.call_args_list)
+        assert all('ubuntu:18.04' == call[1]['image']
+                   for call in run_build.call_args_list)
+
+    def test_main(self, capsys, mocker, tmpdir):
+        backend = FakeBackend(auto_finish=True)
+        mocker.patch('build_scheduler.LocalBuildBackend',
+                     return_value=backend)
+        matrix = tmpdir.join('matrix.yaml')
+        matrix.write(yaml.safe_dump({
+            'output': '{series}-{instrument}.yaml',
+            'matrix': {'series': ['xenial', 'bionic'],
+                       'instrument': [False, False]}}))
+        mocker.patch('sys.argv', ['schedule_builds', '--poll-interval', '0',
+                                  matrix.strpath])
+        build_scheduler.main()
+        output = capsys.readouterr()[0]
+        assert 1 == len(backend.launched)
+        assert 2 == len(backend.launched[0][2])
+        assert 'same as' in output
+        assert 'matrix-bionic-False: succeeded' in output
+        assert 'matrix-xenial-False: succeeded' in output
+
+    def test_main_names_jobs_uniquely(self, capsys, mocker, tmpdir):
+        backend = FakeBackend(auto_finish=True)
+        mocker.patch('build_scheduler.LocalBuildBackend',
+                     return_value=backend)
+        matrices = []
+        for directory in ('a', 'b'):
+            matrix = tmpdir.mkdir(directory).join('matrix.yaml')
+            # Both use the default output paths, build-config-0.yaml etc.
+            matrix.write(yaml.safe_dump({'matrix': {
+                'series': ['xenial', 'bionic'],
+                'image_ppa': ['{}/ppa'.format(directory)]}}))
+            matrices.append(matrix.strpath)
+        mocker.patch('sys.argv', ['schedule_builds', '--poll-interval', '0']
+                     + matrices)
+        build_scheduler.main()
+        output = capsys.readouterr()[0]
+        names = sorted(line.split(': ')[0] for line in output.splitlines())
+        assert ['matrix-build-config-0', 'matrix-build-config-0-1',
+                'matrix-build-config-1', 'matrix-build-config-1-1'] == names
+
+
+class TestGetChrootSnapshotKey(object):
+
+    def test_key_includes_series_and_arch(self):
+        key = generate_build_config._get_chroot_snapshot_key(
+            'bionic', 'arm64', '- x')
+        assert key.startswith('bionic-arm64-')
+
+    def test_key_depends_on_chroot_update(self):
+        get_key = generate_build_config._get_chroot_snapshot_key
+        assert get_key('xenial', 'amd64', '- x') != \
+            get_key('xenial', 'amd64', '- y')
+
+
+class TestGetChrootSnapshotSnippets(object):
+
+    def test_update_skipped_when_restored(self):
+        unpack, update = generate_build_config._get_chroot_snapshot_snippets(
+            'xenial', 'amd64', '- unpack', '- update', '/snap')
+        assert 'unpack' in unpack
+        assert '/snap/xenial-amd64-' in unpack
+        update = yaml.safe_load(update)
+        assert '[ $CHROOT_RESTORED = 1 ] || { update; }' == update[0]
+        assert any("-name 'xenial-amd64-" in command for command in update)
+
+
+class TestGuardSnippet(object):
+
+    def test_each_command_guarded(self):
+        snippet = '- one\n\n- "two; three"\n'
+        assert ['[ -f x ] || { one; }', '[ -f x ] || { two; three; }'] == \
+            yaml.safe_load(generate_build_config._guard_snippet(
+                snippet, '[ -f x ]'))
+
+
+class TestAddSetupSteps(object):
+
+    def test_nothing_added_by_default(self):
+        assert generate_build_config.TEMPLATE == \
+            generate_build_config._add_setup_steps(
+                generate_build_config.TEMPLATE)
+
+    def test_prefetch_after_payloads_copied(self):
+        template = generate_build_config._add_setup_steps(
+            generate_build_config.TEMPLATE, prefetch=True)
+        assert template.index('{copy_payloads}') < template.index(
+            generate_build_config.PREFETCH_TEMPLATE)
+
+    def test_bundle_unpacked_after_prefetch(self):
+        template = generate_build_config._add_setup_steps(
+            generate_build_config.TEMPLATE, prefetch=True,
+            offline_bundle=True)
+        assert template.index(generate_build_config.PREFETCH_TEMPLATE) < \
+            template.index(generate_build_config.OFFLINE_BUNDLE_TEMPLATE)
+
+
+class TestGetOfflineBundleUnpack(object):
+
+    @pytest.mark.parametrize('prefetch', [True, False])
+    def test_bundle_url_fetched(self, prefetch):
+        unpack, prefetches = generate_build_config._get_offline_bundle_unpack(
+            'http://mirror/bundle.tar', '/home/ubuntu', '/srv/bundle',
+            ['b', 'a'], prefetch=prefetch)
+        assert prefetch == ('wget' not in unpack)
+        assert prefetch == bool(prefetches)
+        assert 'tar -xf /home/ubuntu/offline-bundle.tar' in unpack
+        assert '&& ls a b >' in unpack
+
+    def test_bundle_path_used_in_place(self):
+        unpack, prefetches = generate_build_config._get_offline_bundle_unpack(
+            '/srv/bundle.tar', '/home/ubuntu', '/srv/bundle', [],
+            prefetch=True)
+        assert [] == prefetches
+        assert 'tar -xf /srv/bundle.tar -C /srv/bundle' in unpack
+
+
+class TestGetBaseImageSnippets(object):
+
+    def test_worker_job_images_prefetched(self):
+        snippet, prefetches = generate_build_config._get_base_image_snippets(
+            ['amd64', 'arm64'], 'xenial', images_directory='/srv/images',
+            prefetch=True)
+        assert 2 == len(snippet.splitlines())
+        assert all(command.startswith('- ln -sf /srv/images/')
+                   for command in snippet.splitlines())
+        assert [('/srv/images/xenial-server-cloudimg-{}.squashfs'.format(
+            arch), 'newer') for arch in ('amd64', 'arm64')] == [
+                entry[:2] for entry in prefetches]
 
 
-@pytest.fixture
-def write_cloud_config_in_memory():
-    def _write_cloud_config_in_memory(*args, **kwargs):
-        output_stream = StringIO()
-        generate_build_config._write_cloud_config(
-            output_stream, *args, **kwargs)
-        return output_stream.getvalue()
-    return _write_cloud_config_in_memory
+class TestGetHooks(object):
 
+    def test_no_hooks_by_default(self):
+        assert [] == generate_build_config._get_hooks()
 
-class TestWriteCloudConfig(object):
+    def test_customisation_script_wrapped_by_setup_and_teardown(
+            self, tmpdir):
+        script = tmpdir.join('script.sh')
+        script.write('#!/bin/sh\necho customise\n')
+        hooks = generate_build_config._get_hooks(
+            customisation_script=script.strpath)
+        assert [(9998, 'chroot'), (9997, 'chroot'), (9999, 'chroot')] == [
+            (sequence, hook_type) for _, hook_type, sequence, _ in hooks]
 
-    def test_writes_to_file(self, write_cloud_config_in_memory):
-        assert len(write_cloud_config_in_memory()) > 0
+    def test_hook_files_written_for_each_build(self):
+        hooks = [('#!/bin/sh\n', 'binary', '010', 'filter')]
+        builds = generate_build_config._get_builds(['amd64', 'arm64'])
+        paths = [path for _, path, _ in generate_build_config._get_hook_files(
+            hooks, builds, '/home/ubuntu')]
+        assert 2 == len(paths)
+        assert all(path.endswith('/hooks/010-filter.binary')
+                   for path in paths)
 
-    def test_written_output_is_yaml(self, write_cloud_config_in_memory):
-        yaml.load(write_cloud_config_in_memory())
 
-    def test_written_output_is_cloud_config(
-            self, write_cloud_config_in_memory):
-        assert '#cloud-config' \
-            == write_cloud_config_in_memory().splitlines()[0].strip()
+class TestWriteCloudConfigChrootSnapshot(object):
 
-    def test_default_build_id_is_root(
-            self, build_id, write_cloud_config_in_memory):
-        assert '- export BUILD_ID={}'.format(build_id) in \
-            write_cloud_config_in_memory().splitlines()
+    def test_no_snapshots_by_default(self, write_cloud_config_in_memory):
+        assert 'CHROOT_SNAPSHOT' not in write_cloud_config_in_memory()
 
-    def test_serial_includes_ubuntu_standalone_builder(
-            self, write_cloud_config_in_memory):
-        buildlivefs_line = [
-            line for line in write_cloud_config_in_memory().splitlines()
-            if 'buildlivefs' in line][0]
-        assert '--datestamp ubuntu-standalone-builder' in buildlivefs_line
+    def test_snapshots_keyed_by_series(self, write_cloud_config_in_memory):
+        output = write_cloud_config_in_memory(chroot_snapshot_dir='/snap',
+                                              series='bionic')
+        assert 'export CHROOT_SNAPSHOT=/snap/bionic-amd64-' in output
 
-    def test_write_files_not_included_by_default(
+    def test_snapshots_keyed_by_build_ppa(
             self, write_cloud_config_in_memory):
-        cloud_config = yaml.load(write_cloud_config_in_memory())
-        assert 'write_files' not in cloud_config
+        def get_snapshot_line(**kwargs):
+            return [line for line in write_cloud_config_in_memory(
+                chroot_snapshot_dir='/snap', **kwargs).splitlines()
+                if 'export CHROOT_SNAPSHOT=' in line][0]
+        assert get_snapshot_line() != get_snapshot_line(
+            build_ppa='ppa:foo/bar')
 
-    def test_no_build_ppa_by_default(self, write_cloud_config_in_memory):
-        content = write_cloud_config_in_memory()
-        assert 'add-apt-repository' not in content
-        assert 'apt-transport-https' not in content
+    def test_snapshot_reused_by_second_build(
+            self, tmpdir, write_cloud_config_in_memory):
+        homedir = tmpdir.mkdir('home')
+        log = tmpdir.join('log')
+        fake_bin = tmpdir.mkdir('bin')
+        fake_bin.join('unsquashfs').write(
+            '#!/bin/sh\nmkdir -p $4/etc\ntouch $4/etc/resolv.conf\n'
+            'echo unsquashfs >> {}\n'.format(log.strpath))
+        buildd_bin = homedir.mkdir('launchpad-buildd').mkdir('bin')
+        buildd_bin.join('mount-chroot').write(
+            '#!/bin/sh\necho mount-chroot >> {}\n'.format(log.strpath))
+        buildd_bin.join('update-debian-chroot').write(
+            '#!/bin/sh\ntouch $CHROOT_ROOT/updated\n'
+            'echo update-debian-chroot >> {}\n'.format(log.strpath))
+        for script in fake_bin.listdir() + buildd_bin.listdir():
+            script.chmod(0o755)
+        runcmd = yaml.safe_load(write_cloud_config_in_memory(
+            homedir=homedir.strpath,
+            chroot_snapshot_dir=tmpdir.join('snap').strpath))['runcmd']
+        start = runcmd.index('export BUILD_ID=root')
+        end = [index for index, command in enumerate(runcmd)
+               if 'CHROOT_SNAPSHOT.$BUILD_ID.part' in command][0]
+        script = tmpdir.join('build.sh')
+        script.write('set -e\n' + '\n'.join(runcmd[start:end + 1]))
+        env = dict(os.environ, PATH='{}:{}'.format(fake_bin.strpath,
+                                                   os.environ['PATH']))
 
-    def _get_wget_line(self, output):
-        wget_lines = [ln for ln in output.splitlines() if 'wget' in ln]
-        assert 1 == len(wget_lines)
-        return wget_lines[0]
+        subprocess.check_call(['sh', script.strpath], env=env)
+        assert ['unsquashfs', 'mount-chroot', 'update-debian-chroot'] == \
+            log.read().split()
+        assert 1 == len(tmpdir.join('snap').listdir())
 
-    def test_daily_image_used(self, write_cloud_config_in_memory):
-        wget_line = self._get_wget_line(write_cloud_config_in_memory())
-        assert 'xenial-server-cloudimg-amd64.squashfs ' in wget_line
+        log.remove()
+        homedir.join('build-root').remove()
+        subprocess.check_call(['sh', script.strpath], env=env)
+        assert ['mount-chroot'] == log.read().split()
+        assert homedir.join(
+            'build-root', 'chroot-autobuild', 'updated').check()
 
-    def test_latest_daily_image_used(self, write_cloud_config_in_memory):
-        url = self._get_wget_line(write_cloud_config_in_memory()).split()[2]
-        path = urlparse(url).path
-        assert 'current' == path.split('/')[2]
+    def test_per_config_hooks_not_snapshotted(
+            self, tmpdir, write_cloud_config_in_memory):
+        customisation_dir = tmpdir.mkdir('customisation')
+        customisation_dir.join('9000-foo.chroot').write('#!/bin/sh\n')
+        runcmd = yaml.safe_load(write_cloud_config_in_memory(
+            artifacts=['squashfs'],
+            chroot_snapshot_dir=tmpdir.mkdir('snap').strpath,
+            customisation_dir=customisation_dir.strpath))['runcmd']
+        restore, create = [
+            [command for command in runcmd if marker in command][0]
+            for marker in ('tar -xf $CHROOT_SNAPSHOT',
+                           'tar -cf $CHROOT_SNAPSHOT')]
+        chroot = tmpdir.join('chroot')
+        hooks = chroot.ensure('usr', 'share', 'livecd-rootfs', 'live-build',
+                              'ubuntu-cpc', 'hooks', dir=True)
+        names = ['030-root-tarball.binary', '010-artifact-filter.binary',
+                 '9998-local-customisation.binary',
+                 '9998-local-customisation.chroot',
+                 '9998-local-modifications.chroot']
+        for name in names:
+            hooks.join(name).write('old')
+        env = dict(os.environ, BUILD_ID='root', CHROOT_RESTORED='0',
+                   CHROOT_ROOT=chroot.strpath,
+                   CHROOT_SNAPSHOT=tmpdir.join('snapshot.tar').strpath)
+        subprocess.check_call(['sh', '-c', create], env=env)
+        with tarfile.open(env['CHROOT_SNAPSHOT']) as snapshot:
+            assert [names[0]] == [
+                name.rsplit('/', 1)[-1] for name in snapshot.getnames()
+                if '/hooks/' in name]
 
-    def test_build_ppa_snippet_included(self, write_cloud_config_in_memory):
-        output = write_cloud_config_in_memory(build_ppa='ppa:foo/bar')
-        assert 'add-apt-repository -y -u ppa:foo/bar' in output
+        # Restoring an older snapshot leaves this config's hooks in place
+        with tarfile.open(env['CHROOT_SNAPSHOT'], 'w') as snapshot:
+            snapshot.add(chroot.strpath, arcname='.')
+        for name in names:
+            hooks.join(name).write('new')
+        subprocess.check_call(['sh', '-c', restore], env=env)
+        assert ['old'] + ['new'] * 4 == [
+            hooks.join(name).read() for name in names]
 
-    def test_build_ppa_snippet_included_before_update_debian_chroot(
-            self, write_cloud_config_in_memory):
-        ppa_string = 'ppa:foo/bar'
-        output = write_cloud_config_in_memory(build_ppa=ppa_string)
-        assert output.find('add-apt-repository -y -u {}'.format(ppa_string)) \
-            < output.find('update-debian-chroot')
 
-    def test_image_ppa_not_by_default(self, write_cloud_config_in_memory):
-        content = write_cloud_config_in_memory()
-        assert '--extra-ppa' not in content
+class TestChrootStorageScript(object):
 
-    def test_image_ppa_added(self, write_cloud_config_in_memory):
-        image_ppa = 'foo/bar:1001'
-        content = write_cloud_config_in_memory(image_ppa=image_ppa)
-        assert '--extra-ppa {}'.format(image_ppa) in content
+    @pytest.fixture
+    def run_script(self, tmpdir):
+        script = tmpdir.join('chroot-storage.sh')
+        script.write(generate_build_config.CHROOT_STORAGE_CONTENT)
+        meminfo = tmpdir.join('meminfo')
 
-    def test_binary_hook_filter_included(self, write_cloud_config_in_memory):
-        hook_filter = 'some*glob*'
-        output = write_cloud_config_in_memory(binary_hook_filter=hook_filter)
-        cloud_config = yaml.load(output)
-        for stanza in cloud_config['write_files']:
-            content = base64.b64decode(stanza['content']).decode('utf-8')
-            if '{}|9997*|9998*|9999*'.format(hook_filter) in content:
-                break
-        else:
-            pytest.fail('Binary hook filter not correctly included.')
+        def _run_script(available_mb, *args):
+            meminfo.write('MemTotal: 99999999 kB\n'
+                          'MemAvailable: {} kB\n'.format(available_mb * 1024))
+            env = {'MEMINFO': meminfo.strpath, 'PATH': '/usr/bin:/bin'}
+            return subprocess.check_output(
+                ['sh', script.strpath] + list(args), env=env).decode('utf-8')
+        return _run_script
 
-    def test_binary_hook_sequence_is_lower_than_030(
-            self, write_cloud_config_in_memory, monkeypatch):
-        # That's the lowest sequence of disks and we want to filter before that
-        filter_template = '-- binary hook filter:{} --'
-        hook_filter = 'some*glob'
-        monkeypatch.setattr(
-            generate_build_config,
-            "BINARY_HOOK_FILTER_CONTENT", filter_template)
-        output = write_cloud_config_in_memory(binary_hook_filter=hook_filter)
-        cloud_config = yaml.load(output)
-        expected_content = filter_template.format(hook_filter)
-        for stanza in cloud_config['write_files']:
-            content = base64.b64decode(stanza['content']).decode('utf-8')
-            if content == expected_content:
-                break
-        else:
-            pytest.fail('Binary hook filter not correctly included.')
-        path = stanza['path'].rsplit('/')[-1]
-        assert path < '030-some-file.binary'
+    def test_auto_falls_back_to_disk_when_memory_short(
+            self, run_script, tmpdir):
+        build_dir = tmpdir.join('build-root').ensure(dir=True)
+        build_dir.join('hook').write('hook')
+        output = run_script(2048, 'mount', 'auto', '4096', '8192',
+                            build_dir.strpath)
+        assert 'Using disk' in output
+        assert 'hook' == build_dir.join('hook').read()
+        assert not tmpdir.join('build-root.disk').check()
+
+    def test_release_of_unmounted_tree_is_a_noop(self, run_script, tmpdir):
+        build_dir = tmpdir.join('build-root').ensure(dir=True)
+        run_script(0, 'release', build_dir.strpath)
+        assert build_dir.check(dir=True)
 
 
 def customisation_script_combinations():
@@ -306,6 +3047,774 @@ class TestWriteCloudConfigWithCustomisationScript(object):
             [content for content in contents if expected_bytes == content])
 
 
+@pytest.fixture
+def customisation_dir(tmpdir):
+    customisation_dir = tmpdir.mkdir('customisation')
+    customisation_dir.join('20-second.chroot').write(
+        '#!/bin/sh\necho second >> $LOG\n')
+    customisation_dir.join('10-first.chroot').write(
+        '#!/bin/sh\necho first $(cat $CUSTOMISATION_DIR/assets/motd) '
+        '>> $LOG\n')
+    customisation_dir.join('10-images.binary').write(
+        '#!/bin/sh\necho binary $(cat $CUSTOMISATION_DIR/assets/motd) '
+        '>> $LOG\n')
+    customisation_dir.mkdir('assets').join('motd').write('hello')
+    return customisation_dir
+
+
+class TestWriteCloudConfigGrubProbeShim(object):
+
+    @pytest.fixture
+    def hook_paths(self, tmpdir, write_cloud_config_in_memory):
+        def _hook_paths(script_content, **kwargs):
+            script = tmpdir.join('script.sh')
+            script.write(script_content)
+            cloud_config = yaml.safe_load(write_cloud_config_in_memory(
+                customisation_script=script.strpath, **kwargs))
+            return dict((os.path.basename(stanza['path']),
+                         generate_build_config._get_write_files_content(
+                             stanza).decode('utf-8'))
+                        for stanza in cloud_config['write_files'])
+        return _hook_paths
+
+    @pytest.mark.parametrize('shim,setup_content', [
+        (None, generate_build_config.SETUP_CONTENT),
+        ('full', generate_build_config.SETUP_CONTENT),
+        ('fast', generate_build_config.FAST_SETUP_CONTENT)])
+    def test_shim_used(self, hook_paths, shim, setup_content):
+        hooks = hook_paths('#!/bin/sh\necho hi\n', grub_probe_shim=shim)
+        assert setup_content == hooks['9997-local-modifications.chroot']
+        assert generate_build_config.TEARDOWN_CONTENT == \
+            hooks['9999-local-modifications.chroot']
+
+    def test_no_shim(self, hook_paths):
+        hooks = hook_paths('#!/bin/sh\necho hi\n', grub_probe_shim='none')
+        assert ['9998-local-modifications.chroot'] == [
+            name for name in hooks if name.endswith('.chroot')]
+
+    @pytest.mark.parametrize('script,setup_content', [
+        ('#!/bin/sh\necho hi > /etc/motd\n', None),
+        ('#!/bin/sh\napt-get install -y linux-generic\n',
+         generate_build_config.FAST_SETUP_CONTENT),
+        ('#!/bin/sh\nupdate-initramfs -u\n',
+         generate_build_config.FAST_SETUP_CONTENT)])
+    def test_auto(self, hook_paths, script, setup_content):
+        hooks = hook_paths(script, grub_probe_shim='auto')
+        assert setup_content == hooks.get('9997-local-modifications.chroot')
+
+    @pytest.mark.parametrize('hook,expected', [
+        (b'#!/bin/sh\necho hi\n', False),
+        (b'#!/bin/sh\napt-get -y upgrade\n', True),
+        # Matches split between chunks are found too
+        (b'#!/bin/sh\n' + b'#' * 65523 + b'\ndpkg -i /tmp/linux.deb\n',
+         True)])
+    def test_auto_checks_customisation_dir_chroot_hooks(
+            self, tmpdir, write_cloud_config_in_memory, hook, expected):
+        customisation_dir = tmpdir.mkdir('customisation')
+        customisation_dir.join('10-run.chroot').write_binary(hook)
+        # Neither assets nor binary hooks run in the chroot
+        customisation_dir.join('10-images.binary').write(
+            '#!/bin/sh\ngrub-mkimage\n')
+        customisation_dir.mkdir('assets').join('kernel.deb').write_binary(
+            b'linux-image')
+        output = write_cloud_config_in_memory(
+            customisation_dir=customisation_dir.strpath,
+            grub_probe_shim='auto')
+        assert expected == ('9997-local-modifications.chroot' in output)
+
+    def test_customisation_dir_only_scanned_for_auto(
+            self, mocker, write_cloud_config_in_memory, customisation_dir):
+        may_run_grub_probe = mocker.patch(
+            'generate_build_config._customisation_dir_may_run_grub_probe')
+        write_cloud_config_in_memory(
+            customisation_dir=customisation_dir.strpath,
+            grub_probe_shim='full')
+        assert 0 == may_run_grub_probe.call_count
+
+    def test_invalid_shim_rejected(self, write_cloud_config_in_memory):
+        with pytest.raises(ValueError):
+            write_cloud_config_in_memory(grub_probe_shim='quick')
+
+
+def _get_grub_probe_shim(setup_content):
+    return setup_content.split(
+        'cat <<"PSEUDO_GRUB_PROBE" > /usr/sbin/grub-probe\n')[1].split(
+            'PSEUDO_GRUB_PROBE\n')[0]
+
+
+def grub_probe_argument_matrix():
+    """
+    Arguments to run the grub-probe stand-ins with: the ways that grub
+    scripts call grub-probe, and the edge cases of getopt's parsing.
+    """
+    matrix = []
+    for target in ['device', 'fs', 'fs_uuid', 'partmap', 'abstraction',
+                   'drive', 'unknown', '']:
+        for target_args in [['--target=' + target], ['--target', target],
+                            ['--t', target]]:
+            for device_args in [[], ['--device'],
+                                ['--device-map', '/boot/grub/device.map']]:
+                for path_args in [['/'], ['/dev/sda'], ['/dev/sda1'], []]:
+                    matrix.append(device_args + target_args + path_args)
+    return matrix + [
+        # Options after (and between) arguments
+        ['/dev/sda', '--target=drive'],
+        ['/', '--device', '--target', 'device', 'other'],
+        # Explicit ends of options
+        ['--target=device', '--', '/'],
+        ['--target=device', '--', '--device'],
+        ['--', '--target=fs'],
+        ['--target=device', '-'],
+        ['--target=device', ''],
+        # Repeated and abbreviated options
+        ['--target=fs', '--target=device', '/'],
+        ['--targ=drive', '--device-=/map', '/dev/sda'],
+        ['--device-m', '/map', '--target=drive', '/dev/sda1'],
+        # Invalid options
+        ['--dev', '/'], ['--d', 'x'], ['--device=1'], ['-t', 'fs'],
+        ['--target'], ['--device-map'], ['--unknown'], ['-'],
+    ]
+
+
+@pytest.fixture(scope='module')
+def grub_probe_shims(tmpdir_factory):
+    """
+    A directory containing the full and fast grub-probe stand-ins.
+    """
+    shims = tmpdir_factory.mktemp('shims')
+    for name, setup_content in [
+            ('full', generate_build_config.SETUP_CONTENT),
+            ('fast', generate_build_config.FAST_SETUP_CONTENT)]:
+        shims.join(name).write(_get_grub_probe_shim(setup_content))
+    return shims
+
+
+@pytest.mark.skipif(
+    subprocess.call(['sh', '-c', 'command -v getopt'],
+                    stdout=subprocess.PIPE) != 0,
+    reason='getopt is not installed')
+class TestGrubProbeShims(object):
+
+    def _run(self, shim, args):
+        process = subprocess.Popen(['sh', shim.strpath] + args,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        return process.communicate()[0], process.returncode
+
+    @pytest.mark.parametrize('args', grub_probe_argument_matrix(),
+                             ids=' '.join)
+    def test_fast_shim_behaves_as_full_shim(self, grub_probe_shims, args):
+        assert self._run(grub_probe_shims.join('full'), args) == \
+            self._run(grub_probe_shims.join('fast'), args)
+
+    @pytest.mark.parametrize('args,expected', [
+        (['--target=device', '/'], (b'/dev/sda1\n', 0)),
+        (['--device', '/dev/sda1', '--target=fs_uuid'], (b'', 1)),
+        (['--target=drive', '/dev/sda'], (b'(hd0)\n', 0)),
+        (['--unknown'], (b'\n', 1))])
+    def test_shims_probe_fake_disk(self, grub_probe_shims, args, expected):
+        assert expected == self._run(grub_probe_shims.join('fast'), args)
+
+
+class TestGetCustomisationDirArchive(object):
+
+    def _get_members(self, archive):
+        with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+            return [(member.name, member.mode, member.mtime, member.uname)
+                    for member in tar.getmembers()]
+
+    def test_archive_contents(self, customisation_dir):
+        archive = generate_build_config._get_customisation_dir_archive(
+            customisation_dir.strpath)
+        assert [('10-first.chroot', 0o755, 0, 'root'),
+                ('10-images.binary', 0o755, 0, 'root'),
+                ('20-second.chroot', 0o755, 0, 'root'),
+                ('assets', 0o755, 0, 'root'),
+                ('assets/motd', 0o644, 0, 'root')] == \
+            self._get_members(archive)
+
+    def test_archive_is_reproducible(self, customisation_dir):
+        archive = generate_build_config._get_customisation_dir_archive(
+            customisation_dir.strpath)
+        customisation_dir.join('assets', 'motd').setmtime(1234567890)
+        assert archive == generate_build_config._get_customisation_dir_archive(
+            customisation_dir.strpath)
+
+    def test_directory_without_hooks_raises_value_error(self, tmpdir):
+        tmpdir.join('asset').write('')
+        with pytest.raises(ValueError):
+            generate_build_config._get_customisation_dir_archive(
+                tmpdir.strpath)
+
+    def test_missing_directory_raises_value_error(self, tmpdir):
+        with pytest.raises(ValueError):
+            generate_build_config._get_customisation_dir_archive(
+                tmpdir.join('missing').strpath)
+
+
+class TestCustomisationDirHooks(object):
+
+    def _write_hooks(self, customisation_dir, hooks_dir):
+        archive = generate_build_config._get_customisation_dir_archive(
+            customisation_dir.strpath)
+        for content, hook_type in \
+                generate_build_config._get_customisation_dir_hooks(
+                    archive, hooks_dir.strpath):
+            hook = hooks_dir.join('9998-local-customisation.' + hook_type)
+            hook.write_binary(content if isinstance(content, bytes)
+                              else content.encode('utf-8'))
+            hook.chmod(0o755)
+
+    def test_hooks_run_in_order_with_assets(self, customisation_dir, tmpdir):
+        hooks_dir = tmpdir.mkdir('hooks')
+        log = tmpdir.join('log')
+        self._write_hooks(customisation_dir, hooks_dir)
+        env = dict(os.environ, LOG=log.strpath)
+        subprocess.check_call(
+            [hooks_dir.join('9998-local-customisation.chroot').strpath],
+            env=env)
+        subprocess.check_call(
+            [hooks_dir.join('9998-local-customisation.binary').strpath],
+            env=env)
+        assert ['first hello', 'second', 'binary hello'] == \
+            log.read().splitlines()
+
+    def test_hooks_run_from_working_directory(self, tmpdir):
+        # live-build runs binary hooks from the build directory, which
+        # they refer to by relative path (e.g. binary/ and chroot/)
+        customisation_dir = tmpdir.mkdir('customisation')
+        customisation_dir.join('10-where.binary').write(
+            '#!/bin/sh\npwd > where\n')
+        hooks_dir = tmpdir.mkdir('hooks')
+        build_dir = tmpdir.mkdir('build')
+        self._write_hooks(customisation_dir, hooks_dir)
+        subprocess.check_call(
+            [hooks_dir.join('9998-local-customisation.binary').strpath],
+            cwd=build_dir.strpath)
+        assert build_dir.strpath == build_dir.join('where').read().strip()
+
+
+class TestWriteCloudConfigCustomisationDir(object):
+
+    def _get_hooks(self, output):
+        return dict(
+            (py.path.local(stanza['path']).basename,
+             base64.b64decode(stanza['content']))
+            for stanza in yaml.safe_load(output)['write_files'])
+
+    def test_hooks_written(self, customisation_dir,
+                           write_cloud_config_in_memory):
+        hooks = self._get_hooks(write_cloud_config_in_memory(
+            customisation_dir=customisation_dir.strpath))
+        assert ['9997-local-modifications.chroot',
+                '9998-local-customisation.binary',
+                '9998-local-customisation.chroot',
+                '9999-local-modifications.chroot'] == sorted(hooks)
+
+    def test_customisation_dir_hooks_run_before_customisation_script(
+            self, customisation_dir, tmpdir, write_cloud_config_in_memory):
+        script = tmpdir.join('script.sh')
+        script.write('#!/bin/sh\n')
+        hooks = sorted(self._get_hooks(write_cloud_config_in_memory(
+            customisation_dir=customisation_dir.strpath,
+            customisation_script=script.strpath)))
+        assert hooks.index('9998-local-customisation.chroot') < \
+            hooks.index('9998-local-modifications.chroot')
+
+    def test_archive_embedded_once(self, customisation_dir,
+                                   write_cloud_config_in_memory):
+        archive = generate_build_config._get_customisation_dir_archive(
+            customisation_dir.strpath)
+        output = write_cloud_config_in_memory(
+            architectures=['amd64', 'arm64'],
+            customisation_dir=customisation_dir.strpath)
+        assert 1 == len([content for content in self._get_hooks(
+            output).values() if archive in content])
+
+
+class TestRenderTemplate(object):
+
+    @pytest.mark.parametrize('template', [
+        generate_build_config.TEMPLATE, generate_build_config.BUILD_TEMPLATE])
+    def test_matches_str_format(self, template):
+        fields = [field for _, field, _, _ in
+                  generate_build_config.string.Formatter().parse(template)
+                  if field is not None]
+        kwargs = dict((field, '<{}>'.format(field)) for field in fields)
+        assert template.format(**kwargs) == \
+            generate_build_config._render_template(template, **kwargs)
+
+    def test_template_only_split_once(self, mocker):
+        template = 'a {b} c {{d}}'
+        parse_spy = mocker.spy(generate_build_config.string.Formatter,
+                               'parse')
+        for _ in range(3):
+            assert 'a x c {d}' == \
+                generate_build_config._render_template(template, b='x')
+        assert 1 == parse_spy.call_count
+
+    def test_compiled_templates_bounded(self, mocker,
+                                        write_cloud_config_in_memory):
+        mocker.patch('generate_build_config._COMPILED_TEMPLATES',
+                     generate_build_config.collections.OrderedDict())
+        mocker.patch('generate_build_config.COMPILED_TEMPLATES_LIMIT', 4)
+        for index in range(10):
+            write_cloud_config_in_memory(
+                publish_url='http://example.com/{}/'.format(index))
+        assert 4 == len(generate_build_config._COMPILED_TEMPLATES)
+        # The most recently used templates are kept
+        assert any('http://example.com/9/' in template
+                   for template in generate_build_config._COMPILED_TEMPLATES)
+
+    def test_positional_fields_not_supported(self):
+        with pytest.raises(ValueError):
+            generate_build_config._compile_template('{} {0}')
+
+
+class TestBuildConfig(object):
+
+    def test_defaults_match_write_cloud_config(
+            self, write_cloud_config_in_memory):
+        assert write_cloud_config_in_memory() == \
+            generate_build_config.BuildConfig().render()
+
+    def test_arguments_passed_through(self, write_cloud_config_in_memory):
+        kwargs = {'architectures': ['amd64', 'arm64'],
+                  'build_ppa': 'ppa:foo/bar', 'series': 'bionic'}
+        assert write_cloud_config_in_memory(**kwargs) == \
+            generate_build_config.BuildConfig(**kwargs).render()
+
+    def test_unknown_argument_raises_type_error(self):
+        with pytest.raises(TypeError):
+            generate_build_config.BuildConfig(arch='amd64')
+
+    def test_has_no_instance_dict(self):
+        config = generate_build_config.BuildConfig()
+        assert not hasattr(config, '__dict__')
+        with pytest.raises(AttributeError):
+            config.arch = 'amd64'
+
+    def test_equality(self):
+        BuildConfig = generate_build_config.BuildConfig
+        assert BuildConfig(series='bionic') == BuildConfig(series='bionic')
+        assert BuildConfig(series='bionic') != BuildConfig()
+
+    def test_repr_shows_non_default_arguments(self):
+        assert "BuildConfig(series='bionic')" == repr(
+            generate_build_config.BuildConfig(series='bionic'))
+
+    def test_render_to_text_file(self):
+        output = StringIO()
+        config = generate_build_config.BuildConfig()
+        assert config.render(output) is None
+        assert config.render() == output.getvalue()
+
+    def test_render_to_bytes_buffer(self):
+        output = io.BytesIO()
+        config = generate_build_config.BuildConfig()
+        config.render(output)
+        assert config.render().encode('utf-8') == output.getvalue()
+
+    def test_render_to_binary_file(self, tmpdir):
+        config = generate_build_config.BuildConfig()
+        with open(tmpdir.join('output.yaml').strpath, 'wb') as f:
+            config.render(f)
+        assert config.render() == tmpdir.join('output.yaml').read()
+
+    def test_shared_cache_renders_match(self, tmpdir):
+        script = tmpdir.join('script.sh')
+        script.write('#!/bin/sh\necho customise\n')
+        configs = [generate_build_config.BuildConfig(
+            architectures=['amd64', 'arm64'], build_ppa=ppa,
+            customisation_script=script.strpath)
+            for ppa in ('ppa:foo/bar', 'ppa:foo/baz')]
+        cache = {}
+        for _ in range(2):
+            for config in configs:
+                assert config.render() == config.render(cache=cache)
+        assert cache
+
+    @pytest.mark.benchmark
+    def test_benchmark_render(self, capsys, tmpdir):
+        script = tmpdir.join('script.sh')
+        script.write('#!/bin/sh\n' + 'echo customise\n' * 100)
+        configs = [generate_build_config.BuildConfig(
+            architectures=['amd64', 'arm64'], build_ppa=ppa,
+            customisation_script=script.strpath)
+            for ppa in ('ppa:foo/bar', 'ppa:foo/baz')]
+        cache = {}
+        renders = 200
+
+        def uncached():
+            for index in range(renders):
+                configs[index % 2].render(io.BytesIO())
+
+        def cached():
+            for index in range(renders):
+                configs[index % 2].render(io.BytesIO(), cache=cache)
+
+        uncached_time = min(timeit.repeat(uncached, number=1, repeat=3))
+        cached_time = min(timeit.repeat(cached, number=1, repeat=3))
+        with capsys.disabled():
+            print('\nBuildConfig.render: {:.2f}ms uncached, {:.2f}ms with a '
+                  'shared cache'.format(uncached_time * 1000 / renders,
+                                        cached_time * 1000 / renders))
+        assert cached_time < uncached_time
+
+
+class TestExpandMatrix(object):
+
+    def test_one_combination_per_product(self):
+        combinations = generate_build_config._expand_matrix({'matrix': {
+            'build_ppa': ['ppa:a/b', 'ppa:c/d', None],
+            'customisation_script': ['one.sh', 'two.sh']}})
+        assert 6 == len(combinations)
+        assert 6 == len(set(path for path, _ in combinations))
+
+    def test_scalar_treated_as_single_value(self):
+        combinations = generate_build_config._expand_matrix(
+            {'matrix': {'homedir': '/srv'}})
+        assert [('build-config-0.yaml', {'homedir': '/srv'})] == combinations
+
+    def test_defaults_overridden_by_matrix(self):
+        combinations = generate_build_config._expand_matrix(
+            {'matrix': {'homedir': ['/srv']}},
+            defaults={'homedir': '/home', 'image_ppa': 'foo/bar'})
+        assert {'homedir': '/srv', 'image_ppa': 'foo/bar'} == \
+            combinations[0][1]
+
+    def test_output_pattern_uses_sanitised_values(self):
+        combinations = generate_build_config._expand_matrix({
+            'output': '{build_ppa}/{customisation_script}-{index}.yaml',
+            'matrix': {'build_ppa': ['ppa:a/b'],
+                       'customisation_script': ['/x/rabbit.sh']}})
+        assert 'ppa_a_b/rabbit-0.yaml' == combinations[0][0]
+
+    def test_unknown_argument_raises_value_error(self):
+        with pytest.raises(ValueError):
+            generate_build_config._expand_matrix({'matrix': {'bogus': [1]}})
+
+    def test_output_pattern_with_unknown_field_raises_value_error(self):
+        with pytest.raises(ValueError):
+            generate_build_config._expand_matrix(
+                {'output': '{build_ppa}.yaml', 'matrix': {'homedir': ['/']}})
+
+
+class TestWriteMatrixCloudConfigs(object):
+
+    @pytest.fixture(autouse=True)
+    def matrix_tmpdir(self, tmpdir):
+        self.tmpdir = tmpdir
+        self.scripts = []
+        for name in ('one', 'two'):
+            script = tmpdir.join(name + '.sh')
+            script.write('#!/bin/sh\n-- {} --'.format(name))
+            self.scripts.append(script)
+        self.matrix_file = tmpdir.join('matrix.yaml')
+        self.matrix_file.write(yaml.safe_dump({
+            'output': 'out/{customisation_script}-{build_ppa}.yaml',
+            'matrix': {
+                'build_ppa': ['ppa:a/b', 'ppa:c/d', 'ppa:e/f'],
+                'customisation_script': ['one.sh', 'two.sh']}}))
+
+    def test_output_matches_individual_renders(self):
+        paths = generate_build_config._write_matrix_cloud_configs(
+            self.matrix_file.strpath)
+        assert 6 == len(paths)
+        expected = StringIO()
+        generate_build_config._write_cloud_config(
+            expected, build_ppa='ppa:c/d',
+            customisation_script=self.scripts[1].strpath)
+        assert expected.getvalue() == \
+            self.tmpdir.join('out', 'two-ppa_c_d.yaml').read()
+
+    def test_each_script_read_once(self, mocker):
+        read_spy = mocker.spy(generate_build_config, '_read_script')
+        generate_build_config._write_matrix_cloud_configs(
+            self.matrix_file.strpath)
+        assert 2 == read_spy.call_count
+
+    def test_each_stanza_encoded_once(self, mocker):
+        encode_spy = mocker.spy(
+            generate_build_config, '_produce_write_files_stanza')
+        generate_build_config._write_matrix_cloud_configs(
+            self.matrix_file.strpath)
+        # setup, teardown and each of the two scripts
+        assert 4 == encode_spy.call_count
+
+    def test_defaults_apply_to_every_config(self):
+        paths = generate_build_config._write_matrix_cloud_configs(
+            self.matrix_file.strpath, defaults={'image_ppa': 'foo/bar:1001'})
+        for path in paths:
+            assert '--extra-ppa foo/bar:1001' in py.path.local(path).read()
+
+    def test_output_matches_command_line_render(self):
+        generate_build_config._write_matrix_cloud_configs(
+            self.matrix_file.strpath)
+        expected = self.tmpdir.join('expected.yaml')
+        subprocess.check_call([
+            sys.executable, generate_build_config.__file__, expected.strpath,
+            '--build-ppa', 'ppa:a/b', '--customisation-script',
+            self.scripts[0].strpath])
+        assert expected.read() == \
+            self.tmpdir.join('out', 'one-ppa_a_b.yaml').read()
+
+    @pytest.mark.benchmark
+    def test_benchmark_against_per_invocation_loop(self, capsys):
+        paths = []
+
+        def batch():
+            paths[:] = generate_build_config._write_matrix_cloud_configs(
+                self.matrix_file.strpath)
+
+        def loop():
+            for index in range(len(paths)):
+                subprocess.check_call([
+                    sys.executable, generate_build_config.__file__,
+                    self.tmpdir.join('loop-{}.yaml'.format(index)).strpath,
+                    '--build-ppa', 'ppa:a/b', '--customisation-script',
+                    self.scripts[index % 2].strpath])
+
+        batch_time = min(timeit.repeat(batch, number=1, repeat=3))
+        loop_time = min(timeit.repeat(loop, number=1, repeat=1))
+        with capsys.disabled():
+            print('\nmatrix: {:.1f} configs/s batched, {:.1f} configs/s '
+                  'per-invocation'.format(len(paths) / batch_time,
+                                          len(paths) / loop_time))
+        assert batch_time < loop_time
+
+
+class TestRenderCache(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self, tmpdir):
+        self.cache_dir = tmpdir.join('cache')
+        self.script = tmpdir.join('script.sh')
+        self.script.write('#!/bin/sh\necho customise\n')
+        self.kwargs = {'build_ppa': 'ppa:foo/bar',
+                       'customisation_script': self.script.strpath}
+
+    def _render(self, **kwargs):
+        output = io.BytesIO()
+        hit = generate_build_config._write_cloud_config_cached(
+            output, self.cache_dir.strpath, **kwargs)
+        return hit, output.getvalue()
+
+    def test_miss_then_hit(self, mocker):
+        assert (False, self._render_fresh()) == self._render(**self.kwargs)
+        write_spy = mocker.spy(generate_build_config, '_write_cloud_config')
+        assert (True, self._render_fresh()) == self._render(**self.kwargs)
+        assert 1 == write_spy.call_count  # Only for _render_fresh
+
+    def _render_fresh(self):
+        return generate_build_config.BuildConfig(
+            **self.kwargs).render().encode('utf-8')
+
+    def test_key_ignores_argument_order(self):
+        assert generate_build_config._get_render_cache_key(
+            dict(sorted(self.kwargs.items()))) == \
+            generate_build_config._get_render_cache_key(
+                dict(reversed(sorted(self.kwargs.items()))))
+
+    def test_key_changes_with_arguments(self):
+        get_key = generate_build_config._get_render_cache_key
+        assert get_key(self.kwargs) != get_key(
+            dict(self.kwargs, build_ppa='ppa:foo/baz'))
+
+    def test_key_changes_with_script_content(self):
+        key = generate_build_config._get_render_cache_key(self.kwargs)
+        self.script.write('#!/bin/sh\necho changed\n')
+        assert key != generate_build_config._get_render_cache_key(
+            self.kwargs)
+
+    def test_changed_script_not_served_from_cache(self):
+        self._render(**self.kwargs)
+        self.script.write('#!/bin/sh\necho changed\n')
+        hit, output = self._render(**self.kwargs)
+        assert not hit
+        assert any(b'echo changed' in base64.b64decode(stanza['content'])
+                   for stanza in yaml.safe_load(output)['write_files'])
+
+    def test_base_image_cache_configs_not_cached(self, mocker):
+        mocker.patch('generate_build_config._get_base_image_checksum',
+                     return_value='abcd')
+        for _ in range(2):
+            assert not self._render(base_image_cache='/cache')[0]
+        assert not self.cache_dir.check()
+
+    def test_verify_passes_for_identical_render(self):
+        self._render(**self.kwargs)
+        output = io.BytesIO()
+        assert generate_build_config._write_cloud_config_cached(
+            output, self.cache_dir.strpath, verify=True, **self.kwargs)
+        assert self._render_fresh() == output.getvalue()
+
+    def test_verify_fails_for_different_render(self):
+        self._render(**self.kwargs)
+        entry = self.cache_dir.listdir()[0]
+        entry.write('#cloud-config\n')
+        with pytest.raises(ValueError):
+            generate_build_config._write_cloud_config_cached(
+                io.BytesIO(), self.cache_dir.strpath, verify=True,
+                **self.kwargs)
+        assert not entry.check()
+
+    def test_least_recently_used_evicted(self):
+        self.cache_dir.ensure(dir=True)
+        for index, name in enumerate(['old', 'used', 'new']):
+            entry = self.cache_dir.join(name + '.yaml')
+            entry.write('x' * 1000)
+            entry.setmtime(1000000000 + index)
+        self.cache_dir.join('used.yaml').setmtime(1000000010)
+        generate_build_config._evict_render_cache(self.cache_dir.strpath,
+                                                  2000)
+        assert ['new.yaml', 'used.yaml'] == sorted(
+            entry.basename for entry in self.cache_dir.listdir())
+
+    def test_cache_kept_under_size_cap(self):
+        for index in range(3):
+            self._render(build_ppa='ppa:foo/bar{}'.format(index))
+        cap = 2 * max(entry.size() for entry in self.cache_dir.listdir())
+        generate_build_config._write_cloud_config_cached(
+            io.BytesIO(), self.cache_dir.strpath,
+            cache_size=float(cap) / 2 ** 20, build_ppa='ppa:foo/bar3')
+        assert cap >= sum(entry.size() for entry in self.cache_dir.listdir())
+
+
+class TestCheckShellSyntax(object):
+
+    def test_valid_script(self):
+        assert [] == generate_build_config._check_shell_syntax(
+            '#!/bin/sh\necho hello\n', 'hook')
+
+    def test_syntax_error_reported_with_line(self):
+        diagnostics = generate_build_config._check_shell_syntax(
+            '#!/bin/sh\nif true; then\necho\n', 'hook')
+        assert 1 == len(diagnostics)
+        assert diagnostics[0].startswith('hook: ')
+
+    def test_missing_shebang_reported(self):
+        assert 1 == len(generate_build_config._check_shell_syntax(
+            'echo hello\n', 'hook'))
+
+    def test_other_interpreters_not_checked(self):
+        assert [] == generate_build_config._check_shell_syntax(
+            '#!/usr/bin/env python\nif True:\n', 'hook')
+
+
+class TestCheckBuildConfig(object):
+
+    def test_defaults_pass(self):
+        assert [] == generate_build_config._check_build_config()
+
+    def test_user_data_limit_checked(self):
+        diagnostics = generate_build_config._check_build_config(
+            user_data_limit=1000)
+        assert 1 == len(diagnostics)
+        assert diagnostics[0].startswith('--user-data-limit: ')
+        assert 'limit of 1000 bytes' in diagnostics[0]
+
+    def test_user_data_limit_met(self):
+        assert [] == generate_build_config._check_build_config(
+            user_data_limit=16384)
+
+    def test_all_features_pass(self, customisation_dir, tmpdir):
+        script = tmpdir.join('script.sh')
+        script.write('#!/bin/sh\necho customise\n')
+        assert [] == generate_build_config._check_build_config(
+            apt_cache_local=True, apt_proxy='http://proxy:3128',
+            architectures=['amd64', 'arm64'], artifacts=['qcow2'],
+            binary_customisation_script=script.strpath,
+            binary_hook_filter='*', build_ppa='ppa:foo/bar',
+            chroot_snapshot_dir='/snap', chroot_storage='auto',
+            compress_payloads=True,
+            customisation_dir=customisation_dir.strpath,
+            customisation_script=script.strpath, image_ppa='foo/bar:1001',
+            instrument=True, launchpad_buildd='http://mirror/lpbuildd.tar.gz',
+            launchpad_buildd_sha256='abcd')
+
+    def test_no_network_access(self, mocker):
+        checksum_mock = mocker.patch(
+            'generate_build_config._get_base_image_checksum')
+        assert [] == generate_build_config._check_build_config(
+            base_image_cache='/cache')
+        assert 0 == checksum_mock.call_count
+
+    @pytest.mark.parametrize('kwargs,option', [
+        ({'image_ppa': 'ppa:foo/bar'}, '--image-ppa'),
+        ({'image_ppa': '~foo/bar'}, '--image-ppa'),
+        ({'image_ppa': 'foo/bar:high'}, '--image-ppa'),
+        ({'build_ppa': 'foo/bar'}, '--build-ppa'),
+        ({'build_ppa': 'https://example.com/ubuntu'}, '--build-ppa'),
+        ({'build_ppa': 'https://private-ppa.launchpad.net/foo/bar/ubuntu'},
+         '--build-ppa-key'),
+        ({'build_ppa': 'ppa:foo/bar', 'build_ppa_key': 'not-a-key'},
+         '--build-ppa-key'),
+        ({'apt_proxy': 'proxy:3128'}, '--apt-proxy'),
+        ({'binary_hook_filter': 'no-such-hook*'}, '--binary-hook-filter'),
+        ({'customisation_script': '/nonexistent.sh'},
+         '--customisation-script'),
+    ])
+    def test_invalid_inputs_reported(self, kwargs, option):
+        diagnostics = generate_build_config._check_build_config(**kwargs)
+        assert 1 == len(diagnostics)
+        assert diagnostics[0].startswith(option + ': ')
+
+    @pytest.mark.parametrize('binary_hook_filter', [
+        '03*', '030-root-tarball.binary', '*-root-squashfs.binary',
+        '040*|041*'])
+    def test_binary_hook_filters_of_real_hooks_pass(
+            self, binary_hook_filter):
+        assert [] == generate_build_config._check_build_config(
+            binary_hook_filter=binary_hook_filter)
+
+    def test_artifact_hooks_are_known_hooks(self):
+        patterns = itertools.chain.from_iterable(
+            generate_build_config.ARTIFACT_HOOKS.values())
+        for pattern in patterns:
+            assert any(fnmatch.fnmatch(name, pattern) for name in
+                       generate_build_config.UBUNTU_CPC_BINARY_HOOKS)
+
+    def test_empty_script_reported(self, tmpdir):
+        script = tmpdir.join('script.sh')
+        script.write('\n')
+        diagnostics = generate_build_config._check_build_config(
+            binary_customisation_script=script.strpath)
+        assert ['--binary-customisation-script: {} is empty, so would not '
+                'be run'.format(script.strpath)] == diagnostics
+
+    def test_script_syntax_error_reported(self, tmpdir):
+        script = tmpdir.join('script.sh')
+        script.write('#!/bin/sh\nfor x in; do\n')
+        diagnostics = generate_build_config._check_build_config(
+            customisation_script=script.strpath)
+        assert 1 == len(diagnostics)
+        assert diagnostics[0].startswith(script.strpath + ': ')
+
+    def test_customisation_dir_hook_syntax_error_reported(
+            self, customisation_dir):
+        hook = customisation_dir.join('30-broken.chroot')
+        hook.write('#!/bin/sh\n(\n')
+        assert [hook.strpath] == [
+            diagnostic.split(': ')[0] for diagnostic in
+            generate_build_config._check_build_config(
+                customisation_dir=customisation_dir.strpath)]
+
+    def test_render_errors_reported(self):
+        assert ['parallel_builds must be at least 1.'] == \
+            generate_build_config._check_build_config(parallel_builds=0)
+
+    def test_broken_template_reported(self, monkeypatch, tmpdir):
+        monkeypatch.setattr(generate_build_config, 'TEARDOWN_CONTENT',
+                            '#!/bin/sh\nfi\n')
+        script = tmpdir.join('script.sh')
+        script.write('#!/bin/sh\necho customise\n')
+        diagnostics = generate_build_config._check_build_config(
+            customisation_script=script.strpath)
+        assert any(diagnostic.split(': ')[0].endswith(
+            '9999-local-modifications.chroot') for diagnostic in diagnostics)
+
+
 class TestMain(object):
 
     def test_main_exits_nonzero_with_too_many_cli_arguments(
@@ -317,38 +3826,196 @@ class TestMain(object):
             generate_build_config.main()
         assert excinfo.value.code > 0
 
+    @pytest.mark.parametrize('argv,code', [
+        ([], 0), (['--image-ppa', 'ppa:foo/bar'], 1)])
+    def test_main_check(self, argv, code, capsys, mocker, tmpdir):
+        output = tmpdir.join('output.yaml')
+        output.write('existing')
+        mocker.patch('sys.argv', ['ubuntu-standalone-builder.py',
+                                  output.strpath, '--check'] + argv)
+        with pytest.raises(SystemExit) as excinfo:
+            generate_build_config.main()
+        assert code == excinfo.value.code
+        assert 'existing' == output.read()
+        assert bool(code) == capsys.readouterr().err.startswith(
+            '--image-ppa: ')
+
+    def test_main_uses_render_cache(self, mocker, tmpdir):
+        mocker.patch('sys.argv', ['ubuntu-standalone-builder.py',
+                                  tmpdir.join('output.yaml').strpath,
+                                  '--render-cache', '/cache',
+                                  '--render-cache-size', '10',
+                                  '--render-cache-verify'])
+        cached_mock = mocker.patch(
+            'generate_build_config._write_cloud_config_cached')
+        write_mock = mocker.patch('generate_build_config._write_cloud_config')
+        generate_build_config.main()
+        assert 0 == write_mock.call_count
+        args, kwargs = cached_mock.call_args
+        assert '/cache' == args[1]
+        assert 10 == kwargs['cache_size']
+        assert kwargs['verify']
+
+    def test_main_rejects_render_cache_with_matrix(self, mocker, tmpdir):
+        mocker.patch('sys.argv', ['ubuntu-standalone-builder.py',
+                                  '--matrix', tmpdir.join('m.yaml').strpath,
+                                  '--render-cache', '/cache'])
+        with pytest.raises(SystemExit) as excinfo:
+            generate_build_config.main()
+        assert excinfo.value.code > 0
+
     def test_main_passes_arguments_to_write_cloud_config(self, mocker, tmpdir):
         output_filename = tmpdir.join('output.yaml').strpath
+        apt_proxy = 'http://proxy:3128'
+        architectures = ['amd64', 'arm64']
+        artifacts = ['squashfs', 'qcow2']
+        base_image_cache = '/var/cache/images'
         binary_customisation_script = 'binary.sh'
         binary_hook_filter = 'binary*hook*'
+        customisation_dir = 'customisation'
         customisation_script = 'script.sh'
         homedir = '/var/tmp'
         build_ppa = 'ppa:foo/bar'
         build_ppa_key = 'DEADBEEF'
+        chroot_snapshot_dir = '/srv/snapshots'
+        chroot_storage = 'auto'
+        chroot_storage_size = 4096
         image_ppa = 'foo/bar:1001'
+        instrument = True
+        launchpad_buildd = 'http://mirror/lpbuildd.tar.gz'
+        launchpad_buildd_sha256 = 'abcd'
+        parallel_builds = 2
+        projects = ['ubuntu-cpc']
+        series = 'bionic'
         mocker.patch('sys.argv', ['ubuntu-standalone-builder.py',
                                   output_filename,
+                                  '--apt-cache-local',
+                                  '--apt-proxy', apt_proxy,
+                                  '--arch', architectures[0],
+                                  '--arch', architectures[1],
+                                  '--artifacts', ','.join(artifacts),
+                                  '--base-image-cache', base_image_cache,
                                   '--binary-customisation-script',
                                   binary_customisation_script,
                                   '--binary-hook-filter',
                                   binary_hook_filter,
+                                  '--customisation-dir',
+                                  customisation_dir,
                                   '--customisation-script',
                                   customisation_script,
+                                  '--grub-probe-shim', 'fast',
                                   '--homedir', homedir,
                                   '--build-ppa', build_ppa,
                                   '--build-ppa-key', build_ppa_key,
-                                  '--image-ppa', image_ppa])
+                                  '--chroot-snapshot-dir',
+                                  chroot_snapshot_dir,
+                                  '--chroot-storage', chroot_storage,
+                                  '--chroot-storage-size',
+                                  str(chroot_storage_size),
+                                  '--compress-payloads',
+                                  '--image-ppa', image_ppa,
+                                  '--instrument',
+                                  '--launchpad-buildd', launchpad_buildd,
+                                  '--launchpad-buildd-sha256',
+                                  launchpad_buildd_sha256,
+                                  '--offline-bundle', '/srv/bundle.tar',
+                                  '--artifact-manifest',
+                                  '--compress-artifacts', 'zstd',
+                                  '--compression-level', '9',
+                                  '--parallel-builds', str(parallel_builds),
+                                  '--prefetch',
+                                  '--progress-log', '/var/log/progress.log',
+                                  '--project', projects[0],
+                                  '--publish-chunk-size', '512',
+                                  '--publish-jobs', '8',
+                                  '--publish-url', 'http://example.com/',
+                                  '--series', series,
+                                  '--squashfs-block-size', '256',
+                                  '--squashfs-compressor', 'lz4',
+                                  '--unsquashfs-processors', 'auto',
+                                  '--user-data-limit', 'azure',
+                                  '--worker-job', 'job1'])
         write_cloud_config_mock = mocker.patch(
             'generate_build_config._write_cloud_config')
         generate_build_config.main()
         assert len(write_cloud_config_mock.call_args_list) == 1
         call = write_cloud_config_mock.call_args_list[0]
         assert ({
+            'apt_cache_local': True,
+            'apt_proxy': apt_proxy,
+            'architectures': architectures,
+            'artifact_manifest': True,
+            'artifacts': artifacts,
+            'base_image_cache': base_image_cache,
             'binary_customisation_script': binary_customisation_script,
             'binary_hook_filter': binary_hook_filter,
+            'customisation_dir': customisation_dir,
             'customisation_script': customisation_script,
+            'grub_probe_shim': 'fast',
             'homedir': homedir,
             'build_ppa': build_ppa,
             'build_ppa_key': build_ppa_key,
-            'image_ppa': image_ppa},) == call[1:]
+            'chroot_snapshot_dir': chroot_snapshot_dir,
+            'chroot_storage': chroot_storage,
+            'chroot_storage_size': chroot_storage_size,
+            'compress_artifacts': 'zstd',
+            'compress_payloads': True,
+            'compression_level': 9,
+            'image_ppa': image_ppa,
+            'instrument': instrument,
+            'launchpad_buildd': launchpad_buildd,
+            'launchpad_buildd_sha256': launchpad_buildd_sha256,
+            'offline_bundle': '/srv/bundle.tar',
+            'parallel_builds': parallel_builds,
+            'prefetch': True,
+            'progress_log': '/var/log/progress.log',
+            'projects': projects,
+            'publish_chunk_size': 512,
+            'publish_jobs': 8,
+            'publish_url': 'http://example.com/',
+            'series': series,
+            'squashfs_block_size': 256,
+            'squashfs_compressor': 'lz4',
+            'unsquashfs_processors': 'auto',
+            'user_data_limit': 65536,
+            'worker': False,
+            'worker_job': 'job1'},) == call[1:]
         assert output_filename == call[0][0].name
+
+    def test_main_passes_matrix_and_defaults(self, mocker):
+        mocker.patch('sys.argv', ['ubuntu-standalone-builder.py',
+                                  '--matrix', 'matrix.yaml',
+                                  '--image-ppa', 'foo/bar'])
+        write_cloud_config_mock = mocker.patch(
+            'generate_build_config._write_cloud_config')
+        write_matrix_mock = mocker.patch(
+            'generate_build_config._write_matrix_cloud_configs')
+        generate_build_config.main()
+        assert 0 == write_cloud_config_mock.call_count
+        call = write_matrix_mock.call_args_list[0]
+        assert ('matrix.yaml',) == call[0]
+        assert 'foo/bar' == call[1]['defaults']['image_ppa']
+
+    def test_main_rejects_outfile_with_matrix(self, mocker, tmpdir):
+        output = tmpdir.join('out.yaml')
+        output.write('existing')
+        mocker.patch('sys.argv', ['ubuntu-standalone-builder.py',
+                                  output.strpath,
+                                  '--matrix', 'matrix.yaml'])
+        with pytest.raises(SystemExit) as excinfo:
+            generate_build_config.main()
+        assert excinfo.value.code > 0
+        assert 'existing' == output.read()
+
+    @pytest.mark.parametrize('argv', [[], ['-']])
+    def test_main_writes_to_stdout(self, argv, capsys, mocker):
+        mocker.patch('sys.argv', ['ubuntu-standalone-builder.py'] + argv)
+        generate_build_config.main()
+        assert 'runcmd' in yaml.safe_load(capsys.readouterr().out)
+
+    def test_main_rejects_unwritable_outfile(self, mocker, tmpdir):
+        mocker.patch('sys.argv', ['ubuntu-standalone-builder.py',
+                                  tmpdir.join('missing', 'out.yaml').strpath])
+        with pytest.raises(SystemExit) as excinfo:
+            generate_build_config.main()
+        assert excinfo.value.code > 0